@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+import json
+import os
+
+from openai import NotFoundError
+
+from persistence import atomic_write
+
+
+ASSISTANT_MANIFEST_FILE = 'assistants.json'
+
+
+def spec_hash(spec: dict) -> str:
+  return hashlib.sha256(json.dumps(spec, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+def load_manifest(path: str = ASSISTANT_MANIFEST_FILE) -> dict:
+  if not os.path.exists(path):
+    return {}
+  try:
+    with open(path, "r", encoding="utf-8") as f:
+      return json.load(f)
+  except Exception as e:
+    print(f"[Error] Failed to load assistant manifest: {e}")
+    return {}
+
+def save_manifest(manifest: dict, path: str = ASSISTANT_MANIFEST_FILE):
+  atomic_write(os.path.abspath(path), json.dumps(manifest, ensure_ascii=False, indent=2))
+
+
+async def find_assistants(client, names: set) -> dict:
+  # The list endpoint is paginated; iterating the paginator walks every page
+  found = {}
+  async for assistant in client.beta.assistants.list(limit=100, order="desc"):
+    if assistant.name in names and assistant.name not in found:
+      found[assistant.name] = assistant
+  return found
+
+async def assistant_exists(client, assistant_id: str) -> bool:
+  try:
+    await client.beta.assistants.retrieve(assistant_id)
+  except NotFoundError:
+    return False
+  return True
+
+async def create_assistant(client, spec: dict, digest: str):
+  return await client.beta.assistants.create(
+    name=spec['name'],
+    model=spec['model'],
+    metadata={**spec['metadata'], 'spec_hash': digest},
+    instructions=spec['instructions'],
+    tools=spec['tools'],
+    **{option: spec[option] for option in ('temperature', 'top_p') if option in spec},
+  )
+
+async def reconcile_assistants(client, specs: dict, path: str = ASSISTANT_MANIFEST_FILE) -> dict:
+  manifest = load_manifest(path)
+  digests = {key: spec_hash(spec) for key, spec in specs.items()}
+  assistant_ids = {
+    key: manifest[key]['assistant_id']
+    for key, digest in digests.items()
+    if key in manifest and manifest[key].get('spec_hash') == digest
+  }
+  # A matching hash says the spec is unchanged, not that the assistant is still there; one deleted
+  # from the dashboard is looked up or created again like any other missing one
+  exists = await asyncio.gather(*[assistant_exists(client, assistant_id) for assistant_id in assistant_ids.values()])
+  for key, found in zip(list(assistant_ids), exists):
+    if not found:
+      print(f"[Debug] Assistant '{specs[key]['name']}' in the manifest no longer exists.")
+      del assistant_ids[key]
+  missing = [key for key in specs if key not in assistant_ids]
+  if not missing:
+    print("[Debug] Assistant manifest is up to date, skipping assistant setup.")
+    return assistant_ids
+
+  existing = await find_assistants(client, {specs[key]['name'] for key in missing})
+  to_create = []
+  for key in missing:
+    assistant = existing.get(specs[key]['name'])
+    if assistant and (assistant.metadata or {}).get('spec_hash') == digests[key]:
+      print(f"[Debug] Assistant '{specs[key]['name']}' already exists with the correct spec.")
+      assistant_ids[key] = assistant.id
+    else:
+      to_create.append(key)
+
+  created = await asyncio.gather(*[create_assistant(client, specs[key], digests[key]) for key in to_create])
+  for key, assistant in zip(to_create, created):
+    assistant_ids[key] = assistant.id
+    print(f"[Debug] Created assistant '{specs[key]['name']}' with metadata {specs[key]['metadata']}.")
+
+  save_manifest({
+    key: {'name': specs[key]['name'], 'assistant_id': assistant_ids[key], 'spec_hash': digests[key]}
+    for key in specs
+  }, path)
+  return assistant_ids
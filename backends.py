@@ -0,0 +1,292 @@
+import asyncio
+import inspect
+import json
+import os
+import uuid
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import tracing
+from metrics import STAGE_SECONDS, RUNS_IN_FLIGHT
+from run_engine import Backend
+from usage import estimate_tokens
+
+
+TRANSCRIPT_FOLDER = 'transcripts'
+CHAT_CONTEXT_TOKENS = 24000
+MAX_TOOL_ROUNDS = 8
+MAX_RESIDENT_TRANSCRIPTS = 64
+
+
+def new_id(prefix: str) -> str:
+  return f"{prefix}_{uuid.uuid4().hex[:24]}"
+
+def as_message(entry: dict):
+  # Shaped like an Assistants thread message so callers can treat both backends alike
+  return SimpleNamespace(
+    id=entry['id'],
+    role=entry['role'],
+    status="completed",
+    run_id=entry.get('run_id'),
+    content=[SimpleNamespace(type="text", text=SimpleNamespace(value=entry['content']))],
+    attachments=[SimpleNamespace(file_id=file_id) for file_id in entry.get('attachments', [])],
+  )
+
+
+class ChatBackend(Backend):
+  # Keeps every thread as a local transcript and sends a stateless chat completion per step, so
+  # a turn costs one request instead of a run plus polls. The window sent each step is the
+  # thread's seed plus the newest entries that fit context_tokens.
+  prefix = "chat_"
+
+  def __init__(self, client, rate_limiter=None, tool_handler=None, resolve_attachment=None, context_tokens: int = CHAT_CONTEXT_TOKENS, folder: str = TRANSCRIPT_FOLDER):
+    super().__init__(rate_limiter, tool_handler)
+    self.client = client
+    self.resolve_attachment = resolve_attachment
+    self.context_tokens = context_tokens
+    self.folder = folder
+    self.assistants = {}
+    self.transcripts = OrderedDict()
+    self.attachment_texts = {}
+
+  def owns(self, assistant_id: str) -> bool:
+    return bool(assistant_id) and assistant_id.startswith(self.prefix)
+
+  def register_assistant(self, key: str, spec: dict) -> str:
+    assistant_id = f"{self.prefix}{key}"
+    self.assistants[assistant_id] = spec
+    return assistant_id
+
+  def transcript_path(self, thread_id: str) -> str:
+    return os.path.join(self.folder, f"{thread_id}.jsonl")
+
+  def read_transcript(self, thread_id: str) -> list:
+    if not self.folder or not os.path.exists(self.transcript_path(thread_id)):
+      return []
+    with open(self.transcript_path(thread_id), "r", encoding="utf-8") as f:
+      return [json.loads(line) for line in f if line.strip()]
+
+  def write_entries(self, thread_id: str, entries: list):
+    os.makedirs(self.folder, exist_ok=True)
+    with open(self.transcript_path(thread_id), "a", encoding="utf-8") as f:
+      for entry in entries:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+  async def transcript(self, thread_id: str) -> list:
+    if thread_id not in self.transcripts:
+      self.transcripts[thread_id] = await asyncio.to_thread(self.read_transcript, thread_id)
+    self.transcripts.move_to_end(thread_id)
+    # Transcripts on disk are reloaded on demand; without a folder they have to stay resident
+    while self.folder and len(self.transcripts) > MAX_RESIDENT_TRANSCRIPTS:
+      self.transcripts.popitem(last=False)
+    return self.transcripts[thread_id]
+
+  async def append(self, thread_id: str, *entries: dict):
+    transcript = await self.transcript(thread_id)
+    transcript.extend(entries)
+    if self.folder:
+      await asyncio.to_thread(self.write_entries, thread_id, list(entries))
+
+  def user_entry(self, message: dict) -> dict:
+    return {
+      'id': new_id("msg"),
+      'role': message.get('role', "user"),
+      'content': message['content'],
+      'attachments': [attachment['file_id'] for attachment in message.get('attachments') or []],
+    }
+
+  async def create_thread(self, messages: list = None) -> str:
+    thread_id = new_id(f"{self.prefix}thread")
+    self.transcripts[thread_id] = []
+    if messages:
+      await self.append(thread_id, *[self.user_entry(message) for message in messages])
+    return thread_id
+
+  async def add_message(self, thread_id: str, content: str, attachments: list = [], role: str = "user"):
+    await self.append(thread_id, self.user_entry({'role': role, 'content': content, 'attachments': attachments}))
+
+  async def list_messages(self, thread_id: str, after: str = None) -> list:
+    entries = await self.transcript(thread_id)
+    if after:
+      ids = [entry['id'] for entry in entries]
+      entries = entries[ids.index(after) + 1:] if after in ids else entries
+    return [as_message(entry) for entry in entries if entry['role'] in ("user", "assistant") and entry.get('content')]
+
+  async def attachment_text(self, file_id: str) -> str:
+    if file_id not in self.attachment_texts:
+      text = await asyncio.to_thread(self.resolve_attachment, file_id) if self.resolve_attachment else None
+      self.attachment_texts[file_id] = text
+    return self.attachment_texts[file_id]
+
+  async def render(self, entry: dict) -> dict:
+    if entry['role'] == "tool":
+      return {'role': "tool", 'tool_call_id': entry['tool_call_id'], 'content': entry['content']}
+    message = {'role': entry['role'], 'content': entry.get('content') or ""}
+    for file_id in entry.get('attachments', []):
+      text = await self.attachment_text(file_id)
+      if text:
+        message['content'] += f"\n\n（附件 {file_id}）\n{text}"
+    if entry.get('tool_calls'):
+      message['tool_calls'] = entry['tool_calls']
+    return message
+
+  async def context(self, thread_id: str, spec: dict) -> list:
+    entries = await self.transcript(thread_id)
+    rendered = [await self.render(entry) for entry in entries]
+    sizes = [estimate_tokens(message['content']) + estimate_tokens(json.dumps(message.get('tool_calls', []))) for message in rendered]
+    budget = self.context_tokens - estimate_tokens(spec['instructions']) - (sizes[0] if sizes else 0)
+    start = len(rendered)
+    while start > 1 and sizes[start - 1] <= budget:
+      start -= 1
+      budget -= sizes[start]
+    # A tool result cannot open the window without the assistant message that called it
+    while start < len(rendered) and rendered[start]['role'] == "tool":
+      start += 1
+    return [{'role': "system", 'content': spec['instructions']}] + rendered[:1] + rendered[max(start, 1):]
+
+  async def complete(self, spec: dict, messages: list, on_text=None) -> (str, list, object):
+    tools = [tool for tool in spec['tools'] if tool['type'] == "function"]
+    options = {'tools': tools} if tools else {}
+    options.update({option: spec[option] for option in ('temperature', 'top_p') if option in spec})
+    if not on_text:
+      response = await self.client.chat.completions.create(model=spec['model'], messages=messages, **options)
+      message = response.choices[0].message
+      tool_calls = [tool_call.model_dump() for tool_call in message.tool_calls or []]
+      return message.content or "", tool_calls, response.usage
+
+    content = ""
+    tool_calls = {}
+    usage = None
+    stream = await self.client.chat.completions.create(
+      model=spec['model'],
+      messages=messages,
+      stream=True,
+      stream_options={'include_usage': True},
+      **options,
+    )
+    async for chunk in stream:
+      if chunk.usage:
+        usage = chunk.usage
+      if not chunk.choices:
+        continue
+      delta = chunk.choices[0].delta
+      if delta.content:
+        content += delta.content
+        await on_text(content)
+      # Tool calls arrive in fragments keyed by index; the id and name come first
+      for fragment in delta.tool_calls or []:
+        tool_call = tool_calls.setdefault(fragment.index, {'id': None, 'type': "function", 'function': {'name': "", 'arguments': ""}})
+        if fragment.id:
+          tool_call['id'] = fragment.id
+        if fragment.function and fragment.function.name:
+          tool_call['function']['name'] += fragment.function.name
+        if fragment.function and fragment.function.arguments:
+          tool_call['function']['arguments'] += fragment.function.arguments
+    return content, [tool_calls[index] for index in sorted(tool_calls)], usage
+
+  async def run_and_fetch(self, thread_id: str, assistant_id: str, messages: list = None, on_text=None, on_run=None) -> (str, object, str):
+    with RUNS_IN_FLIGHT.track(), tracing.span("run", thread=thread_id, assistant=assistant_id, streamed=bool(on_text)) as span:
+      reply, run_status, error = await self.run_steps(thread_id, assistant_id, messages, on_text, on_run)
+      span.set("run.status", run_status.status)
+      return reply, run_status, error
+
+  async def resume(self, thread_id: str, assistant_id: str, run_id: str = None, since: float = None) -> (str, object, str):
+    # Local runs live in the transcript: a run that got to answer has its reply there, and one
+    # that did not is completed again from the transcript, which already holds its messages
+    if not run_id or not thread_id:
+      return None
+    entries = await self.transcript(thread_id)
+    if not entries:
+      return None
+    usage = SimpleNamespace(prompt_tokens=0, completion_tokens=0, total_tokens=0)
+    for entry in reversed(entries):
+      if entry.get('run_id') == run_id and entry['role'] == "assistant" and not entry.get('tool_calls'):
+        return entry['content'], SimpleNamespace(id=run_id, thread_id=thread_id, status="completed", usage=usage), None
+    return await self.run_and_fetch(thread_id, assistant_id)
+
+  async def run_steps(self, thread_id: str, assistant_id: str, messages: list = None, on_text=None, on_run=None) -> (str, object, str):
+    if thread_id is None:
+      thread_id = await self.create_thread(messages)
+    elif messages:
+      await self.append(thread_id, *[self.user_entry(message) for message in messages])
+    run_status = SimpleNamespace(
+      id=new_id("run"),
+      thread_id=thread_id,
+      status="in_progress",
+      usage=SimpleNamespace(prompt_tokens=0, completion_tokens=0, total_tokens=0),
+    )
+    if on_run:
+      await on_run(run_status)
+    spec = self.assistants.get(assistant_id)
+    if spec is None:
+      run_status.status = "failed"
+      return None, run_status, f"❌ Bot錯誤. 狀態: {run_status.status}"
+
+    for _ in range(MAX_TOOL_ROUNDS):
+      await self.throttle()
+      context = await self.context(thread_id, spec)
+      with STAGE_SECONDS.time("run_in_progress"), tracing.span("model.completion", model=spec['model'], messages=len(context)) as span:
+        content, tool_calls, usage = await self.complete(spec, context, on_text)
+        span.set("tool_calls", len(tool_calls))
+        if usage:
+          span.set("tokens.prompt", usage.prompt_tokens)
+          span.set("tokens.completion", usage.completion_tokens)
+      if usage:
+        run_status.usage.prompt_tokens += usage.prompt_tokens
+        run_status.usage.completion_tokens += usage.completion_tokens
+        run_status.usage.total_tokens += usage.total_tokens
+      if not tool_calls:
+        break
+      await self.append(thread_id, {'id': new_id("msg"), 'role': "assistant", 'content': content, 'tool_calls': tool_calls, 'run_id': run_status.id})
+      tool_outputs = await asyncio.gather(*[
+        self.call_tool(thread_id, tool_call['id'], tool_call['function']['name'], tool_call['function']['arguments'])
+        for tool_call in tool_calls
+      ])
+      await self.append(thread_id, *[
+        {'id': new_id("msg"), 'role': "tool", 'tool_call_id': output['tool_call_id'], 'content': output['output'], 'run_id': run_status.id}
+        for output in tool_outputs
+      ])
+    else:
+      run_status.status = "incomplete"
+      return None, run_status, f"❌ Bot錯誤. 狀態: {run_status.status}"
+
+    run_status.status = "completed"
+    if not content:
+      return None, run_status, "❌ 沒有收到 AI 回覆。"
+    await self.append(thread_id, {'id': new_id("msg"), 'role': "assistant", 'content': content, 'run_id': run_status.id})
+    return content, run_status, None
+
+  async def stream_and_fetch(self, thread_id: str, assistant_id: str, on_text, messages: list = None, on_run=None) -> (str, object, str):
+    return await self.run_and_fetch(thread_id, assistant_id, messages, on_text=on_text, on_run=on_run)
+
+
+class FakeBackend(ChatBackend):
+  """Answers locally without a model so the bot can be exercised end to end offline.
+
+  reply, when given, is called as reply(spec, messages) and returns the reply text, or an
+  awaitable of it; tests and the load test pass a coroutine function there to complete a turn
+  only when they choose to. Without it the last user message is echoed back.
+  """
+  prefix = "fake_"
+
+  def __init__(self, rate_limiter=None, tool_handler=None, resolve_attachment=None, delay: float = 0, folder: str = None, reply=None):
+    super().__init__(None, rate_limiter, tool_handler, resolve_attachment, folder=folder)
+    self.delay = delay
+    self.reply = reply
+
+  async def complete(self, spec: dict, messages: list, on_text=None) -> (str, list, object):
+    if self.delay:
+      await asyncio.sleep(self.delay)
+    if self.reply:
+      content = self.reply(spec, messages)
+      if inspect.isawaitable(content):
+        content = await content
+    else:
+      last = next((message['content'] for message in reversed(messages) if message['role'] == "user"), "")
+      content = f"（測試敘事）{last[:80]}"
+    if on_text:
+      await on_text(content)
+    prompt_tokens = sum(estimate_tokens(message['content']) for message in messages)
+    completion_tokens = estimate_tokens(content)
+    usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens)
+    return content, [], usage
@@ -0,0 +1,160 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from run_engine import RunEngine, TERMINAL_RUN_STATUSES, user_message
+
+
+class FakeRunBackend:
+  def __init__(self, run_latency: float):
+    self.run_latency = run_latency
+    self.threads = {}
+    self.runs = {}
+    self.next_id = 0
+
+  def new_id(self, prefix: str) -> str:
+    self.next_id += 1
+    return f"{prefix}_{self.next_id}"
+
+  def create_thread(self):
+    thread_id = self.new_id("thread")
+    self.threads[thread_id] = []
+    return SimpleNamespace(id=thread_id)
+
+  def create_message(self, thread_id: str, role: str, content: str, run_id: str = None):
+    self.threads[thread_id].insert(0, SimpleNamespace(
+      role=role,
+      run_id=run_id,
+      content=[SimpleNamespace(type="text", text=SimpleNamespace(value=content))],
+    ))
+
+  def create_run(self, thread_id: str, messages: list = None):
+    for message in messages or []:
+      self.create_message(thread_id, message['role'], message['content'])
+    run_id = self.new_id("run")
+    self.runs[run_id] = {'thread_id': thread_id, 'started': time.monotonic(), 'done': False}
+    return SimpleNamespace(id=run_id, thread_id=thread_id)
+
+  def retrieve_run(self, run_id: str):
+    run = self.runs[run_id]
+    if time.monotonic() - run['started'] < self.run_latency:
+      return SimpleNamespace(status="in_progress", usage=None)
+    if not run['done']:
+      run['done'] = True
+      self.create_message(run['thread_id'], "assistant", f"reply to {run_id}", run_id)
+    return SimpleNamespace(id=run_id, thread_id=run['thread_id'], status="completed", usage=SimpleNamespace(total_tokens=100))
+
+  def list_messages(self, thread_id: str, limit: int, run_id: str = None):
+    messages = [message for message in self.threads[thread_id] if run_id is None or message.run_id == run_id]
+    return SimpleNamespace(data=messages[:limit])
+
+
+class FakeSyncClient:
+  def __init__(self, backend: FakeRunBackend):
+    self.beta = SimpleNamespace(threads=SimpleNamespace(
+      create=lambda messages=None: backend.create_thread(),
+      messages=SimpleNamespace(
+        create=lambda thread_id, role, content, attachments=[]: backend.create_message(thread_id, role, content),
+        list=lambda thread_id, limit: backend.list_messages(thread_id, limit),
+      ),
+      runs=SimpleNamespace(
+        create=lambda thread_id, assistant_id: backend.create_run(thread_id),
+        retrieve=lambda thread_id, run_id: backend.retrieve_run(run_id),
+      ),
+    ))
+
+
+class FakeAsyncClient:
+  def __init__(self, backend: FakeRunBackend):
+    self.calls = 0
+
+    def counted(fn):
+      async def call(*args, **kwargs):
+        self.calls += 1
+        return fn(*args, **kwargs)
+      return call
+
+    self.beta = SimpleNamespace(threads=SimpleNamespace(
+      create=counted(lambda messages=None: backend.create_thread()),
+      messages=SimpleNamespace(
+        create=counted(lambda thread_id, role, content, attachments=[]: backend.create_message(thread_id, role, content)),
+        list=counted(lambda thread_id, limit, run_id=None, order=None: backend.list_messages(thread_id, limit, run_id)),
+      ),
+      runs=SimpleNamespace(
+        create=counted(lambda thread_id, assistant_id, additional_messages=None: backend.create_run(thread_id, additional_messages)),
+        retrieve=counted(lambda thread_id, run_id: backend.retrieve_run(run_id)),
+      ),
+    ))
+
+
+async def blocking_turn(client: FakeSyncClient, thread_id: str, poll_interval: float):
+  # Mirrors the previous implementation: sync client calls and time.sleep polling inside a coroutine
+  client.beta.threads.messages.create(thread_id=thread_id, role="user", content="User ID:0\nhello")
+  run = client.beta.threads.runs.create(thread_id=thread_id, assistant_id="assistant")
+  while True:
+    run_status = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+    if run_status.status in TERMINAL_RUN_STATUSES:
+      break
+    time.sleep(poll_interval)
+  messages = client.beta.threads.messages.list(thread_id=thread_id, limit=5)
+  return next(msg.content[0].text.value for msg in messages.data if msg.role == "assistant")
+
+
+async def async_turn(engine: RunEngine, thread_id: str):
+  assistant_reply, _, error = await engine.run_and_fetch(thread_id, "assistant", [user_message("User ID:0\nhello")])
+  if error:
+    raise RuntimeError(error)
+  return assistant_reply
+
+
+async def bench_blocking(sessions: int, turns: int, run_latency: float, poll_interval: float) -> float:
+  client = FakeSyncClient(FakeRunBackend(run_latency))
+  thread_ids = [client.beta.threads.create().id for _ in range(sessions)]
+
+  async def session_loop(thread_id: str):
+    for _ in range(turns):
+      await blocking_turn(client, thread_id, poll_interval)
+
+  start = time.monotonic()
+  await asyncio.gather(*[session_loop(thread_id) for thread_id in thread_ids])
+  return time.monotonic() - start
+
+
+async def bench_async(sessions: int, turns: int, run_latency: float, poll_interval: float) -> float:
+  client = FakeAsyncClient(FakeRunBackend(run_latency))
+  engine = RunEngine(client, poll_interval=poll_interval)
+  thread_ids = [await engine.create_thread() for _ in range(sessions)]
+  client.calls = 0
+
+  async def session_loop(thread_id: str):
+    for _ in range(turns):
+      await async_turn(engine, thread_id)
+
+  start = time.monotonic()
+  await asyncio.gather(*[session_loop(thread_id) for thread_id in thread_ids])
+  elapsed = time.monotonic() - start
+  print(f"async run engine: {client.calls / (sessions * turns):.1f} round trips per turn")
+  return elapsed
+
+
+async def main():
+  parser = argparse.ArgumentParser(description="Concurrent-session throughput of the run engine against a fake backend")
+  parser.add_argument("--sessions", type=int, default=20)
+  parser.add_argument("--turns", type=int, default=3)
+  parser.add_argument("--run-latency", type=float, default=0.2, help="seconds until a fake run completes")
+  parser.add_argument("--poll-interval", type=float, default=0.05)
+  args = parser.parse_args()
+
+  total_turns = args.sessions * args.turns
+  for name, bench in [("blocking (sync client + time.sleep)", bench_blocking), ("async run engine", bench_async)]:
+    elapsed = await bench(args.sessions, args.turns, args.run_latency, args.poll_interval)
+    print(f"{name}: {total_turns} turns in {elapsed:.2f}s, {total_turns / elapsed:.1f} turns/s")
+
+
+if __name__ == "__main__":
+  asyncio.run(main())
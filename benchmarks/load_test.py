@@ -0,0 +1,185 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+from metrics import STAGE_SECONDS
+from testing.fakes import FakeAssistantsServer, FakeInteraction, build_client, import_bot, shutdown
+from usage import percentile
+
+
+class Pacer:
+  # Hands out command slots at a fixed rate across every simulated player
+  def __init__(self, rate: float):
+    self.interval = 1 / rate if rate else 0
+    self.next_at = time.monotonic()
+    self.lock = asyncio.Lock()
+
+  async def wait(self):
+    async with self.lock:
+      now = time.monotonic()
+      if self.next_at > now:
+        await asyncio.sleep(self.next_at - now)
+      self.next_at = max(now, self.next_at) + self.interval
+
+
+class Monitor:
+  def __init__(self, client, interval: float = 0.02):
+    self.client = client
+    self.interval = interval
+    self.lags = []
+    self.queue_depths = []
+    self.task = None
+
+  async def run(self):
+    while True:
+      started = time.monotonic()
+      await asyncio.sleep(self.interval)
+      self.lags.append(time.monotonic() - started - self.interval)
+      scheduler = self.client.scheduler
+      self.queue_depths.append(sum(scheduler.queue_depth(session_id) for session_id in scheduler.queues) + len(scheduler.limiter.waiters))
+
+  def start(self):
+    self.task = asyncio.create_task(self.run())
+
+  def stop(self):
+    self.task.cancel()
+
+
+async def settle(client, results: list, timeout: float = 120):
+  # Queued turns are answered by the session workers after the commands return; a worker holding
+  # a batch open for the batch window has already emptied the queue, so wait on the replies
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    answered = all(command.followup.events for _, command in results)
+    if answered and not client.scheduler.in_flight and not client.summary_tasks:
+      return True
+    await asyncio.sleep(0.05)
+  return False
+
+
+async def player(bot, client, pacer: Pacer, session_id: str, user_id: int, turns: int, results: list):
+  def interaction():
+    return FakeInteraction(bot.CHANNEL_ID, user_id, f"player{user_id}")
+
+  character_id = f"c{user_id}"
+  await pacer.wait()
+  command = interaction()
+  await client.tracked("create_character", client.create_character(command, character_id))
+  results.append(('create_character', command))
+  command = interaction()
+  await client.tracked("play", client.play(command, "我是一名來自北境的騎士。"))
+  results.append(('create_character', command))
+
+  await pacer.wait()
+  command = interaction()
+  await client.tracked("join", client.join(command, session_id, character_id, "我推開酒館的門。"))
+  results.append(('join', command))
+
+  for turn in range(turns):
+    await pacer.wait()
+    command = interaction()
+    await client.tracked("play", client.play(command, f"第 {turn + 1} 個行動"))
+    results.append(('play', command))
+
+async def load(bot, server: FakeAssistantsServer, args) -> dict:
+  client = await build_client(
+    bot, server, tempfile.mkdtemp(prefix="gpttrpg-load-"),
+    backend=args.backend,
+    streaming=not args.no_streaming,
+    poll_interval=args.poll_interval,
+    rpm=args.rpm,
+    tpm=args.tpm,
+    batch_window=args.batch_window,
+    run_latency=args.run_latency,
+    summary_threshold=args.summary_threshold,
+    trace=args.trace,
+  )
+  monitor = Monitor(client)
+  monitor.start()
+  results = []
+  started = time.monotonic()
+
+  session_ids = [f"load-{index}" for index in range(args.sessions)]
+  for session_id in session_ids:
+    command = FakeInteraction(bot.CHANNEL_ID, 1, "host")
+    await client.tracked("start_game", client.start_game(command, session_id))
+    results.append(('start_game', command))
+
+  pacer = Pacer(args.rate)
+  await asyncio.gather(*[
+    player(bot, client, pacer, session_id, 1000 + index * args.players + seat, args.turns, results)
+    for index, session_id in enumerate(session_ids)
+    for seat in range(args.players)
+  ])
+  settled = await settle(client, results)
+  elapsed = time.monotonic() - started
+  monitor.stop()
+  await shutdown(client)
+  return {'client': client, 'results': results, 'elapsed': elapsed, 'monitor': monitor, 'settled': settled}
+
+def report(server: FakeAssistantsServer, outcome: dict):
+  results = outcome['results']
+  monitor = outcome['monitor']
+  elapsed = outcome['elapsed']
+  turns = [command for kind, command in results if kind in ('join', 'play')]
+  print(f"elapsed: {elapsed:.1f}s{'' if outcome['settled'] else ' (did not settle)'}")
+  print(f"turns: {len(turns)}, {len(turns) / elapsed:.2f} turns/s, failed {sum(command.failed() for command in turns)}")
+  for kind in ('start_game', 'create_character', 'join', 'play'):
+    latencies = [command.latency() for k, command in results if k == kind and command.latency() is not None]
+    if latencies:
+      print(f"{kind}: n={len(latencies)} p50 {percentile(latencies, 0.5):.2f}s p95 {percentile(latencies, 0.95):.2f}s p99 {percentile(latencies, 0.99):.2f}s")
+  print(f"queue depth: mean {sum(monitor.queue_depths) / max(1, len(monitor.queue_depths)):.2f}, max {max(monitor.queue_depths, default=0)}")
+  print(f"event-loop lag: p50 {percentile(monitor.lags, 0.5) * 1000:.1f}ms p99 {percentile(monitor.lags, 0.99) * 1000:.1f}ms max {max(monitor.lags, default=0) * 1000:.1f}ms")
+  for (stage,), series in sorted(STAGE_SECONDS.values.items()):
+    print(f"stage {stage}: n={series['count']} mean {series['sum'] / series['count']:.3f}s total {series['sum']:.1f}s")
+  print(f"runs by assistant: {dict(server.runs_by_assistant)}")
+  print(f"fake API requests: {sum(server.requests.values())} {dict(server.requests)}")
+  if server.violations:
+    print(f"run/message overlaps: {len(server.violations)}")
+
+
+async def main():
+  # The ordering, race and recovery checks live in tests/ and run under pytest
+  parser = argparse.ArgumentParser(description="Drive GPTTRPG offline with fake Discord interactions and a fake Assistants server")
+  parser.add_argument("--sessions", type=int, default=4)
+  parser.add_argument("--players", type=int, default=3)
+  parser.add_argument("--turns", type=int, default=5, help="/play commands per player after joining")
+  parser.add_argument("--rate", type=float, default=5, help="commands per second across all players; 0 for no pacing")
+  parser.add_argument("--run-latency", type=float, default=2.0, help="mean seconds until a fake run completes")
+  parser.add_argument("--request-latency", type=float, default=0.05, help="seconds every fake API request takes")
+  parser.add_argument("--prompt-tokens", type=int, default=800, help="fixed prompt tokens per run on top of the thread content")
+  parser.add_argument("--completion-tokens", type=int, default=300)
+  parser.add_argument("--failure-rate", type=float, default=0)
+  parser.add_argument("--poll-interval", type=float, default=1.0)
+  parser.add_argument("--batch-window", type=float, default=2.0)
+  parser.add_argument("--summary-threshold", type=int, default=0, help="override the main summary threshold")
+  parser.add_argument("--rpm", type=int, default=500)
+  parser.add_argument("--tpm", type=int, default=300000)
+  parser.add_argument("--backend", choices=["assistants", "fake"], default="assistants")
+  parser.add_argument("--no-streaming", action="store_true")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--verbose", action="store_true", help="keep the bot's own logging")
+  parser.add_argument("--trace", help="write the run's spans to this file, for python tracing.py --file")
+  args = parser.parse_args()
+  if args.trace:
+    args.trace = os.path.abspath(args.trace)
+
+  bot = import_bot(tempfile.mkdtemp(prefix="gpttrpg-load-"))
+  log = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+
+  server = FakeAssistantsServer(args.run_latency, args.request_latency, args.prompt_tokens, args.completion_tokens, args.failure_rate, seed=args.seed)
+  with log:
+    outcome = await load(bot, server, args)
+  report(server, outcome)
+
+
+if __name__ == "__main__":
+  asyncio.run(main())
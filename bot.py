@@ -1,54 +1,131 @@
 import discord
 from discord import app_commands
 from enum import Enum
-from openai import OpenAI
+from openai import AsyncOpenAI
 import time
+import asyncio
 import json
 import os
 import atexit
 import configparser
-import threading
 import traceback
-from collections import deque
 import random
-import io
+import functools
+from typing import Literal
+from run_engine import RunEngine, user_message
+from backends import ChatBackend, FakeBackend
+from round_trips import RoundTripStats, counting_http_client
+import metrics
+import tracing
+from metrics import STAGE_SECONDS, TURN_SECONDS, COMMAND_SECONDS, RUNS, TOKENS, QUEUE_DEPTH, TURNS_IN_FLIGHT
+from dice import CHECK_TOOLS, handle_check_tool, is_check_tool, format_probability_table
+from specialists import SpecialistRouter, ROUTER_TOOLS
+from usage import TierStats, estimate_tokens, record_turn, record_specialist, reset_context, predict_next_context, expected_growth, ledger_of, cost, PROMPT_TOKEN_PRICE, COMPLETION_TOKEN_PRICE
+from combat import COMBAT_TOOLS, WOUND_TOOLS, current_session_id, in_combat, is_combat_tool, handle_combat_tool, record_strategy, pending_players, begin_round, ledger_summary
+from profiling import Profiler, LoopWatchdog, PROFILE_FOLDER, LOOP_BLOCK_THRESHOLD
+from journal import Journal, JOURNAL_FILE
+from streaming import NarrationReply, ChannelFollowup, STREAM_EDIT_INTERVAL_MS, STREAM_EDIT_MIN_CHARS
+from scheduler import SessionScheduler, FairLimiter, RateLimiter
+from persistence import Persistence, SESSION_FOLDER, FLUSH_INTERVAL
+from assistant_manifest import reconcile_assistants
+from uploads import UploadCache, collect_file_ids, UPLOAD_GC_INTERVAL
+from scenarios import ScenarioRegistry
+from storage import create_storage, LazyRows, CharacterCache, SQLITE_PATH, CHARACTER_CACHE_SIZE, CHARACTER_CACHE_BYTES
 
 
 config = configparser.ConfigParser()
 config.read(os.path.join(os.path.dirname(__file__), '.config'))
 
-DISCORD_TOKEN = config['DEFAULT']['DISCORD_TOKEN']
-OPENAI_API_KEY = config['DEFAULT']['OPENAI_API_KEY']
-SERVER_ID = int(config['DEFAULT']['SERVER_ID'])
-CHANNEL_ID = int(config['DEFAULT']['CHANNEL_ID'])
+# Without a .config the module still imports, so the bot can be driven offline by the load test
+DISCORD_TOKEN = config['DEFAULT'].get('DISCORD_TOKEN', fallback='')
+OPENAI_API_KEY = config['DEFAULT'].get('OPENAI_API_KEY', fallback=None)
+SERVER_ID = config['DEFAULT'].getint('SERVER_ID', fallback=0)
+CHANNEL_ID = config['DEFAULT'].getint('CHANNEL_ID', fallback=0)
+MAX_CONCURRENT_RUNS = config['DEFAULT'].getint('MAX_CONCURRENT_RUNS', fallback=8)
+OPENAI_RPM = config['DEFAULT'].getint('OPENAI_RPM', fallback=500)
+OPENAI_TPM = config['DEFAULT'].getint('OPENAI_TPM', fallback=300000)
+PROMPT_TOKEN_PRICE = config['DEFAULT'].getfloat('PROMPT_TOKEN_PRICE', fallback=PROMPT_TOKEN_PRICE)
+COMPLETION_TOKEN_PRICE = config['DEFAULT'].getfloat('COMPLETION_TOKEN_PRICE', fallback=COMPLETION_TOKEN_PRICE)
+SUMMARY_THRESHOLD_TOKEN = 20000
+DEFAULT_MODEL = config['DEFAULT'].get('MODEL', fallback="gpt-4-turbo")
 
 rule_set = configparser.ConfigParser()
 rule_set.read(os.path.join(os.path.dirname(__file__), 'rule_set.config'))
+
+def model_options(section: str) -> dict:
+  # Each task picks its own model tier; sampling parameters left out keep the model defaults
+  return {
+    "model": rule_set[section].get('MODEL', fallback=DEFAULT_MODEL),
+    "temperature": rule_set[section].getfloat('TEMPERATURE', fallback=None),
+    "top_p": rule_set[section].getfloat('TOP_P', fallback=None),
+    "prompt_token_price": rule_set[section].getfloat('PROMPT_TOKEN_PRICE', fallback=PROMPT_TOKEN_PRICE),
+    "completion_token_price": rule_set[section].getfloat('COMPLETION_TOKEN_PRICE', fallback=COMPLETION_TOKEN_PRICE),
+  }
+
 RULE_SET = {
   "main": {
     "file_name": rule_set['MAIN']['FILE_NAME'],
     "version": rule_set['MAIN']['VERSION'],
+    "backend": rule_set['MAIN'].get('BACKEND', fallback='assistants'),
+    **model_options('MAIN'),
     "rule_set": rule_set['MAIN']['RULE_SET'],
+    "streaming": rule_set['MAIN'].getboolean('STREAMING', fallback=False),
+    "stream_edit_interval_ms": rule_set['MAIN'].getint('STREAM_EDIT_INTERVAL_MS', fallback=STREAM_EDIT_INTERVAL_MS),
+    "stream_edit_min_chars": rule_set['MAIN'].getint('STREAM_EDIT_MIN_CHARS', fallback=STREAM_EDIT_MIN_CHARS),
+    "summary_threshold_token": rule_set['MAIN'].getint('SUMMARY_THRESHOLD_TOKEN', fallback=SUMMARY_THRESHOLD_TOKEN),
+    "batch_window_seconds": rule_set['MAIN'].getfloat('BATCH_WINDOW_SECONDS', fallback=0),
   }, 
   "character_creation": {
     "file_name": rule_set['CHARACTER_CREATION']['FILE_NAME'],
     "version": rule_set['CHARACTER_CREATION']['VERSION'],
+    "backend": rule_set['CHARACTER_CREATION'].get('BACKEND', fallback='assistants'),
+    **model_options('CHARACTER_CREATION'),
     "rule_set": rule_set['CHARACTER_CREATION']['RULE_SET'],
+    "streaming": rule_set['CHARACTER_CREATION'].getboolean('STREAMING', fallback=False),
+    "stream_edit_interval_ms": rule_set['CHARACTER_CREATION'].getint('STREAM_EDIT_INTERVAL_MS', fallback=STREAM_EDIT_INTERVAL_MS),
+    "stream_edit_min_chars": rule_set['CHARACTER_CREATION'].getint('STREAM_EDIT_MIN_CHARS', fallback=STREAM_EDIT_MIN_CHARS),
+    "summary_threshold_token": rule_set['CHARACTER_CREATION'].getint('SUMMARY_THRESHOLD_TOKEN', fallback=SUMMARY_THRESHOLD_TOKEN),
   },
   "ability_check": {
     "file_name": rule_set['ABILITY_CHECK']['FILE_NAME'],
     "version": rule_set['ABILITY_CHECK']['VERSION'],
+    "backend": rule_set['ABILITY_CHECK'].get('BACKEND', fallback='assistants'),
+    **model_options('ABILITY_CHECK'),
   },
   "combat": {
     "file_name": rule_set['COMBAT']['FILE_NAME'],
     "version": rule_set['COMBAT']['VERSION'],
-  }
+    "backend": rule_set['COMBAT'].get('BACKEND', fallback='assistants'),
+    **model_options('COMBAT'),
+  },
+  "summary": {
+    "file_name": rule_set['SUMMARY']['FILE_NAME'],
+    "version": rule_set['SUMMARY']['VERSION'],
+    "backend": rule_set['SUMMARY'].get('BACKEND', fallback='assistants'),
+    **model_options('SUMMARY'),
+  },
 }
 
-SAVES_FILE = 'saves.json'
-CHARACTER_FOLDER = 'characters'
-SESSION_FOLDER = 'sessions'
-SUMMARY_THRESHOLD_TOKEN = 20000
+FLUSH_INTERVAL = config['DEFAULT'].getint('FLUSH_INTERVAL', fallback=FLUSH_INTERVAL)
+STORAGE = config['DEFAULT'].get('STORAGE', fallback='json')
+SQLITE_PATH = config['DEFAULT'].get('SQLITE_PATH', fallback=SQLITE_PATH)
+CHARACTER_CACHE_SIZE = config['DEFAULT'].getint('CHARACTER_CACHE_SIZE', fallback=CHARACTER_CACHE_SIZE)
+CHARACTER_CACHE_BYTES = config['DEFAULT'].getint('CHARACTER_CACHE_BYTES', fallback=CHARACTER_CACHE_BYTES)
+SESSION_IDLE_TTL = config['DEFAULT'].getint('SESSION_IDLE_TTL', fallback=1800)
+UPLOAD_GC_INTERVAL = config['DEFAULT'].getint('UPLOAD_GC_INTERVAL', fallback=UPLOAD_GC_INTERVAL)
+SUMMARY_ARC_SIZE = config['DEFAULT'].getint('SUMMARY_ARC_SIZE', fallback=5)
+METRICS_HOST = config['DEFAULT'].get('METRICS_HOST', fallback=metrics.METRICS_HOST)
+METRICS_PORT = config['DEFAULT'].getint('METRICS_PORT', fallback=metrics.METRICS_PORT)
+TRACE_FILE = config['DEFAULT'].get('TRACE_FILE', fallback=tracing.TRACE_FILE)
+TRACE_MAX_BYTES = config['DEFAULT'].getint('TRACE_MAX_BYTES', fallback=tracing.TRACE_MAX_BYTES)
+TRACE_BACKUPS = config['DEFAULT'].getint('TRACE_BACKUPS', fallback=tracing.TRACE_BACKUPS)
+PROFILE_FOLDER = config['DEFAULT'].get('PROFILE_FOLDER', fallback=PROFILE_FOLDER)
+LOOP_BLOCK_THRESHOLD_MS = config['DEFAULT'].getint('LOOP_BLOCK_THRESHOLD_MS', fallback=int(LOOP_BLOCK_THRESHOLD * 1000))
+JOURNAL_FILE = config['DEFAULT'].get('JOURNAL_FILE', fallback=JOURNAL_FILE)
+
+# What a queued turn needs to be queued again after a restart; the followup webhook does not survive one
+JOURNALED_PAYLOAD_FIELDS = ('user_id', 'messages', 'response_prefix', 'attachments', 'strategy')
+RECOVERED_NOTE = "（機器人重新啟動，補上中斷前的回覆）\n"
 
 CHARACTER_CREATION_INTRO = [
   "從霧氣瀰漫的狹海彼岸，命運的長路悄然展開。",
@@ -89,80 +166,116 @@ def enum_decoder(dct):
           dct[key] = enum_class[enum_member_name]
   return dct
 
-def load_saves():
-  save = {}
-  characters = {}
-
-  if os.path.exists(SAVES_FILE):
-    try:
-      with open(SAVES_FILE, "r", encoding="utf-8") as f:
-        save = json.load(f, object_hook=enum_decoder)
-    except Exception as e:
-      print(f"[Error] Failed to load saves: {e}")
-
-  if os.path.exists(CHARACTER_FOLDER):
-    try:
-      for user_id in os.listdir(CHARACTER_FOLDER):
-        user_folder = os.path.join(CHARACTER_FOLDER, user_id)
-        if os.path.isdir(user_folder):
-          characters[user_id] = {}
-          for character_file in os.listdir(user_folder):
-            if character_file.endswith(".json"):
-              character_path = os.path.join(user_folder, character_file)
-              try:
-                with open(character_path, "r", encoding="utf-8") as f:
-                  character_id = os.path.splitext(character_file)[0]
-                  characters[user_id][character_id] = json.load(f, object_hook=enum_decoder)
-              except Exception as e:
-                print(f"[Error] Failed to load character {character_file} for user {user_id}: {e}")
-    except Exception as e:
-      print(f"[Error] Failed to load characters: {e}")
-
-  return save, characters
-
 def save_saves():
   try:
-    json_data = json.dumps(client.saves, ensure_ascii=False, indent=2, cls=EnumEncoder)
-    with open(SAVES_FILE, "w", encoding="utf-8") as f:
-      f.write(json_data)
-
-    if not os.path.exists(CHARACTER_FOLDER):
-      os.makedirs(CHARACTER_FOLDER)
-
-    for user_id, characters in client.characters.items():
-      user_folder = os.path.join(CHARACTER_FOLDER, user_id)
-      if not os.path.exists(user_folder):
-        os.makedirs(user_folder)
-
-      for character_id, character_data in characters.items():
-        character_file = os.path.join(user_folder, f"{character_id}.json")
-        try:
-          json_data = json.dumps(character_data, ensure_ascii=False, indent=2, cls=EnumEncoder)
-          with open(character_file, "w", encoding="utf-8") as f:
-            f.write(json_data)
-        except Exception as e:
-          print(f"[Error] Failed to save character {character_id} for user {user_id}: {e}")
+    client.persistence.flush_sync()
   except Exception as e:
     print(f"[Error] Failed to save saves: {e}")
+  try:
+    if tracing.exporter:
+      tracing.exporter.flush_sync()
+  except Exception as e:
+    print(f"[Error] Failed to write spans: {e}")
 
-# Register save_saves to run at exit
+# Flush whatever is still dirty at exit
 atexit.register(save_saves)
 
 
 class GPTTRPG(discord.Client):
   def __init__(self):
     super().__init__(intents=discord.Intents.default())
-    self.openAIClient = OpenAI(api_key=OPENAI_API_KEY)
+    self.openAIClient = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=counting_http_client())
+    self.round_trips = RoundTripStats()
+    self.tiers = TierStats()
+    self.rate_limiter = RateLimiter(OPENAI_RPM, OPENAI_TPM)
+    self.run_engine = RunEngine(self.openAIClient, rate_limiter=self.rate_limiter, tool_handler=self.handle_tool_call)
+    self.upload_cache = UploadCache(self.openAIClient)
+    # Rows keep the assistant id they were started with, and the id tells which backend owns them
+    self.backends = {
+      'assistants': self.run_engine,
+      'chat': ChatBackend(self.openAIClient, rate_limiter=self.rate_limiter, tool_handler=self.handle_tool_call, resolve_attachment=self.upload_cache.read_text),
+      'fake': FakeBackend(tool_handler=self.handle_tool_call, resolve_attachment=self.upload_cache.read_text),
+    }
     self.tree = app_commands.CommandTree(self)
-    self.saves, self.characters = load_saves()
-    self.player_state = {}
-    self.message_queue = {session_id: deque() for session_id in self.saves.keys()}
-    self.processing = {session_id: False for session_id in self.saves.keys()}
-    self.processing_lock = {session_id: threading.Lock() for session_id in self.saves.keys()}
+    self.storage = create_storage(STORAGE, enum_decoder, SQLITE_PATH)
+    self.saves = LazyRows(self.storage.load_session)
+    self.characters = CharacterCache(self.storage, CHARACTER_CACHE_SIZE, CHARACTER_CACHE_BYTES, self.can_evict_character)
+    self.player_state = LazyRows(self.storage.load_player_state)
+    self.persistence = Persistence(self.storage, self.saves, self.characters, self.player_state, EnumEncoder, FLUSH_INTERVAL)
     self.rule_set = RULE_SET
+    self.scenarios = ScenarioRegistry()
+    self.specialist_router = SpecialistRouter(self.backend_of, self.rule_set, on_usage=self.record_specialist_usage)
+    self.persistence_task = None
+    self.hibernation_task = None
+    self.upload_gc_task = None
+    self.metrics_runner = None
+    self.trace_task = None
+    self.profiler = Profiler(PROFILE_FOLDER)
+    self.watchdog = LoopWatchdog(LOOP_BLOCK_THRESHOLD_MS / 1000) if LOOP_BLOCK_THRESHOLD_MS else None
+    self.journal = Journal(JOURNAL_FILE)
+    self.recovery_task = None
+    self.summary_tasks = {}
+    self.scheduler = SessionScheduler(
+      self.process_turn_batch,
+      self.is_turn_batch_ready,
+      batch_window=self.rule_set['main']['batch_window_seconds'],
+      limiter=FairLimiter(MAX_CONCURRENT_RUNS),
+      rate_limiter=self.rate_limiter,
+      default_turn_tokens=self.rule_set['main']['summary_threshold_token'] // 2,
+      idle_ttl=SESSION_IDLE_TTL,
+    )
+    QUEUE_DEPTH.collect = lambda: {(session_id,): self.scheduler.queue_depth(session_id) for session_id in self.scheduler.queues}
+    TURNS_IN_FLIGHT.collect = lambda: {(): len(self.scheduler.in_flight)}
+
+  async def close(self):
+    await self.scheduler.shutdown()
+    if self.persistence_task:
+      self.persistence_task.cancel()
+    if self.hibernation_task:
+      self.hibernation_task.cancel()
+    if self.upload_gc_task:
+      self.upload_gc_task.cancel()
+    if self.trace_task:
+      self.trace_task.cancel()
+    if self.watchdog:
+      self.watchdog.stop()
+    self.profiler.stop()
+    if self.recovery_task:
+      self.recovery_task.cancel()
+    for task in list(self.summary_tasks.values()):
+      task.cancel()
+    if self.metrics_runner:
+      await self.metrics_runner.cleanup()
+    await self.persistence.flush()
+    self.storage.close()
+    if tracing.exporter:
+      await tracing.exporter.flush()
+    await super().close()
 
   async def setup_hook(self):
     print("[Debug] Running setup_hook...")
+    self.persistence_task = asyncio.create_task(self.persistence.run())
+    self.hibernation_task = asyncio.create_task(self.hibernate_idle_sessions())
+    self.upload_gc_task = asyncio.create_task(self.upload_cache.run_gc(self.referenced_file_ids, UPLOAD_GC_INTERVAL))
+    # An empty TRACE_FILE turns tracing off
+    if tracing.configure(TRACE_FILE, TRACE_MAX_BYTES, TRACE_BACKUPS):
+      self.trace_task = asyncio.create_task(tracing.exporter.run())
+    # LOOP_BLOCK_THRESHOLD_MS = 0 turns the watchdog off
+    if self.watchdog:
+      self.watchdog.start()
+    await asyncio.gather(self.sync_commands(), self.setup_assistants(), self.serve_metrics())
+    self.recovery_task = asyncio.create_task(self.recover_in_flight())
+
+  async def serve_metrics(self):
+    # METRICS_PORT = 0 turns the endpoint off
+    if not METRICS_PORT:
+      return
+    try:
+      self.metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT)
+    except Exception as e:
+      print(f"[Error] Failed to serve metrics on {METRICS_HOST}:{METRICS_PORT}: {e}")
+
+  async def sync_commands(self):
     try:
       self.tree.copy_global_to(guild=discord.Object(id=SERVER_ID))
       await self.tree.sync(guild=discord.Object(id=SERVER_ID))
@@ -171,43 +284,96 @@ class GPTTRPG(discord.Client):
       print(f"[Error] During setup_hook: {e}")
       traceback.print_exc()
 
+  def assistant_spec(self, key: str, rule: dict) -> dict:
+    with open(rule["file_name"], "r", encoding="utf-8") as f:
+      instructions = f.read()
+    tools = [{"type": "file_search"}]
+    if key == 'main':
+      # The main assistant only routes checks and combat; the specialists hold the detailed rules
+      tools += ROUTER_TOOLS + COMBAT_TOOLS
+    elif key in ('ability_check', 'combat'):
+      # Checks are resolved locally through function tools; the odds table lets the DM pick fair difficulties
+      tools += CHECK_TOOLS
+      if key == 'combat':
+        tools += WOUND_TOOLS
+      instructions += f"\n\n# 檢定成功率表（取較高骰子，無加值）\n{format_probability_table()}\n"
+    spec = {
+      'name': f"GPTTRPG_{key}",
+      'model': rule["model"],
+      'metadata': {"version": rule["version"]},
+      'instructions': instructions,
+      'tools': tools,
+    }
+    for option in ('temperature', 'top_p'):
+      if rule[option] is not None:
+        spec[option] = rule[option]
+    return spec
+
+  async def handle_tool_call(self, thread_id: str, name: str, arguments: dict) -> dict:
+    if is_check_tool(name):
+      output = handle_check_tool(name, arguments)
+      print(f"[Debug] Check on thread {thread_id}: {name} {json.dumps(output, ensure_ascii=False)}")
+      return output
+    # Tools can run outside any session, e.g. the first narration of /start_game
+    session_id = current_session_id.get()
+    session = self.saves[session_id] if session_id is not None and session_id in self.saves else None
+    if is_combat_tool(name):
+      output = handle_combat_tool(session, name, arguments)
+      if session is not None:
+        self.persistence.mark_session(session_id)
+      print(f"[Debug] Combat on thread {thread_id}: {name} {json.dumps(output, ensure_ascii=False)}")
+      return output
+    if self.specialist_router.handles(name):
+      return await self.specialist_router.dispatch(name, arguments, session)
+    return None
+
+  def record_tier(self, task: str, seconds: float, usage=None):
+    rule = self.rule_set[task]
+    self.tiers.record(task, rule['model'], seconds, usage, rule['prompt_token_price'], rule['completion_token_price'])
+    RUNS.inc(task, "completed" if usage else "failed")
+    if usage:
+      TOKENS.inc(task, "prompt", amount=usage.prompt_tokens)
+      TOKENS.inc(task, "completion", amount=usage.completion_tokens)
+
+  def record_specialist_usage(self, rule_key: str, usage, seconds: float):
+    self.record_tier(rule_key, seconds, usage)
+    if usage is None:
+      return
+    session_id = current_session_id.get()
+    if session_id is not None and session_id in self.saves:
+      record_specialist(self.saves[session_id], rule_key, usage.prompt_tokens, usage.completion_tokens)
+      self.persistence.mark_session(session_id)
+
+  def backend_of(self, assistant_id: str):
+    for backend in self.backends.values():
+      if backend.owns(assistant_id):
+        return backend
+    return self.run_engine
+
+  async def setup_assistants(self):
     try:
-      existing_assistants = self.openAIClient.beta.assistants.list().data
-      existing_assistant_names = {assistant.name: assistant for assistant in existing_assistants}
-
-      for key, rule in self.rule_set.items():
-        assistant_name = f"GPTTRPG_{key}"
-        metadata = {"version": rule["version"]}
-
-        if assistant_name in existing_assistant_names:
-          existing_metadata = existing_assistant_names[assistant_name].metadata
-          if existing_metadata.get("version") == rule["version"]:
-            print(f"[Debug] Assistant '{assistant_name}' already exists with the correct version.")
-            self.rule_set[key]['assistant_id'] = existing_assistant_names[assistant_name].id
-        
-        if 'assistant_id' not in self.rule_set[key]:
-          with open(rule["file_name"], "r", encoding="utf-8") as f:
-            instructions = f.read()
-
-          response = self.openAIClient.beta.assistants.create(
-            name=assistant_name,
-            model="gpt-4-turbo",
-            metadata=metadata,
-            instructions=instructions,
-            tools=[{"type": "file_search"}],
-          )
-          self.rule_set[key]['assistant_id'] = response.id
-          print(f"[Debug] Created assistant '{assistant_name}' with metadata {metadata}.")
+      specs = {key: self.assistant_spec(key, rule) for key, rule in self.rule_set.items()}
+      # Local backends register every spec so rows started under them keep working after a config change
+      for kind, backend in self.backends.items():
+        if kind != 'assistants':
+          for key, spec in specs.items():
+            assistant_id = backend.register_assistant(key, spec)
+            if self.rule_set[key]['backend'] == kind:
+              self.rule_set[key]['assistant_id'] = assistant_id
+      remote_specs = {key: spec for key, spec in specs.items() if self.rule_set[key]['backend'] == 'assistants'}
+      assistant_ids = await reconcile_assistants(self.openAIClient, remote_specs) if remote_specs else {}
+      for key, assistant_id in assistant_ids.items():
+        self.rule_set[key]['assistant_id'] = assistant_id
     except Exception as e:
       print(f"[Error] During assistant setup: {e}")
       traceback.print_exc()
 
-  def sync_characters(self):
+  async def sync_characters(self):
     for user_id, characters in self.characters.items():
       for character_id, character in characters.items():
-        self.sync_character(user_id, character_id)
+        await self.sync_character(user_id, character_id)
 
-  def sync_character(self, user_id: str, character_id: str, refresh: bool = False) -> str:
+  async def sync_character(self, user_id: str, character_id: str, refresh: bool = False) -> str:
     if user_id not in self.characters or character_id not in self.characters[user_id]:
       print(f"[Debug] No character data found for {user_id}: {character_id}")
       return
@@ -220,19 +386,210 @@ class GPTTRPG(discord.Client):
     
     if 'file_id' not in character or refresh:
       print(f"[Debug] Syncing character file for {user_id}: {character_id}")
-      file_io = io.BytesIO(json.dumps(character['data'], ensure_ascii=False, indent=2).encode('utf-8'))
-      file_io.name = f"CHARACTER_{user_id}_{character_id}.json"
       try:
-        response = self.openAIClient.files.create(
-          file=file_io,
-          purpose="assistants",
+        character['file_id'] = await self.upload_cache.upload(
+          f"CHARACTER_{user_id}_{character_id}.json",
+          json.dumps(character['data'], ensure_ascii=False, indent=2).encode('utf-8'),
         )
-        character['file_id'] = response.id
+        self.persistence.mark_character(user_id, character_id)
       except Exception as e:
         print(f"[Error] Failed to upload character file for {user_id}: {character_id}: {e}")
         traceback.print_exc()
     
-    return character['file_id']
+    return character.get('file_id')
+
+  async def referenced_file_ids(self) -> set:
+    await self.persistence.flush()
+    def scan():
+      file_ids = set()
+      for _, _, content in self.storage.iter_rows():
+        collect_file_ids(json.loads(content), file_ids)
+      return file_ids
+    return await asyncio.to_thread(scan)
+
+  def can_evict_character(self, user_id: str, character_id: str) -> bool:
+    character = dict.get(self.characters.get(user_id, {}), character_id)
+    if character is None:
+      return True
+    # Characters mid-creation are held across long-running flows; keep them resident
+    return character.get('state') == CharacterCreationState.CREATED and not self.persistence.is_dirty('character', (user_id, character_id))
+
+  async def hibernate_session(self, session_id: str):
+    if self.persistence.is_dirty('session', session_id):
+      await self.persistence.flush()
+    # A turn, tool call or usage record may have changed the session while it was flushed
+    if self.persistence.is_dirty('session', session_id):
+      print(f"[Debug] Session {session_id} changed while hibernating; keeping it resident.")
+      return
+    players = dict.get(self.saves, session_id, {}).get('players', {})
+    self.saves.evict(session_id)
+    for user_id in players:
+      player_state = dict.get(self.player_state, user_id)
+      if player_state and player_state.get('session_id') == session_id and not self.persistence.is_dirty('player_state', user_id):
+        self.player_state.evict(user_id)
+    print(f"[Debug] Session {session_id} hibernated.")
+
+  async def hibernate_idle_sessions(self):
+    while True:
+      await asyncio.sleep(SESSION_IDLE_TTL / 2)
+      for session_id in self.saves.idle_keys(SESSION_IDLE_TTL):
+        if not self.scheduler.is_active(session_id) and session_id not in self.summary_tasks:
+          try:
+            await self.hibernate_session(session_id)
+          except Exception as e:
+            print(f"[Error] Failed to hibernate session {session_id}: {e}")
+            traceback.print_exc()
+
+  async def memory_report(self, interaction: discord.Interaction):
+    if interaction.channel.id != CHANNEL_ID:
+      await interaction.response.send_message("請在gpt-trpg頻道使用此指令.", ephemeral=True)
+      return
+
+    resident_sessions = list(dict.keys(self.saves))
+    msg = f"常駐進度：{len(resident_sessions)}\n"
+    for session_id in resident_sessions:
+      worker = "執行中" if self.scheduler.is_active(session_id) else "休眠待命"
+      msg += f"• {session_id}: {worker}，佇列 {self.scheduler.queue_depth(session_id)}\n"
+    msg += f"常駐角色：{len(self.characters.lru)} / {self.characters.max_entries}，約 {self.characters.resident_bytes // 1024} / {self.characters.max_bytes // 1024} KiB\n"
+    msg += f"常駐玩家狀態：{len(dict.keys(self.player_state))}\n"
+    msg += f"工作佇列：{len(self.scheduler.workers)}"
+    await interaction.response.send_message(msg, ephemeral=True)
+
+  async def profile_start(self, interaction: discord.Interaction, mode: str, seconds: int):
+    try:
+      self.profiler.start(mode, seconds)
+    except Exception as e:
+      await interaction.response.send_message(f"❌ 無法開始效能分析：{e}", ephemeral=True)
+      return
+    window = f"{seconds} 秒後自動停止" if seconds else "以 /debug_profile stop 停止"
+    await interaction.response.send_message(f"✅ 已開始 {mode} 效能分析，{window}。", ephemeral=True)
+
+  async def profile_stop(self, interaction: discord.Interaction):
+    result = self.profiler.stop()
+    if not result:
+      await interaction.response.send_message("❌ 沒有進行中或已完成的效能分析。", ephemeral=True)
+      return
+    msg = f"**{result['kind']} 效能分析（{result['seconds']:.0f} 秒）：** `{result['path']}`\n"
+    msg += "\n".join(f"• {line}" for line in result['top'])
+    await interaction.response.send_message(msg[:2000], file=discord.File(result['path']), ephemeral=True)
+
+  async def profile_blocking(self, interaction: discord.Interaction, limit: int):
+    if not self.watchdog:
+      await interaction.response.send_message("❌ 事件迴圈監看未啟用（LOOP_BLOCK_THRESHOLD_MS = 0）。", ephemeral=True)
+      return
+    episodes = self.watchdog.recent(limit)
+    if not episodes:
+      await interaction.response.send_message(f"目前沒有超過 {self.watchdog.threshold * 1000:.0f}ms 的事件迴圈阻塞。", ephemeral=True)
+      return
+    msg = f"**最近的事件迴圈阻塞（門檻 {self.watchdog.threshold * 1000:.0f}ms）：**\n"
+    for episode in reversed(episodes):
+      # The innermost frames say what was blocking; the rest is the loop's own machinery
+      stack = " ← ".join(reversed(episode['stack'].split(";")[-6:])) if episode['stack'] else "（未擷取到堆疊）"
+      msg += f"• {time.strftime('%H:%M:%S', time.localtime(episode['at']))} {episode['seconds'] * 1000:.0f}ms\n  {stack}\n"
+    await interaction.response.send_message(msg[:2000], ephemeral=True)
+
+  async def seed_report(self, interaction: discord.Interaction, session_id: str):
+    if interaction.channel.id != CHANNEL_ID:
+      await interaction.response.send_message("請在gpt-trpg頻道使用此指令.", ephemeral=True)
+      return
+
+    if session_id not in self.saves:
+      await interaction.response.send_message(f"❌ 進度 `{session_id}` 不存在.", ephemeral=True)
+      return
+
+    session = self.saves[session_id]
+    seed_stats = session.get('seed_stats', [])
+    if not seed_stats:
+      await interaction.response.send_message(f"❌ 進度 `{session_id}` 尚無起始內容紀錄。", ephemeral=True)
+      return
+
+    open_summaries = [summary['name'] for summary in session['summaries'] if not summary.get('merged')]
+    msg = f"**進度 `{session_id}` 各章起始內容大小：**\n"
+    for stats in seed_stats:
+      msg += f"• 第 {stats['chapter']} 章：起始訊息 {stats['seed_chars']} 字（約 {stats.get('seed_tokens', '?')} tokens"
+      if stats.get('saved_tokens'):
+        msg += f"，劇本改為附件省下約 {stats['saved_tokens']} tokens"
+      msg += f"），附件 {stats['attachments']} 個（摘要共 {stats['attached_summary_chars']} 字）\n"
+    msg += f"目前附加的摘要：{'、'.join(open_summaries)}"
+    await interaction.response.send_message(msg, ephemeral=True)
+
+  async def usage_report(self, interaction: discord.Interaction, session_id: str):
+    if interaction.channel.id != CHANNEL_ID:
+      await interaction.response.send_message("請在gpt-trpg頻道使用此指令.", ephemeral=True)
+      return
+
+    if session_id not in self.saves:
+      await interaction.response.send_message(f"❌ 進度 `{session_id}` 不存在.", ephemeral=True)
+      return
+
+    session = self.saves[session_id]
+    ledger = ledger_of(session)
+    total = ledger['total']
+    if not total['runs']:
+      await interaction.response.send_message(f"❌ 進度 `{session_id}` 尚無用量紀錄。", ephemeral=True)
+      return
+
+    # Session turns run on the main rule set; each specialist is priced at its own model's rates
+    main = self.rule_set['main']
+    threshold = main['summary_threshold_token']
+    turns_cost = cost(total['prompt'], total['completion'], main['prompt_token_price'], main['completion_token_price'])
+    total_cost = turns_cost
+    msg = f"**進度 `{session_id}` 的用量：**\n"
+    msg += f"回合數：{total['runs']}，輸入 {total['prompt']} tokens，輸出 {total['completion']} tokens，約 ${turns_cost:.2f}\n"
+    msg += f"平均每回合：輸入 {total['prompt'] // total['runs']}，輸出 {total['completion'] // total['runs']} tokens\n"
+    msg += f"目前上下文：{ledger['context_tokens']} tokens，每回合約增加 {expected_growth(session)}，預估下回合 {predict_next_context(session, self.queued_text(session_id))} / {threshold}\n"
+    for rule_key, specialist in ledger['specialist'].items():
+      rule = self.rule_set.get(rule_key, main)
+      specialist_cost = cost(specialist['prompt'], specialist['completion'], rule['prompt_token_price'], rule['completion_token_price'])
+      total_cost += specialist_cost
+      msg += f"專職地城主 {rule_key}：{specialist['runs']} 次，輸入 {specialist['prompt']}，輸出 {specialist['completion']} tokens，約 ${specialist_cost:.2f}\n"
+    msg += f"合計約 ${total_cost:.2f}\n"
+    msg += "各玩家：\n"
+    for user_id, player in ledger['players'].items():
+      msg += f"• <@{user_id}>：{player['turns']} 回合，輸入 {player['prompt']}，輸出 {player['completion']} tokens，約 ${cost(player['prompt'], player['completion'], main['prompt_token_price'], main['completion_token_price']):.2f}\n"
+    await interaction.response.send_message(msg, ephemeral=True)
+
+  def queued_text(self, session_id: str) -> str:
+    # What the session's next run will be sent beyond its thread: the turns already queued for it
+    return "\n".join(message for payload in self.scheduler.queued(session_id) for message in payload['messages'])
+
+  def narration_reply(self, followup: discord.Webhook, rule_key: str, header: str = "") -> NarrationReply:
+    rule = self.rule_set[rule_key]
+    return NarrationReply(
+      followup,
+      header=header,
+      streaming=rule.get('streaming', False),
+      interval_ms=rule.get('stream_edit_interval_ms', STREAM_EDIT_INTERVAL_MS),
+      min_chars=rule.get('stream_edit_min_chars', STREAM_EDIT_MIN_CHARS),
+    )
+
+  async def scenario_seed(self, session_id: str, scenario: dict) -> (str, list):
+    # The scenario body is uploaded once per version and searched through file_search; only the
+    # synopsis travels inline. If the upload fails the whole body is inlined as before.
+    session = self.saves[session_id]
+    try:
+      file_id = await self.upload_cache.upload(f"SCENARIO_{scenario['id']}.md", scenario['body'].encode('utf-8'))
+    except Exception as e:
+      print(f"[Error] Failed to upload scenario {scenario['id']}: {e}")
+      traceback.print_exc()
+      session.pop('scenario_file', None)
+      return scenario['body'], []
+    session['scenario_file'] = {'file_id': file_id}
+    self.persistence.mark_session(session_id)
+    inline = f"{scenario['synopsis']}\n\n（完整劇本為附件 {scenario['id']}.md，請以檔案搜尋查閱細節）"
+    return inline, [{'file_id': file_id, 'tools': [{'type': 'file_search'}]}]
+
+  def record_seed_stats(self, session: dict, seed_content: str, attachments: list, scenario: dict):
+    inline_tokens = estimate_tokens(seed_content)
+    session.setdefault('seed_stats', []).append({
+      'chapter': self.count_summaries(session, 0),
+      'seed_chars': len(seed_content),
+      'seed_tokens': inline_tokens,
+      # What the same seed would have cost with the scenario body inlined
+      'saved_tokens': estimate_tokens(scenario['body']) - estimate_tokens(scenario['synopsis']) if scenario and 'scenario_file' in session else 0,
+      'attachments': len(attachments),
+      'attached_summary_chars': sum(file.get('chars', 0) for file in session['summaries'] if 'file_id' in file and not file.get('merged')),
+    })
 
   async def start_game(self, interaction: discord.Interaction, session_id: str, scenario_id: str = None):
     if interaction.channel.id != CHANNEL_ID:
@@ -252,70 +609,38 @@ class GPTTRPG(discord.Client):
     }
     save = self.saves[session_id]
 
-    scenario_content = None
+    scenario = None
     if scenario_id:
-      scenarios_dir = os.path.join(os.path.dirname(__file__), "scenarios")
-      file_path = os.path.join(scenarios_dir, f"{scenario_id}.md")
-      if not os.path.exists(file_path):
+      scenario = self.scenarios.get(scenario_id)
+      if not scenario:
         del self.saves[session_id]
         await interaction.response.send_message(f"❌ 找不到劇本 `{scenario_id}`。")
         return
-      with open(file_path, "r", encoding="utf-8") as f:
-        scenario_content = f.read()
 
     await interaction.response.defer()
 
     try:
       main_assistant_id = self.rule_set['main']['assistant_id']
-      thread = self.openAIClient.beta.threads.create()
       save['assistant_id'] = main_assistant_id
-      save['thread_id'] = thread.id
 
-      if scenario_content:
+      attachments = []
+      if scenario:
+        scenario_content, attachments = await self.scenario_seed(session_id, scenario)
         system_message = f"System\n使用以下劇本開始遊戲：\n{scenario_content}"
       else:
         system_message = "System\n不使用劇本並開始遊戲"
 
-      self.openAIClient.beta.threads.messages.create(
-        thread_id=thread.id,
-        role="user",
-        content=system_message,
-      )
-      run = self.openAIClient.beta.threads.runs.create(
-          thread_id=thread.id,
-          assistant_id=main_assistant_id,
-      )
-      while True:
-        run_status = self.openAIClient.beta.threads.runs.retrieve(
-            thread_id=thread.id,
-            run_id=run.id
-        )
-        if run_status.status in ["completed", "failed", "cancelled", "expired"]:
-          break
-        time.sleep(1)
+      thread_id, assistant_reply, error = await self.run_new_thread('main', main_assistant_id, [user_message(system_message, attachments)])
+      save['thread_id'] = thread_id
+      self.record_seed_stats(save, system_message, attachments, scenario)
 
-      if run_status.status != "completed":
-          del self.saves[session_id]
-          await interaction.followup.send(f"❌ 創建進度失敗：Bot錯誤。狀態： {run_status.status}")
-          return
-
-      messages = self.openAIClient.beta.threads.messages.list(thread_id=thread.id, limit=5)
-      # Find the latest assistant message
-      assistant_reply = None
-      for msg in messages.data:
-          if msg.role == "assistant":
-              assistant_reply = msg.content[0].text.value if msg.content else ""
-              break
-
-      if not assistant_reply:
+      if error:
           del self.saves[session_id]
-          await interaction.followup.send("❌ 創建進度失敗：沒有收到 AI 回覆。")
+          await interaction.followup.send(f"❌ 創建進度失敗：{error.removeprefix('❌ ')}")
           return
 
-      self.message_queue[session_id] = deque()
-      self.processing[session_id] = False
-      self.processing_lock[session_id] = threading.Lock()
       save['state'] = SessionState.STARTED
+      self.persistence.mark_session(session_id, flush=True)
       await interaction.followup.send(f"✅ 已創建進度 `{session_id}`\n\n**遊戲敘事:**\n{assistant_reply}")
     except Exception as e:
       del self.saves[session_id]
@@ -327,11 +652,13 @@ class GPTTRPG(discord.Client):
       await interaction.response.send_message("請在gpt-trpg頻道使用此指令.", ephemeral=True)
       return
 
-    if not self.saves:
+    await self.persistence.flush()
+    session_ids = self.storage.list_session_ids()
+    if not session_ids:
       await interaction.response.send_message("目前沒有任何進度。")
       return
     msg = "目前進度列表：\n"
-    for name in self.saves:
+    for name in session_ids:
       msg += f"• {name}\n"
     await interaction.response.send_message(msg)
 
@@ -349,7 +676,8 @@ class GPTTRPG(discord.Client):
       await interaction.response.send_message(f"❌ 進度 `{session_id}` 尚無摘要。", ephemeral=True)
       return
     
-    latest_summary = summaries[-1]
+    chapters = [summary for summary in summaries if summary.get('level', 0) == 0]
+    latest_summary = chapters[-1] if chapters else summaries[-1]
     file_path = os.path.join(SESSION_FOLDER, session_id, f"{latest_summary['file_name']}")
     if not os.path.exists(file_path):
       await interaction.response.send_message(f"❌ 找不到進度 `{session_id}` 的摘要檔案。", ephemeral=True)
@@ -380,6 +708,7 @@ class GPTTRPG(discord.Client):
           'state': PlayerState.CHARACTER_CREATION,
           'character_id': character_id,
         }
+        self.persistence.mark_player(user_id)
         await interaction.response.send_message(f"繼續創建角色 `{character_id}` 。")
       else:
         await interaction.response.send_message(f"❌ 角色 `{character_id}` 狀態未知：{character}。請重新創建。", ephemeral=True)
@@ -393,25 +722,48 @@ class GPTTRPG(discord.Client):
       }
     character = self.characters[user_id][character_id]
     character_creation_assistant_id = self.rule_set['character_creation']['assistant_id']
-    thread = self.openAIClient.beta.threads.create()
-    character['assistant_id'] = character_creation_assistant_id
-    character['thread_id'] = thread.id
 
     if not message:
       message = CHARACTER_CREATION_INTRO[random.randint(0, len(CHARACTER_CREATION_INTRO) - 1)]
 
-    assistant_reply, error = self.run_and_fetch_thread_response(thread.id, character_creation_assistant_id, message)
+    reply = self.narration_reply(interaction.followup, 'character_creation', f"{user_name}：「{message}」\n\n**遊戲敘事:**\n")
+    entry_id = await self.journal.open(
+      'character_creation',
+      user_id=user_id,
+      user_name=user_name,
+      character_id=character_id,
+      channel_id=interaction.channel.id,
+      message=message,
+      assistant_id=character_creation_assistant_id,
+    )
+    await self.settle_journal(self.start_character_creation(reply, user_id, user_name, character_id, message, character_creation_assistant_id, entry_id), [entry_id])
+
+  async def start_character_creation(self, reply: NarrationReply, user_id: str, user_name: str, character_id: str, message: str, assistant_id: str, entry_id: str):
+    character = self.characters[user_id][character_id]
+    thread_id, assistant_reply, error = await self.run_new_thread('character_creation', assistant_id, [user_message(message)], reply=reply, on_run=self.journal.run_recorder(entry_id))
+    character['assistant_id'] = assistant_id
+    character['thread_id'] = thread_id
     if error:
-      del self.characters[user_id][character_id]
-      await interaction.followup.send(error, ephemeral=True)
+      self.drop_unstarted_character(user_id, character_id)
+      await reply.finish(error, ephemeral=True)
       return
     
     self.player_state[user_id] = {
       'state': PlayerState.CHARACTER_CREATION,
       'character_id': character_id,
     }
-    character['state'] = CharacterCreationState.CHARACTER_CREATION,
-    await interaction.followup.send(f"{user_name}：「{message}」\n\n**遊戲敘事:**\n{assistant_reply}")
+    self.persistence.mark_player(user_id)
+    character['state'] = CharacterCreationState.CHARACTER_CREATION
+    self.persistence.mark_character(user_id, character_id, flush=True)
+    await reply.finish(f"{user_name}：「{message}」\n\n**遊戲敘事:**\n{assistant_reply}")
+
+  def drop_unstarted_character(self, user_id: str, character_id: str):
+    # A character whose first run never finished is left NOT_STARTED, which /create_character
+    # reports as still in progress forever; the deletion has to reach storage too
+    if user_id in self.characters and character_id in self.characters[user_id]:
+      if self.characters[user_id][character_id]['state'] == CharacterCreationState.NOT_STARTED:
+        del self.characters[user_id][character_id]
+        self.persistence.mark_character(user_id, character_id, flush=True)
 
   async def delete_character(self, interaction: discord.Interaction, character_id: str):
     if interaction.channel.id != CHANNEL_ID:
@@ -429,14 +781,8 @@ class GPTTRPG(discord.Client):
       await interaction.response.send_message(f"❌ 角色 `{character_id}` 不存在。", ephemeral=True)
       return
 
-    character_file = os.path.join(CHARACTER_FOLDER, user_id, f"{character_id}.json")
-    if os.path.exists(character_file):
-      try:
-        os.remove(character_file)
-      except Exception as e:
-        await interaction.response.send_message(f"❌ 無法刪除角色檔案 `{character_id}`: {e}", ephemeral=True)
-        return
     del self.characters[user_id][character_id]
+    self.persistence.mark_character(user_id, character_id, flush=True)
 
     await interaction.response.send_message(f"✅ 角色 `{character_id}` 已刪除。", ephemeral=True)
 
@@ -446,19 +792,21 @@ class GPTTRPG(discord.Client):
       return
 
     user_id = str(interaction.user.id)
-    if user_id not in self.characters or not self.characters[user_id]:
+    await self.persistence.flush()
+    characters = self.storage.list_characters(user_id)
+    if not characters:
       await interaction.response.send_message("目前沒有任何角色。", ephemeral=True)
       return
     
     msg = "目前角色列表：\n"
-    for character_id, character in self.characters[user_id].items():
+    for character_id, state, character_name in characters:
       name = ""
-      if character['state'] == CharacterCreationState.NOT_STARTED:
+      if state == CharacterCreationState.NOT_STARTED:
         name = "初始化中"
-      elif character['state'] == CharacterCreationState.CHARACTER_CREATION:
+      elif state == CharacterCreationState.CHARACTER_CREATION:
         name = "創角中"
-      elif character['state'] == CharacterCreationState.CREATED:
-        name = character['data']['name'] if 'data' in character and 'name' in character['data'] else "角色資料毀損"
+      elif state == CharacterCreationState.CREATED:
+        name = character_name or "角色資料毀損"
       msg += f"• {character_id}: {name}\n"
 
     await interaction.response.send_message(msg, ephemeral=True)
@@ -506,6 +854,7 @@ class GPTTRPG(discord.Client):
         'state': PlayerState.JOINED,
         'session_id': session_id,
       }
+      self.persistence.mark_player(user_id)
       await interaction.response.send_message(f"✅ 已切換至進度 `{session_id}` 。", ephemeral=True)
       return
 
@@ -521,13 +870,14 @@ class GPTTRPG(discord.Client):
       await interaction.response.send_message(f"❌ 角色 `{character_id}` 尚未創建完成，請先完成創建角色。。", ephemeral=True)
       return
 
-    character_file_id = self.sync_character(user_id, character_id)
+    character_file_id = await self.sync_character(user_id, character_id)
     character_data = self.characters[user_id][character_id]['data']
     save['players'][user_id] = {
       'character_id': character_id,
       'character_name': character_data['name'],
       'file_id': character_file_id,
     }
+    self.persistence.mark_session(session_id, flush=True)
     main_assistant_id = save['assistant_id']
     thread_id = save['thread_id']
 
@@ -536,8 +886,12 @@ class GPTTRPG(discord.Client):
     if not message:
       message = CHARACTER_CREATION_INTRO[random.randint(0, len(CHARACTER_CREATION_INTRO) - 1)]
 
-    self.message_queue[session_id].append({
-        'interaction': interaction,
+    tracing.set_attribute("session", session_id)
+    await self.queue_turn(session_id, interaction.channel.id, {
+        'followup': interaction.followup,
+        'user_id': user_id,
+        'queued_at': time.monotonic(),
+        'trace': tracing.current_context(),
         'messages': [
           f"System\n{user_id}使用以下角色加入遊戲：\n{json.dumps(character_data, ensure_ascii=False, indent=2)}",
           f"User ID:{user_id}\n{message}",
@@ -546,11 +900,11 @@ class GPTTRPG(discord.Client):
         'attachments': [{'file_id': data, 'tools': [{'type': 'file_search'}]} for data in [character_file_id] if data is not None],
       }
     )
-    await self.process_message_queue(session_id)
     self.player_state[user_id] = {
       'state': PlayerState.JOINED,
       'session_id': session_id,
     }
+    self.persistence.mark_player(user_id)
 
   async def play(self, interaction: discord.Interaction, message: str):
     if interaction.channel.id != CHANNEL_ID:
@@ -570,46 +924,68 @@ class GPTTRPG(discord.Client):
       assistant_id = self.characters[user_id][character_id]['assistant_id']
       thread_id = self.characters[user_id][character_id]['thread_id']
 
-      assistant_reply, error = self.run_and_fetch_thread_response(thread_id, assistant_id, message)
-      if error:
-        await interaction.followup.send(error, ephemeral=True)
-        return
-
-      if "START_OF_CHARACTER" in assistant_reply and "END_OF_CHARACTER" in assistant_reply:
-        message_index = assistant_reply.find("START_OF_CHARACTER")
-        start_index = message_index + len("START_OF_CHARACTER")
-        end_index = assistant_reply.find("END_OF_CHARACTER")
-
-        assistant_message = assistant_reply[:message_index].strip()
-        character_data_json = assistant_reply[start_index:end_index].strip()
-        character = self.characters[user_id][character_id]
-        try:
-          character_data = json.loads(character_data_json)
-          character['data'] = character_data
-          character['state'] = CharacterCreationState.CREATED
-          del character['assistant_id']
-          del character['thread_id'] 
-          self.player_state[user_id]['state'] = PlayerState.NOT_STARTED
-          if assistant_message:
-            assistant_message = f"**遊戲敘事**：{assistant_message}\n\n"
-          await interaction.followup.send(f"{assistant_message}✅ 角色 `{character_id}` 創建完成！\n**角色資料：**\n{self.characters[user_id][character_id]['data']}")
-        except json.JSONDecodeError as e:
-          await interaction.followup.send(f"❌ 無法解析角色數據，創建角色失敗：{e}", ephemeral=True)
-          traceback.print_exc()
-        return
-      
-      await interaction.followup.send(f"**玩家{user_name}輸入:**\n{message}\n\n**遊戲敘事:**\n{assistant_reply}")
+      reply = self.narration_reply(interaction.followup, 'character_creation', f"**玩家{user_name}輸入:**\n{message}\n\n**遊戲敘事:**\n")
+      entry_id = await self.journal.open(
+        'character_turn',
+        user_id=user_id,
+        user_name=user_name,
+        character_id=character_id,
+        channel_id=interaction.channel.id,
+        message=message,
+        thread_id=thread_id,
+        assistant_id=assistant_id,
+      )
+      await self.settle_journal(self.run_character_turn(reply, user_id, user_name, character_id, message, thread_id, assistant_id, entry_id), [entry_id])
     
     elif self.player_state[user_id]['state'] == PlayerState.JOINED:
       session_id = self.player_state[user_id]['session_id']
-      self.message_queue[session_id].append({
-        'interaction': interaction,
+      tracing.set_attribute("session", session_id)
+      await self.queue_turn(session_id, interaction.channel.id, {
+        'followup': interaction.followup,
+        'user_id': user_id,
+        'queued_at': time.monotonic(),
+        'trace': tracing.current_context(),
         'messages': [
           f"User ID:{user_id}\n{message}",
         ],
         'response_prefix': f"**玩家{user_name}輸入:**\n{message}",
+        'strategy': message,
       })
-      await self.process_message_queue(session_id)
+
+  async def run_character_turn(self, reply: NarrationReply, user_id: str, user_name: str, character_id: str, message: str, thread_id: str, assistant_id: str, entry_id: str):
+    assistant_reply, error = await self.run_and_fetch_thread_response('character_creation', thread_id, assistant_id, message, reply=reply, on_run=self.journal.run_recorder(entry_id))
+    if error:
+      await reply.finish(error, ephemeral=True)
+      return
+    await self.finish_character_turn(reply, user_id, user_name, character_id, message, assistant_reply)
+
+  async def finish_character_turn(self, reply: NarrationReply, user_id: str, user_name: str, character_id: str, message: str, assistant_reply: str):
+    if "START_OF_CHARACTER" in assistant_reply and "END_OF_CHARACTER" in assistant_reply:
+      message_index = assistant_reply.find("START_OF_CHARACTER")
+      start_index = message_index + len("START_OF_CHARACTER")
+      end_index = assistant_reply.find("END_OF_CHARACTER")
+
+      assistant_message = assistant_reply[:message_index].strip()
+      character_data_json = assistant_reply[start_index:end_index].strip()
+      character = self.characters[user_id][character_id]
+      try:
+        character_data = json.loads(character_data_json)
+        character['data'] = character_data
+        character['state'] = CharacterCreationState.CREATED
+        del character['assistant_id']
+        del character['thread_id'] 
+        self.persistence.mark_character(user_id, character_id, flush=True)
+        self.player_state[user_id]['state'] = PlayerState.NOT_STARTED
+        self.persistence.mark_player(user_id)
+        if assistant_message:
+          assistant_message = f"**遊戲敘事**：{assistant_message}\n\n"
+        await reply.finish(f"{assistant_message}✅ 角色 `{character_id}` 創建完成！\n**角色資料：**\n{self.characters[user_id][character_id]['data']}")
+      except json.JSONDecodeError as e:
+        await reply.finish(f"❌ 無法解析角色數據，創建角色失敗：{e}", ephemeral=True)
+        traceback.print_exc()
+      return
+    
+    await reply.finish(f"**玩家{user_name}輸入:**\n{message}\n\n**遊戲敘事:**\n{assistant_reply}")
 
   async def status(self, interaction: discord.Interaction):
     if interaction.channel.id != CHANNEL_ID:
@@ -633,127 +1009,406 @@ class GPTTRPG(discord.Client):
     
     await interaction.response.send_message("目前狀態：未知", ephemeral=True)
 
-  def run_and_fetch_thread_response(self, thread_id: str, assistant_id: str, message: str, attachments: list = []) -> (str, str):
-    try:
-      self.openAIClient.beta.threads.messages.create(
-        thread_id=thread_id,
-        role="user",
-        content=message,
-        attachments=attachments
-      )
-
-      run = self.openAIClient.beta.threads.runs.create(
-        thread_id=thread_id,
-        assistant_id=assistant_id,
-      )
+  async def run_and_fetch_thread_response(self, task: str, thread_id: str, assistant_id: str, message: str, attachments: list = [], reply: NarrationReply = None, on_run=None) -> (str, str):
+    _, assistant_reply, error = await self.run_new_thread(task, assistant_id, [user_message(message, attachments)], reply=reply, thread_id=thread_id, on_run=on_run)
+    return assistant_reply, error
 
-      while True:
-        run_status = self.openAIClient.beta.threads.runs.retrieve(
-          thread_id=thread_id,
-          run_id=run.id
-        )
-        if run_status.status in ["completed", "failed", "cancelled", "expired"]:
-          break
-        time.sleep(1)
+  async def run_new_thread(self, task: str, assistant_id: str, messages: list, reply: NarrationReply = None, thread_id: str = None, on_run=None) -> (str, str, str):
+    # Without a thread_id the thread is created together with the run
+    backend = self.backend_of(assistant_id)
+    started = time.monotonic()
+    try:
+      with tracing.span(f"task.{task}", thread=thread_id, assistant=assistant_id) as span:
+        if reply and reply.streaming:
+          assistant_reply, run_status, error = await backend.stream_and_fetch(thread_id, assistant_id, reply.update, messages, on_run=on_run)
+        else:
+          assistant_reply, run_status, error = await backend.run_and_fetch(thread_id, assistant_id, messages, on_run=on_run)
+        self.record_tier(task, time.monotonic() - started, None if error else run_status.usage)
+        if error:
+          print(f"[Error] Run on thread {run_status.thread_id} failed: {error}")
+          span.fail(error)
+          return run_status.thread_id, None, error
+
+        return run_status.thread_id, assistant_reply, None
+    except Exception as e:
+      self.record_tier(task, time.monotonic() - started)
+      traceback.print_exc()
+      return thread_id, None, f"❌ 發生錯誤: {e}"
 
-      if run_status.status != "completed":
-        traceback.print_exc()
-        return None, f"❌ Bot錯誤. 狀態: {run_status.status}"
+  def active_players(self, session_id: str) -> set:
+    return {
+      user_id for user_id in self.saves[session_id]['players']
+      if self.player_state.get(user_id, {}).get('session_id') == session_id
+    }
 
-      messages = self.openAIClient.beta.threads.messages.list(thread_id=thread_id, limit=5)
-      assistant_reply = None
-      for msg in messages.data:
-        if msg.role == "assistant":
-          assistant_reply = msg.content[0].text.value if msg.content else ""
-          break
+  def is_turn_batch_ready(self, session_id: str, batch: list) -> bool:
+    if session_id not in self.saves or any('recovered_run' in payload for payload in batch):
+      return True
+    return not self.active_players(session_id) - {payload['user_id'] for payload in batch}
 
-      if not assistant_reply:
-        traceback.print_exc()
-        return None, f"❌ 沒有收到 AI 回覆。"
+  async def tracked(self, command: str, coro, parent: dict = None, links: list = None, **attributes):
+    with self.round_trips.track(command), COMMAND_SECONDS.time(command), tracing.span(command, parent, links, **attributes):
+      return await coro
 
-      return assistant_reply, None
-    except Exception as e:
-      traceback.print_exc()
-      return None, f"❌ 發生錯誤: {e}"
+  async def queue_turn(self, session_id: str, channel_id: int, payload: dict):
+    # Journaled before it is queued, so a turn the bot dies before answering is queued again on restart
+    fields = {key: payload[key] for key in JOURNALED_PAYLOAD_FIELDS if key in payload}
+    payload['journal_id'] = await self.journal.open('turn', session_id=session_id, channel_id=channel_id, **fields)
+    self.scheduler.submit(session_id, payload)
 
-  async def process_message_queue(self, session_id: str):
-    if session_id not in self.message_queue or not self.message_queue[session_id]:
+  async def settle_journal(self, coro, entry_ids: list):
+    # Work cut off by shutdown keeps its entries for the next start; anything else is done with them
+    try:
+      result = await coro
+    except asyncio.CancelledError:
+      raise
+    except Exception:
+      await self.journal.close(*entry_ids)
+      raise
+    await self.journal.close(*entry_ids)
+    return result
+
+  async def process_turn_batch(self, session_id: str, batch: list) -> int | None:
+    # Runs cut off by a restart are answered before anything queued behind them
+    for recovered in [payload for payload in batch if 'recovered_run' in payload]:
+      await self.settle_journal(self.tracked("recover", self.resume_turn(session_id, recovered), session=session_id), recovered['journal_ids'])
+    batch = [payload for payload in batch if 'recovered_run' not in payload]
+    if not batch:
       return
+    # The turn continues the trace of the first queued command and links the others it absorbed
+    traces = [payload.get('trace') for payload in batch]
+    entry_ids = [payload['journal_id'] for payload in batch] + [self.run_entry_id(batch)]
+    return await self.settle_journal(self.tracked("turn", self.run_turn_batch(session_id, batch), traces[0], traces[1:], session=session_id, payloads=len(batch)), entry_ids)
 
+  def run_entry_id(self, batch: list) -> str:
+    return f"{batch[0]['journal_id']}-run"
+
+  async def run_turn_batch(self, session_id: str, batch: list) -> int | None:
     if session_id not in self.saves:
       print(f"[Error] Session {session_id} not found in saves.")
       return
+    for payload in batch:
+      STAGE_SECONDS.observe(time.monotonic() - payload['queued_at'], "queue_wait")
     session = self.saves[session_id]
+    if 'pending_thread' in session:
+      await self.swap_thread(session_id)
+    thread_id = session['thread_id']
+    assistant_id = session['assistant_id']
+    backend = self.backend_of(assistant_id)
+    current_session_id.set(session_id)
+
+    # Every message of the batch rides on the run creation instead of one request per message
+    posted = []
+    messages = []
+    for payload in batch:
+      # During combat a participant's input is their strategy for the round; it reaches the
+      # thread through the round prompt instead of as a message of its own. Other players
+      # act again once the combat is over.
+      if in_combat(session) and 'strategy' in payload:
+        if not record_strategy(session, payload['user_id'], payload['strategy']):
+          await payload['followup'].send(f"{payload.get('response_prefix', '')}\n\n❌ 你的角色沒有參與這場戰鬥，請等待戰鬥結束後再行動。")
+          continue
+        self.persistence.mark_session(session_id)
+      else:
+        messages += [user_message(message, payload.get('attachments', [])) for message in payload['messages']]
+      posted.append(payload)
+    if not posted:
+      return
 
-    with self.processing_lock[session_id]:
-      if self.processing[session_id]:
+    if in_combat(session):
+      waiting = pending_players(session, self.active_players(session_id))
+      if waiting:
+        try:
+          for message in messages:
+            await backend.add_message(thread_id, message['content'], message.get('attachments', []))
+        except Exception as e:
+          for payload in posted:
+            await payload['followup'].send(f"❌ 發生錯誤: {e}")
+          return
+        for payload in posted:
+          recorded = "已記錄策略" if 'strategy' in payload else "已記錄"
+          await payload['followup'].send(f"{payload.get('response_prefix', '')}\n\n（{recorded}，等待其他玩家決定策略：{'、'.join(waiting)}）")
         return
-      self.processing[session_id] = True
+      messages.append(user_message(begin_round(session)))
+      self.persistence.mark_session(session_id)
+
+    if len(posted) > 1:
+      print(f"[Debug] Batched {len(posted)} payloads into one run for session {session_id}")
+    response_prefix = "\n".join(payload.get('response_prefix', "") for payload in posted)
+    reply = self.narration_reply(posted[0]['followup'], 'main', f"{response_prefix}\n\n**遊戲敘事:**\n")
+    started = time.monotonic()
+    try:
+      # The run is journaled with the turns it answers, and its id once the backend has one; it is
+      # keyed by the whole batch, as that is what process_turn_batch closes it by
+      run_entry = await self.journal.open(
+        'turn_run',
+        entry_id=self.run_entry_id(batch),
+        session_id=session_id,
+        thread_id=thread_id,
+        assistant_id=assistant_id,
+        payloads=[payload['journal_id'] for payload in posted],
+      )
+      on_run = self.journal.run_recorder(run_entry)
+      if reply.streaming:
+        assistant_reply, run_status, error = await backend.stream_and_fetch(thread_id, assistant_id, reply.update, messages, on_run=on_run)
+      else:
+        assistant_reply, run_status, error = await backend.run_and_fetch(thread_id, assistant_id, messages, on_run=on_run)
+      return await self.finish_turn(session_id, posted, reply, response_prefix, assistant_reply, run_status, error, started)
+    except Exception as e:
+      traceback.print_exc()
+      for payload in posted:
+        await payload['followup'].send(f"❌ 發生錯誤: {e}")
 
-    while self.message_queue[session_id]:
-      payload = self.message_queue[session_id][0]
-      current_interaction = payload['interaction']
-      current_messages = payload['messages']
-      current_response_prefix = payload.get('response_prefix', "")
-      attachments = payload.get('attachments', [])
+  async def resume_turn(self, session_id: str, recovered: dict) -> int | None:
+    run = recovered['recovered_run']
+    posted = recovered['payloads']
+    if session_id not in self.saves:
+      print(f"[Error] Session {session_id} not found in saves.")
+      return
+    backend = self.backend_of(run['assistant_id'])
+    current_session_id.set(session_id)
+    response_prefix = "\n".join(payload.get('response_prefix', "") for payload in posted)
+    reply = NarrationReply(posted[0]['followup'], f"{response_prefix}\n\n**遊戲敘事:**\n")
+    started = time.monotonic()
+    try:
+      resumed = await backend.resume(run.get('thread_id'), run['assistant_id'], run.get('run_id'), run['opened_at'])
+      if resumed is None:
+        # The run was never created, so neither were its messages; the turns go again as they were
+        print(f"[Debug] Run for session {session_id} never started, replaying {len(posted)} turns.")
+        return await self.run_turn_batch(session_id, posted)
+      print(f"[Debug] Resumed run {run.get('run_id')} for session {session_id}.")
+      assistant_reply, run_status, error = resumed
+      return await self.finish_turn(session_id, posted, reply, response_prefix, assistant_reply, run_status, error, started)
+    except Exception as e:
+      traceback.print_exc()
+      for payload in posted:
+        await payload['followup'].send(f"❌ 發生錯誤: {e}")
 
-      thread_id = session['thread_id']
-      assistant_id = session['assistant_id']
+  async def finish_turn(self, session_id: str, posted: list, reply: NarrationReply, response_prefix: str, assistant_reply: str, run_status, error: str, started: float) -> int | None:
+    session = self.saves[session_id]
+    self.record_tier('main', time.monotonic() - started, None if error else run_status.usage)
+    if error:
+      await reply.finish(error)
+      for payload in posted[1:]:
+        await payload['followup'].send(error)
+      return
 
-      try:
-        for message in current_messages:
-          self.openAIClient.beta.threads.messages.create(
-              thread_id=thread_id,
-              role="user",
-              content=message,
-              attachments=attachments
-          )
-      except Exception as e:
-        await current_interaction.followup.send(f"❌ 發生錯誤: {e}")
-      self.message_queue[session_id].popleft()
+    narration = await reply.finish(f"{response_prefix}\n\n**遊戲敘事:**\n{assistant_reply}")
+    for payload in posted[1:]:
+      await payload['followup'].send(f"{payload.get('response_prefix', '')}\n\n（已與其他玩家的行動合併敘事：{narration.jump_url}）")
+    for payload in posted:
+      TURN_SECONDS.observe(time.monotonic() - payload['queued_at'])
+
+    # Summarize ahead of time when the next turn is expected to cross the budget, so the
+    # successor thread is usually ready before the old one actually gets there
+    input_tokens = estimate_tokens("\n".join(message for payload in posted for message in payload['messages']))
+    record_turn(session, [payload['user_id'] for payload in posted], run_status.usage.prompt_tokens, run_status.usage.completion_tokens, input_tokens)
+    self.persistence.mark_session(session_id)
+    threshold = self.rule_set['main']['summary_threshold_token']
+    predicted = predict_next_context(session, self.queued_text(session_id))
+    print(f"[Debug] Total tokens used: {run_status.usage.total_tokens}, predicted next context: {predicted} / {threshold}\n")
+    if predicted > threshold:
+      self.start_summary(session_id)
+    return run_status.usage.total_tokens
+
+  async def journal_channel(self, channel_id: int):
+    return self.get_channel(channel_id) or await self.fetch_channel(channel_id)
+
+  async def recovered_payload(self, entry_id: str, entry: dict) -> dict:
+    payload = {key: entry[key] for key in JOURNALED_PAYLOAD_FIELDS if key in entry}
+    payload['response_prefix'] = f"{RECOVERED_NOTE}{entry.get('response_prefix', '')}"
+    payload['followup'] = ChannelFollowup(await self.journal_channel(entry['channel_id']))
+    payload['queued_at'] = time.monotonic()
+    payload['journal_id'] = entry_id
+    return payload
+
+  async def recover_in_flight(self):
+    # Work the journal still held open when the bot last stopped: runs are picked up where they
+    # are instead of being run again, turns that never reached a run are queued again, and
+    # replies go to the channel since the interactions are gone
+    try:
+      # Sessions queue in order, so every turn a run claimed was queued before any turn left
+      # waiting: runs go back on the queue first, then the turns no run claimed
+      entries = sorted(self.journal.recovered.items(), key=lambda item: (item[1]['kind'] == 'turn', item[1]['opened_at']))
+      turns = {entry_id: entry for entry_id, entry in entries if entry['kind'] == 'turn'}
+      if entries:
+        print(f"[Debug] Recovering {len(entries)} in-flight journal entries.")
+      for entry_id, entry in entries:
+        try:
+          if entry['kind'] == 'turn_run':
+            payloads = [await self.recovered_payload(turn_id, turns.pop(turn_id)) for turn_id in entry['payloads'] if turn_id in turns]
+            if not payloads:
+              await self.journal.close(entry_id)
+              continue
+            self.scheduler.submit(entry['session_id'], {
+              'recovered_run': entry,
+              'payloads': payloads,
+              'journal_ids': [entry_id] + [payload['journal_id'] for payload in payloads],
+              'queued_at': time.monotonic(),
+            })
+          elif entry['kind'] == 'turn' and entry_id in turns:
+            del turns[entry_id]
+            self.scheduler.submit(entry['session_id'], await self.recovered_payload(entry_id, entry))
+          elif entry['kind'] in ('character_creation', 'character_turn'):
+            await self.settle_journal(self.tracked("recover", self.resume_character(entry)), [entry_id])
+        except Exception as e:
+          print(f"[Error] Failed to recover journal entry {entry_id} ({entry['kind']}): {e}")
+          traceback.print_exc()
+          await self.journal.close(entry_id)
+      await self.drop_stuck_characters()
+    except Exception as e:
+      print(f"[Error] Failed to recover in-flight work: {e}")
+      traceback.print_exc()
 
-      try:
-        run = self.openAIClient.beta.threads.runs.create(
-            thread_id=thread_id,
-            assistant_id=assistant_id,
-        )
+  async def resume_character(self, entry: dict):
+    user_id = entry['user_id']
+    character_id = entry['character_id']
+    followup = ChannelFollowup(await self.journal_channel(entry['channel_id']))
+    backend = self.backend_of(entry['assistant_id'])
+    resumed = await backend.resume(entry.get('thread_id'), entry['assistant_id'], entry.get('run_id'), entry['opened_at'])
+    if entry['kind'] == 'character_creation':
+      if resumed is None or resumed[2]:
+        self.drop_unstarted_character(user_id, character_id)
+        await followup.send(f"<@{user_id}> ❌ 角色 `{character_id}` 的創建因機器人重新啟動而中斷，請重新使用 `/create_character`。")
+        return
+      assistant_reply, run_status, _ = resumed
+      if user_id not in self.characters:
+        self.characters[user_id] = {}
+      self.characters[user_id][character_id] = {
+        'state': CharacterCreationState.CHARACTER_CREATION,
+        'assistant_id': entry['assistant_id'],
+        'thread_id': run_status.thread_id,
+      }
+      self.persistence.mark_character(user_id, character_id, flush=True)
+      self.player_state[user_id] = {
+        'state': PlayerState.CHARACTER_CREATION,
+        'character_id': character_id,
+      }
+      self.persistence.mark_player(user_id)
+      reply = NarrationReply(followup)
+      await reply.finish(f"{RECOVERED_NOTE}{entry['user_name']}：「{entry['message']}」\n\n**遊戲敘事:**\n{assistant_reply}")
+      return
 
-        while True:
-          run_status = self.openAIClient.beta.threads.runs.retrieve(
-              thread_id=thread_id,
-              run_id=run.id
-          )
-          if run_status.status in ["completed", "failed", "cancelled", "expired"]:
-            break
-          time.sleep(1)
-
-        if run_status.status != "completed":
-          await current_interaction.followup.send(f"❌ Bot錯誤. 狀態: {run_status.status}")
-          continue
+    if resumed is None:
+      await followup.send(f"<@{user_id}> ❌ 你在創建角色 `{character_id}` 時的輸入因機器人重新啟動而中斷，請重新輸入：{entry['message']}")
+      return
+    assistant_reply, _, error = resumed
+    reply = NarrationReply(followup)
+    if error:
+      await reply.finish(f"<@{user_id}> {error}")
+      return
+    if user_id not in self.characters or character_id not in self.characters[user_id]:
+      await reply.finish(f"{RECOVERED_NOTE}**玩家{entry['user_name']}輸入:**\n{entry['message']}\n\n**遊戲敘事:**\n{assistant_reply}")
+      return
+    await self.finish_character_turn(reply, user_id, entry['user_name'], character_id, entry['message'], assistant_reply)
+
+  async def drop_stuck_characters(self):
+    # NOT_STARTED rows no creation in flight will ever finish, e.g. saved by /save mid-creation
+    stuck = await asyncio.to_thread(self.storage.list_characters_in_state, EnumEncoder().default(CharacterCreationState.NOT_STARTED))
+    in_flight = {(entry['user_id'], entry['character_id']) for entry in self.journal.entries.values() if entry['kind'] == 'character_creation'}
+    for user_id, character_id in stuck:
+      if (user_id, character_id) not in in_flight:
+        print(f"[Debug] Dropping character {character_id} of user {user_id} stuck before creation.")
+        self.drop_unstarted_character(user_id, character_id)
+
+  def start_summary(self, session_id: str):
+    if session_id in self.summary_tasks or 'pending_thread' in self.saves[session_id]:
+      return
+    task = asyncio.create_task(self.tracked("summary", self.summary_session(session_id), session=session_id), name=f"summary-{session_id}")
+    self.summary_tasks[session_id] = task
+    task.add_done_callback(lambda _: self.summary_tasks.pop(session_id, None))
 
-        messages = self.openAIClient.beta.threads.messages.list(thread_id=thread_id, limit=5)
-        # Find the latest assistant message
-        assistant_reply = None
-        for msg in messages.data:
-          if msg.role == "assistant":
-            assistant_reply = msg.content[0].text.value if msg.content else ""
-            break
+  def message_text(self, message) -> str:
+    return "".join(content.text.value for content in message.content if content.type == "text")
 
-        if not assistant_reply:
-          await current_interaction.followup.send("❌ 沒有收到 AI 回覆。")
-          continue
+  def message_attachments(self, message) -> list:
+    return [
+      {'file_id': attachment.file_id, 'tools': [{'type': 'file_search'}]}
+      for attachment in message.attachments or []
+    ]
 
-        await current_interaction.followup.send(f"{current_response_prefix}\n\n**遊戲敘事:**\n{assistant_reply}")
+  async def swap_thread(self, session_id: str):
+    # Runs in the session worker between turns, so nothing else is posting to either thread
+    session = self.saves[session_id]
+    pending = session['pending_thread']
+    backend = self.backend_of(session['assistant_id'])
+    try:
+      replay = await backend.list_messages(session['thread_id'], after=pending['after'])
+      for message in replay:
+        await backend.add_message(pending['thread_id'], self.message_text(message), self.message_attachments(message), role=message.role)
+        pending['after'] = message.id
+    except Exception as e:
+      print(f"[Error] Failed to replay turns into the new thread for session {session_id}: {e}")
+      traceback.print_exc()
+      self.persistence.mark_session(session_id)
+      return
+    session['thread_id'] = pending['thread_id']
+    del session['pending_thread']
+    reset_context(session)
+    self.persistence.mark_session(session_id, flush=True)
+    print(f"[Debug] Session {session_id} switched to thread {session['thread_id']}, replayed {len(replay)} messages.")
 
-        print(f"[Debug] Total tokens used: {run_status.usage.total_tokens}\n")
-        if run_status.usage.total_tokens > SUMMARY_THRESHOLD_TOKEN:
-          self.summary_session(session_id)
-      except Exception as e:
-        await current_interaction.followup.send(f"❌ 發生錯誤: {e}")
+  def count_summaries(self, session: dict, level: int) -> int:
+    return sum(1 for summary in session['summaries'] if summary.get('level', 0) == level)
+
+  async def summarize_on_side_thread(self, content: str, prompt: str) -> (str, str):
+    assistant_id = self.rule_set['summary']['assistant_id']
+    _, summary, error = await self.run_new_thread('summary', assistant_id, [user_message(content), user_message(prompt)])
+    return summary, error
+
+  async def store_summary(self, session_id: str, summary_name: str, content: str, level: int) -> dict:
+    session = self.saves[session_id]
+    summary_file_name = f"{summary_name}.txt"
+    os.makedirs(os.path.join(SESSION_FOLDER, session_id), exist_ok=True)
+    with open(os.path.join(SESSION_FOLDER, session_id, summary_file_name), "w", encoding="utf-8") as f:
+      f.write(content)
+    session['summaries'].append({
+      'name': summary_name,
+      'file_name': summary_file_name,
+      'level': level,
+      'chars': len(content),
+    })
+    summary = session['summaries'][-1]
+    self.persistence.mark_session(session_id)
 
-    self.processing[session_id] = False
+    try:
+      summary['file_id'] = await self.upload_cache.upload(
+        f"SUMMARY_{session_id}_{summary_name}.txt",
+        content.encode('utf-8'),
+      )
+    except Exception as e:
+      print(f"[Error] Failed to upload summary file for session {session_id}: {e}")
+      traceback.print_exc()
+    return summary
 
-  def summary_session(self, session_id: str):
+  async def merge_summaries(self, session_id: str):
+    # Every SUMMARY_ARC_SIZE open summaries of one level fold into a single summary one level up,
+    # so a campaign keeps at most SUMMARY_ARC_SIZE - 1 open summaries per level
+    session = self.saves[session_id]
+    level = 0
+    while True:
+      open_summaries = [summary for summary in session['summaries'] if summary.get('level', 0) == level and not summary.get('merged')]
+      if len(open_summaries) < SUMMARY_ARC_SIZE:
+        return
+      contents = []
+      for summary in open_summaries:
+        with open(os.path.join(SESSION_FOLDER, session_id, summary['file_name']), "r", encoding="utf-8") as f:
+          contents.append(f"## {summary['name']}\n{f.read()}")
+      arc_summary, error = await self.summarize_on_side_thread(
+        "System\n以下是依序排列的數個章節摘要：\n\n" + "\n\n".join(contents),
+        "請以五百字內將以上章節合併為一段篇章摘要，保留對後續劇情重要的人物、承諾、傷勢與伏筆。回覆不需要使用命運引言。",
+      )
+      if error:
+        print(f"[Error] Failed to merge summaries for session {session_id}: {error}")
+        return
+      await self.store_summary(session_id, f"Arc {level + 1}-{self.count_summaries(session, level + 1) + 1}", arc_summary, level + 1)
+      for summary in open_summaries:
+        summary['merged'] = True
+      self.persistence.mark_session(session_id)
+      print(f"[Debug] Merged {len(open_summaries)} level {level} summaries of session {session_id}.")
+      level += 1
+
+  async def summary_session(self, session_id: str):
     if session_id not in self.saves:
       print(f"[Error] Session {session_id} not found in saves.")
       return
@@ -763,72 +1418,82 @@ class GPTTRPG(discord.Client):
       print(f"[Error] Session {session_id} is not in a valid state for summarization.")
       return
     
+    # Summarize a snapshot of the thread on a side thread while play continues on the original;
+    # anything posted after the snapshot is replayed into the successor when it is swapped in
     thread_id = session['thread_id']
     assistant_id = session['assistant_id']
-    current_summary, error = self.run_and_fetch_thread_response(thread_id, assistant_id, "請以五百字內總結目前遊戲進度。回覆不需要使用命運引言，只需要完整敘述目前遊戲進度的摘要即可。")
+    backend = self.backend_of(assistant_id)
+    try:
+      messages = await backend.list_messages(thread_id)
+    except Exception as e:
+      print(f"[Error] Failed to snapshot thread for session {session_id}: {e}")
+      traceback.print_exc()
+      return
+    settled = []
+    for message in messages:
+      if getattr(message, 'status', None) == "in_progress":
+        break
+      settled.append(message)
+    if not settled:
+      return
+    snapshot_id = settled[-1].id
+    transcript = "\n\n".join(f"[{message.role}]\n{self.message_text(message)}" for message in settled)
+
+    current_summary, error = await self.summarize_on_side_thread(
+      f"System\n以下是目前為止的遊戲紀錄：\n{transcript}",
+      "請以五百字內總結目前遊戲進度。回覆不需要使用命運引言，只需要完整敘述目前遊戲進度的摘要即可。",
+    )
     if error:
       print(f"[Error] Failed to summarize session {session_id}: {error}")
       return
     
-    summary_name = f"Chapter {len(session['summaries']) + 1}"
-    summary_file_name = f"{summary_name}.txt"
-    with open(os.path.join(SESSION_FOLDER, session_id, summary_file_name), "w", encoding="utf-8") as f:
-      f.write(current_summary)
-    session['summaries'].append({
-      'name': summary_name,
-      'file_name': summary_file_name,
-    })
-    summary = session['summaries'][-1]
-
-    file_io = io.BytesIO(current_summary.encode('utf-8'))
-    file_io.name = f"SUMMARY_{session_id}_{summary_name}.txt"
-    try:
-      response = self.openAIClient.files.create(
-        file=file_io,
-        purpose="assistants",
-      )
-      summary['file_id'] = response.id
-    except Exception as e:
-      print(f"[Error] Failed to upload summary file for session {session_id}: {e}")
-      traceback.print_exc()
+    await self.store_summary(session_id, f"Chapter {self.count_summaries(session, 0) + 1}", current_summary, 0)
+    await self.merge_summaries(session_id)
 
     scenario_id = session['scenario_id']
+    scenario = None
     scenario_content = "無劇本"
+    scenario_attachments = []
     if scenario_id:
-      scenarios_dir = os.path.join(os.path.dirname(__file__), "scenarios")
-      file_path = os.path.join(scenarios_dir, f"{scenario_id}.md")
-      if not os.path.exists(file_path):
+      scenario = self.scenarios.get(scenario_id)
+      if not scenario:
         print(f"[Error] Scenario file for {scenario_id} not found.")
         return
-      with open(file_path, "r", encoding="utf-8") as f:
-        scenario_content = f.read()
+      scenario_content, scenario_attachments = await self.scenario_seed(session_id, scenario)
     
-    # get all file_ids from summaries and characters
+    # Merged summaries are covered by their arc, so only the open summaries of each level are attached
     attachments = [
       {'file_id': file['file_id'], 'tools': [{'type': 'file_search'}]}
       for file in session['summaries']
-      if 'file_id' in file
+      if 'file_id' in file and not file.get('merged')
     ] + [
       {'file_id': player['file_id'], 'tools': [{'type': 'file_search'}]}
       for player in session['players'].values()
       if 'file_id' in player
-    ]
+    ] + scenario_attachments
 
     controlling_characters = ""
     for player_id, player in session['players'].items():
       controlling_characters += f"{player_id} 控制角色 {player['character_name']}\n"
 
+    combat_state = ledger_summary(session)
+    if combat_state:
+      controlling_characters += f"\n{combat_state}\n"
+
+    seed_content = f"System\n劇本：{scenario_content}\n\n目前摘要：{current_summary}\n\n{controlling_characters}"
     try:
-      thread = self.openAIClient.beta.threads.create(
+      successor_thread_id = await backend.create_thread(
         messages=[
           {
-            'content': f"System\n劇本：{scenario_content}\n\n目前摘要：{current_summary}\n\n{controlling_characters}",
+            'content': seed_content,
             'role': 'user',
             'attachments': attachments,
           }
         ],
       )
-      session['thread_id'] = thread.id
+      session['pending_thread'] = {'thread_id': successor_thread_id, 'after': snapshot_id}
+      self.record_seed_stats(session, seed_content, attachments, scenario)
+      self.persistence.mark_session(session_id, flush=True)
     except Exception as e:
       print(f"[Error] Failed to create summary thread for session {session_id}: {e}")
       traceback.print_exc()
@@ -836,54 +1501,72 @@ class GPTTRPG(discord.Client):
 
 client = GPTTRPG()
 
+def traced_command(function):
+  # Every slash command opens the root span of its trace; turns it queues continue that trace
+  @functools.wraps(function)
+  async def command(interaction: discord.Interaction, *args, **kwargs):
+    await client.tracked(function.__name__, function(interaction, *args, **kwargs), user=str(interaction.user.id))
+  return command
+
 @client.tree.command(name="start_game", description="創建新的遊玩進度")
 @app_commands.describe(session_id="進度名稱", scenario_id="劇本ID(留空則使用自由劇本)")
+@traced_command
 async def start_game(interaction: discord.Interaction, session_id: str, scenario_id: str = None):
   await client.start_game(interaction, session_id, scenario_id)
 
 @client.tree.command(name="list_sessions", description="顯示所有進度")
+@traced_command
 async def list_sessions(interaction: discord.Interaction):
   await client.list_sessions(interaction)
 
 @client.tree.command(name="session_summary", description="觀看進度摘要")
 @app_commands.describe(session_id="進度名稱")
+@traced_command
 async def session_summary(interaction: discord.Interaction, session_id: str):
   await client.session_summary(interaction, session_id)
 
 @client.tree.command(name="create_character", description="創建角色")
 @app_commands.describe(character_id="角色ID", message="創角開場白。留空則會隨機產生")
+@traced_command
 async def create_character(interaction: discord.Interaction, character_id: str, message: str = None):
   await client.create_character(interaction, character_id, message)
 
 @client.tree.command(name="list_characters", description="列出所有角色")
+@traced_command
 async def list_characters(interaction: discord.Interaction):
   await client.list_characters(interaction)
 
 @client.tree.command(name="delete_character", description="刪除角色")
 @app_commands.describe(character_id="角色ID")
+@traced_command
 async def delete_character(interaction: discord.Interaction, character_id: str):
   await client.delete_character(interaction, character_id)
 
 @client.tree.command(name="character_info", description="查看角色資訊")
 @app_commands.describe(character_id="角色ID")
+@traced_command
 async def character_info(interaction: discord.Interaction, character_id: str):
   await client.character_info(interaction, character_id)
 
 @client.tree.command(name="join", description="使用角色加入遊玩進度")
 @app_commands.describe(session_id="進度名稱", character_id="角色ID，重新加入時可留空", message="加入開場白。留空則會隨機產生")
+@traced_command
 async def join(interaction: discord.Interaction, session_id: str, character_id: str = None, message: str = None):
   await client.join(interaction, session_id, character_id, message)
 
 @client.tree.command(name="play", description="與敘事 AI 互動")
 @app_commands.describe(message="輸入你的角色行動或對話")
+@traced_command
 async def play(interaction: discord.Interaction, message: str):
   await client.play(interaction, message)
 
 @client.tree.command(name="status", description="查看玩家狀態")
+@traced_command
 async def status(interaction: discord.Interaction):
   await client.status(interaction)
 
 @client.tree.command(name="list_scenarios", description="列出所有劇本")
+@traced_command
 async def list_scenarios(interaction: discord.Interaction):
   if interaction.channel.id != CHANNEL_ID:
     await interaction.response.send_message("請在gpt-trpg頻道使用此指令.", ephemeral=True)
@@ -891,24 +1574,18 @@ async def list_scenarios(interaction: discord.Interaction):
 
   try:
     await interaction.response.defer()
-    scenarios_dir = os.path.join(os.path.dirname(__file__), "scenarios")
-    if not os.path.exists(scenarios_dir):
+    if not client.scenarios.exists():
       await interaction.followup.send("❌ 找不到場景資料夾。")
       return
 
-    scenario_files = [f for f in os.listdir(scenarios_dir) if f.endswith(".md")]
-    if not scenario_files:
+    scenarios = client.scenarios.list()
+    if not scenarios:
       await interaction.followup.send("❌ 沒有任何場景檔案。")
       return
 
     msg = "目前場景列表：\n"
-    for file_name in scenario_files:
-      file_id = file_name[:-3]  # Remove the .md extension
-      file_path = os.path.join(scenarios_dir, file_name)
-      with open(file_path, "r", encoding="utf-8") as f:
-        first_line = f.readline().strip()
-        title = first_line.lstrip("# ") if first_line.startswith("#") else first_line
-        msg += f"• {file_id}: {title}\n"
+    for scenario in scenarios:
+      msg += f"• {scenario['id']}: {scenario['title']}\n"
 
     await interaction.followup.send(msg)
   except Exception as e:
@@ -916,6 +1593,7 @@ async def list_scenarios(interaction: discord.Interaction):
 
 @client.tree.command(name="scenario_detail", description="顯示指定劇本的詳細資訊")
 @app_commands.describe(scenario_id="劇本ID")
+@traced_command
 async def scenario_detail(interaction: discord.Interaction, scenario_id: str):
   if interaction.channel.id != CHANNEL_ID:
     await interaction.response.send_message("請在gpt-trpg頻道使用此指令.", ephemeral=True)
@@ -923,34 +1601,82 @@ async def scenario_detail(interaction: discord.Interaction, scenario_id: str):
 
   try:
     await interaction.response.defer()
-    scenarios_dir = os.path.join(os.path.dirname(__file__), "scenarios")
-    file_path = os.path.join(scenarios_dir, f"{scenario_id}.md")
-
-    if not os.path.exists(file_path):
+    scenario = client.scenarios.get(scenario_id)
+    if not scenario:
       await interaction.followup.send(f"❌ 找不到劇本 `{scenario_id}`。")
       return
 
-    with open(file_path, "r", encoding="utf-8") as f:
-      content = f.read()
-
-    # Extract the first section starting with ##
-    sections = content.split("##")
-    if len(sections) < 2:
+    # The first section starting with ## is the synopsis
+    if not scenario['detail']:
       await interaction.followup.send(f"❌ 劇本 `{scenario_id}` 沒有簡介。")
       return
 
-    detail = sections[1].strip()
-    await interaction.followup.send(f"**劇本 `{scenario_id}` 的簡介：**\n\n{detail}")
+    await interaction.followup.send(f"**劇本 `{scenario_id}` 的簡介：**\n\n{scenario['detail']}")
   except Exception as e:
     await interaction.followup.send(f"❌ 發生錯誤: {e}")
 
+@client.tree.command(name="seed_report", description="顯示進度每次換章時的起始內容大小")
+@app_commands.describe(session_id="進度名稱")
+@traced_command
+async def seed_report(interaction: discord.Interaction, session_id: str):
+  await client.seed_report(interaction, session_id)
+
+@client.tree.command(name="usage_report", description="顯示進度的 token 用量與成本")
+@app_commands.describe(session_id="進度名稱")
+@traced_command
+async def usage_report(interaction: discord.Interaction, session_id: str):
+  await client.usage_report(interaction, session_id)
+
+@client.tree.command(name="round_trip_report", description="顯示各指令的 OpenAI 往返次數")
+@traced_command
+async def round_trip_report(interaction: discord.Interaction):
+  await interaction.response.send_message(f"**各指令的 OpenAI 往返次數：**\n{client.round_trips.report()}", ephemeral=True)
+
+@client.tree.command(name="tier_report", description="顯示各任務與模型的延遲與成本")
+@traced_command
+async def tier_report(interaction: discord.Interaction):
+  await interaction.response.send_message(f"**各任務與模型的延遲與成本：**\n{client.tiers.report()}", ephemeral=True)
+
+@client.tree.command(name="memory_report", description="顯示常駐記憶體中的進度與角色")
+@traced_command
+async def memory_report(interaction: discord.Interaction):
+  await client.memory_report(interaction)
+
+debug_profile = app_commands.Group(
+  name="debug_profile",
+  description="效能分析（管理員）",
+  default_permissions=discord.Permissions(administrator=True),
+  guild_only=True,
+)
+client.tree.add_command(debug_profile)
+
+@debug_profile.command(name="start", description="開始效能分析")
+@app_commands.describe(mode="sampling 取樣所有執行緒；cprofile 完整記錄事件迴圈執行緒", seconds="分析秒數，0 則直到手動停止")
+@traced_command
+async def profile_start(interaction: discord.Interaction, mode: Literal["sampling", "cprofile"] = "sampling", seconds: int = 60):
+  await client.profile_start(interaction, mode, seconds)
+
+@debug_profile.command(name="stop", description="停止效能分析並取得結果檔")
+@traced_command
+async def profile_stop(interaction: discord.Interaction):
+  await client.profile_stop(interaction)
+
+@debug_profile.command(name="blocking", description="顯示最近的事件迴圈阻塞與其堆疊")
+@app_commands.describe(limit="顯示筆數")
+@traced_command
+async def profile_blocking(interaction: discord.Interaction, limit: int = 5):
+  await client.profile_blocking(interaction, limit)
+
 @client.tree.command(name="save", description="手動保存進度")
+@traced_command
 async def save(interaction: discord.Interaction):
   try:
-    save_saves()
+    client.persistence.mark_all()
+    await client.persistence.flush()
     await interaction.response.send_message("✅ 進度已成功保存。")
   except Exception as e:
     await interaction.response.send_message(f"❌ 保存進度失敗：{e}")
 
-client.run(DISCORD_TOKEN)
-random.seed(time.time())
+if __name__ == "__main__":
+  client.run(DISCORD_TOKEN)
+  random.seed(time.time())
@@ -0,0 +1,196 @@
+import contextvars
+
+
+WOUND_LEVELS = ["無傷", "輕傷", "重傷", "肢解或粉碎"]
+
+# The session whose turn is being processed, so tool calls made inside the run
+# (including nested specialist runs) can reach the combat state
+current_session_id = contextvars.ContextVar("current_session_id", default=None)
+
+
+COMBAT_TOOLS = [
+  {
+    "type": "function",
+    "function": {
+      "name": "start_combat",
+      "description": "進入戰鬥。列出所有參與者，之後每個交戰回合會收到所有玩家的策略與目前傷勢。",
+      "parameters": {
+        "type": "object",
+        "properties": {
+          "situation": {"type": "string", "description": "交戰預備的結果，包含起始距離、地形與是否伏擊"},
+          "participants": {
+            "type": "array",
+            "items": {
+              "type": "object",
+              "properties": {
+                "name": {"type": "string"},
+                "side": {"type": "string", "description": "所屬陣營"},
+                "user_id": {"type": "string", "description": "玩家角色的玩家ID，非玩家角色則省略"},
+              },
+              "required": ["name", "side"],
+            },
+          },
+        },
+        "required": ["situation", "participants"],
+      },
+    },
+  },
+  {
+    "type": "function",
+    "function": {
+      "name": "end_combat",
+      "description": "一方死亡或逃跑成功時結束戰鬥。傷勢會保留到戰鬥之後。",
+      "parameters": {
+        "type": "object",
+        "properties": {
+          "outcome": {"type": "string", "description": "戰鬥結果、雙方損失與戰利品"},
+        },
+        "required": ["outcome"],
+      },
+    },
+  },
+]
+
+WOUND_TOOLS = [
+  {
+    "type": "function",
+    "function": {
+      "name": "record_wound",
+      "description": "記錄某個角色某個部位的傷勢等級，每次造成傷害或治療後都必須呼叫。",
+      "parameters": {
+        "type": "object",
+        "properties": {
+          "character": {"type": "string"},
+          "part": {"type": "string", "description": "部位，如左手臂、頭部、理解能力"},
+          "level": {"type": "string", "enum": WOUND_LEVELS},
+          "reason": {"type": "string"},
+        },
+        "required": ["character", "part", "level", "reason"],
+      },
+    },
+  },
+]
+
+
+def is_combat_tool(name: str) -> bool:
+  return any(tool['function']['name'] == name for tool in COMBAT_TOOLS + WOUND_TOOLS)
+
+def in_combat(session: dict) -> bool:
+  return bool(session.get('combat', {}).get('active'))
+
+def start_combat(session: dict, situation: str, participants: list) -> dict:
+  # Wounds outlive a single battle, so an earlier ledger is carried into the new combat
+  combat = session.setdefault('combat', {'wounds': {}})
+  combat.update({
+    'active': True,
+    'round': 0,
+    'situation': situation,
+    'participants': {
+      participant['name']: {'side': participant['side'], 'user_id': participant.get('user_id')}
+      for participant in participants
+    },
+    'strategies': {},
+    'changes': [],
+  })
+  for name in combat['participants']:
+    combat['wounds'].setdefault(name, {})
+  return {'round': combat['round'], 'wounds': wounds_of(session, combat['participants'])}
+
+def end_combat(session: dict, outcome: str) -> dict:
+  combat = session.get('combat')
+  if not combat or not combat.get('active'):
+    return {'error': "目前沒有進行中的戰鬥"}
+  combat['active'] = False
+  combat['outcome'] = outcome
+  combat['strategies'] = {}
+  return {'rounds': combat['round'], 'wounds': wounds_of(session, combat['participants'])}
+
+def record_wound(session: dict, character: str, part: str, level: str, reason: str = "") -> dict:
+  if level not in WOUND_LEVELS:
+    return {'error': f"未知的傷勢等級 {level}"}
+  combat = session.setdefault('combat', {'wounds': {}, 'active': False})
+  wounds = combat['wounds'].setdefault(character, {})
+  previous = wounds.get(part, WOUND_LEVELS[0])
+  if level == WOUND_LEVELS[0]:
+    wounds.pop(part, None)
+  else:
+    wounds[part] = level
+  change = {'character': character, 'part': part, 'from': previous, 'to': level, 'reason': reason}
+  combat.setdefault('changes', []).append(change)
+  return change
+
+def participant_for(session: dict, user_id: str) -> str:
+  for name, participant in session.get('combat', {}).get('participants', {}).items():
+    if participant.get('user_id') == user_id:
+      return name
+  return None
+
+def record_strategy(session: dict, user_id: str, strategy: str) -> str:
+  name = participant_for(session, user_id)
+  if name:
+    session['combat']['strategies'][name] = strategy
+  return name
+
+def pending_players(session: dict, active_user_ids: set) -> list:
+  combat = session['combat']
+  return [
+    name for name, participant in combat['participants'].items()
+    if participant.get('user_id') in active_user_ids and name not in combat['strategies']
+  ]
+
+def wounds_of(session: dict, names) -> dict:
+  ledger = session.get('combat', {}).get('wounds', {})
+  return {name: ledger.get(name, {}) for name in names}
+
+def format_wounds(wounds: dict) -> str:
+  lines = []
+  for name, parts in wounds.items():
+    status = "、".join(f"{part}{level}" for part, level in parts.items()) if parts else "無傷"
+    lines.append(f"- {name}：{status}")
+  return "\n".join(lines)
+
+def begin_round(session: dict) -> str:
+  # The round prompt carries only what the model needs now: the strategies for this round,
+  # the wound changes since the last prompt and the current ledger of the participants.
+  combat = session['combat']
+  combat['round'] += 1
+  lines = [f"System\n交戰回合 {combat['round']}", "本回合玩家策略："]
+  for name, strategy in combat['strategies'].items():
+    lines.append(f"- {name}：{strategy}")
+  if combat['changes']:
+    lines.append("上回合傷勢變化：")
+    for change in combat['changes']:
+      lines.append(f"- {change['character']} {change['part']}：{change['from']} → {change['to']}（{change['reason']}）")
+  lines.append("目前傷勢：")
+  lines.append(format_wounds(wounds_of(session, combat['participants'])))
+  lines.append("請決定非玩家角色的策略，並呼叫 resolve_combat_round 執行本回合。")
+  combat['strategies'] = {}
+  combat['changes'] = []
+  return "\n".join(lines)
+
+def ledger_summary(session: dict) -> str:
+  combat = session.get('combat')
+  if not combat:
+    return ""
+  wounds = {name: parts for name, parts in combat['wounds'].items() if parts}
+  if not combat.get('active') and not wounds:
+    return ""
+  lines = []
+  if combat.get('active'):
+    lines.append(f"戰鬥進行中，已進行 {combat['round']} 回合。{combat['situation']}")
+    lines.append("參與者：" + "、".join(f"{name}（{participant['side']}）" for name, participant in combat['participants'].items()))
+  if wounds:
+    lines.append("傷勢：")
+    lines.append(format_wounds(wounds))
+  return "\n".join(lines)
+
+def handle_combat_tool(session: dict, name: str, arguments: dict) -> dict:
+  if session is None:
+    return {'error': "目前沒有進行中的遊戲進度"}
+  if name == "start_combat":
+    return start_combat(session, arguments.get('situation', ""), arguments.get('participants', []))
+  if name == "end_combat":
+    return end_combat(session, arguments.get('outcome', ""))
+  if name == "record_wound":
+    return record_wound(session, arguments['character'], arguments['part'], arguments['level'], arguments.get('reason', ""))
+  return None
@@ -0,0 +1,227 @@
+import random
+
+
+DIE_FACES = 20
+STAT_MULTIPLIER = 10
+CRITICAL_SUCCESS = "critical_success"
+CRITICAL_FAILURE = "critical_failure"
+
+
+def roll_2d20(mode: str = "high", rng: random.Random = random) -> dict:
+  dice = [rng.randint(1, DIE_FACES), rng.randint(1, DIE_FACES)]
+  critical = None
+  if dice == [1, 1]:
+    critical = CRITICAL_FAILURE
+  elif dice == [DIE_FACES, DIE_FACES]:
+    critical = CRITICAL_SUCCESS
+  roll = min(dice) if mode == "low" else max(dice)
+  return {'dice': dice, 'roll': roll, 'critical': critical}
+
+def check_total(roll: int, stat: float, bonus: float) -> float:
+  return roll + stat * STAT_MULTIPLIER + bonus
+
+def resolve_check(stat: float, difficulty: float, bonus: float = 0, mode: str = "high", rng: random.Random = random) -> dict:
+  result = roll_2d20(mode, rng)
+  result['total'] = check_total(result['roll'], stat, bonus)
+  result['difficulty'] = difficulty
+  if result['critical'] == CRITICAL_FAILURE:
+    result['success'] = False
+  elif result['critical'] == CRITICAL_SUCCESS:
+    result['success'] = True
+  else:
+    result['success'] = result['total'] >= difficulty
+  result['success_probability'] = success_probability(stat, difficulty, bonus, mode)
+  return result
+
+def resolve_opposed(actor_stat: float, target_stat: float, actor_bonus: float = 0, target_bonus: float = 0, actor_mode: str = "high", target_mode: str = "high", rng: random.Random = random) -> dict:
+  actor = roll_2d20(actor_mode, rng)
+  actor['total'] = check_total(actor['roll'], actor_stat, actor_bonus)
+  target = roll_2d20(target_mode, rng)
+  target['total'] = check_total(target['roll'], target_stat, target_bonus)
+
+  # A critical outranks any plain total; ties go to the target, who holds the status quo
+  rank = {CRITICAL_FAILURE: 0, None: 1, CRITICAL_SUCCESS: 2}
+  actor_key = (rank[actor['critical']], actor['total'])
+  target_key = (rank[target['critical']], target['total'])
+  return {'actor': actor, 'target': target, 'winner': "actor" if actor_key > target_key else "target"}
+
+def resolve_thresholds(stat: float, thresholds: list, bonus: float = 0, mode: str = "high", rng: random.Random = random) -> dict:
+  result = roll_2d20(mode, rng)
+  result['total'] = check_total(result['roll'], stat, bonus)
+  thresholds = sorted(thresholds)
+  if result['critical'] == CRITICAL_FAILURE:
+    reached = []
+  elif result['critical'] == CRITICAL_SUCCESS:
+    reached = thresholds
+  else:
+    reached = [threshold for threshold in thresholds if result['total'] >= threshold]
+  result['thresholds'] = thresholds
+  result['reached'] = reached[-1] if reached else None
+  result['tier'] = len(reached)
+  return result
+
+def resolve_cumulative(stat: float, goal: float, progress: float = 0, bonus: float = 0, mode: str = "high", rng: random.Random = random) -> dict:
+  result = roll_2d20(mode, rng)
+  result['total'] = check_total(result['roll'], stat, bonus)
+  if result['critical'] == CRITICAL_FAILURE:
+    result['progress'] = progress
+  elif result['critical'] == CRITICAL_SUCCESS:
+    result['progress'] = max(goal, progress + result['total'])
+  else:
+    result['progress'] = progress + result['total']
+  result['goal'] = goal
+  result['completed'] = result['progress'] >= goal
+  return result
+
+
+def roll_distribution(mode: str = "high") -> (list, float, float):
+  # Exact distribution over the 400 outcomes of 2d20: P(kept die == v) for non-critical rolls,
+  # plus the probability of each critical.
+  outcomes = DIE_FACES * DIE_FACES
+  pmf = [0.0] * (DIE_FACES + 1)
+  for a in range(1, DIE_FACES + 1):
+    for b in range(1, DIE_FACES + 1):
+      if (a, b) in ((1, 1), (DIE_FACES, DIE_FACES)):
+        continue
+      pmf[min(a, b) if mode == "low" else max(a, b)] += 1 / outcomes
+  return pmf, 1 / outcomes, 1 / outcomes
+
+def roll_tail(mode: str = "high") -> list:
+  # tail[v] = P(non-critical kept die >= v), for v in 0..DIE_FACES + 1
+  pmf, _, _ = roll_distribution(mode)
+  tail = [0.0] * (DIE_FACES + 2)
+  for value in range(DIE_FACES, -1, -1):
+    tail[value] = tail[value + 1] + pmf[value]
+  return tail
+
+TAILS = {mode: roll_tail(mode) for mode in ("high", "low")}
+CRITICAL_SUCCESS_PROBABILITY = 1 / (DIE_FACES * DIE_FACES)
+
+def success_probability(stat: float, difficulty: float, bonus: float = 0, mode: str = "high") -> float:
+  needed = difficulty - stat * STAT_MULTIPLIER - bonus
+  tail = TAILS[mode]
+  if needed <= 1:
+    plain = tail[1]
+  elif needed > DIE_FACES:
+    plain = 0.0
+  else:
+    plain = tail[int(needed) if needed == int(needed) else int(needed) + 1]
+  return plain + CRITICAL_SUCCESS_PROBABILITY
+
+def probability_table(stats: list = range(0, 9), difficulties: list = range(10, 101, 5), bonus: float = 0, mode: str = "high") -> dict:
+  return {stat: {difficulty: success_probability(stat, difficulty, bonus, mode) for difficulty in difficulties} for stat in stats}
+
+def format_probability_table(stats: list = range(0, 9), difficulties: list = range(10, 101, 5), mode: str = "high") -> str:
+  table = probability_table(stats, difficulties, 0, mode)
+  lines = ["| 屬性 \\ 難度 | " + " | ".join(str(difficulty) for difficulty in difficulties) + " |"]
+  lines.append("|" + "---|" * (len(difficulties) + 1))
+  for stat, row in table.items():
+    lines.append(f"| {stat} | " + " | ".join(f"{row[difficulty]:.0%}" for difficulty in difficulties) + " |")
+  return "\n".join(lines)
+
+
+MODE_PARAMETER = {"type": "string", "enum": ["high", "low"], "description": "high 取較高的骰子；負面狀態時使用 low 取較低的骰子"}
+CHECK_TOOLS = [
+  {
+    "type": "function",
+    "function": {
+      "name": "roll_check",
+      "description": "執行一般檢定：擲2d20，結果 + 屬性值*10 + 加值 與難度比較。",
+      "parameters": {
+        "type": "object",
+        "properties": {
+          "character": {"type": "string", "description": "進行檢定的角色"},
+          "reason": {"type": "string", "description": "檢定內容，如「撞開木門」"},
+          "stat": {"type": "number", "description": "屬性值，混合檢定時為加權平均"},
+          "bonus": {"type": "number", "description": "各項加值與修正的總和"},
+          "difficulty": {"type": "number", "description": "檢定難度"},
+          "mode": MODE_PARAMETER,
+        },
+        "required": ["character", "reason", "stat", "difficulty"],
+      },
+    },
+  },
+  {
+    "type": "function",
+    "function": {
+      "name": "roll_opposed_check",
+      "description": "執行對抗檢定：雙方各自擲骰，最終結果高者獲勝，平手時目標方獲勝。",
+      "parameters": {
+        "type": "object",
+        "properties": {
+          "actor": {"type": "string", "description": "行動者"},
+          "target": {"type": "string", "description": "目標"},
+          "reason": {"type": "string", "description": "對抗內容"},
+          "actor_stat": {"type": "number"},
+          "actor_bonus": {"type": "number"},
+          "actor_mode": MODE_PARAMETER,
+          "target_stat": {"type": "number"},
+          "target_bonus": {"type": "number"},
+          "target_mode": MODE_PARAMETER,
+        },
+        "required": ["actor", "target", "reason", "actor_stat", "target_stat"],
+      },
+    },
+  },
+  {
+    "type": "function",
+    "function": {
+      "name": "roll_threshold_check",
+      "description": "執行多段結果檢定：回傳最終結果所達到的最高門檻。",
+      "parameters": {
+        "type": "object",
+        "properties": {
+          "character": {"type": "string"},
+          "reason": {"type": "string"},
+          "stat": {"type": "number"},
+          "bonus": {"type": "number"},
+          "thresholds": {"type": "array", "items": {"type": "number"}, "description": "各段門檻，如 [20, 40, 60]"},
+          "mode": MODE_PARAMETER,
+        },
+        "required": ["character", "reason", "stat", "thresholds"],
+      },
+    },
+  },
+  {
+    "type": "function",
+    "function": {
+      "name": "roll_cumulative_check",
+      "description": "執行一次累計檢定：將本次結果累加至目前進度，並回傳是否達成累計需求。",
+      "parameters": {
+        "type": "object",
+        "properties": {
+          "character": {"type": "string"},
+          "reason": {"type": "string"},
+          "stat": {"type": "number"},
+          "bonus": {"type": "number"},
+          "goal": {"type": "number", "description": "累計需求"},
+          "progress": {"type": "number", "description": "目前已累計的結果"},
+          "mode": MODE_PARAMETER,
+        },
+        "required": ["character", "reason", "stat", "goal", "progress"],
+      },
+    },
+  },
+]
+
+def handle_check_tool(name: str, arguments: dict) -> dict:
+  mode = arguments.get('mode', "high")
+  bonus = arguments.get('bonus', 0)
+  if name == "roll_check":
+    result = resolve_check(arguments['stat'], arguments['difficulty'], bonus, mode)
+  elif name == "roll_opposed_check":
+    result = resolve_opposed(
+      arguments['actor_stat'], arguments['target_stat'],
+      arguments.get('actor_bonus', 0), arguments.get('target_bonus', 0),
+      arguments.get('actor_mode', "high"), arguments.get('target_mode', "high"),
+    )
+  elif name == "roll_threshold_check":
+    result = resolve_thresholds(arguments['stat'], arguments['thresholds'], bonus, mode)
+  elif name == "roll_cumulative_check":
+    result = resolve_cumulative(arguments['stat'], arguments['goal'], arguments.get('progress', 0), bonus, mode)
+  else:
+    return None
+  return {'request': arguments, 'result': result}
+
+def is_check_tool(name: str) -> bool:
+  return any(tool['function']['name'] == name for tool in CHECK_TOOLS)
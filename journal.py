@@ -0,0 +1,89 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+
+from persistence import atomic_write
+
+
+JOURNAL_FILE = 'inflight.jsonl'
+
+
+class Journal:
+  # Append-only log of work still owed to players: queued turns and the runs answering them. Each
+  # line opens, updates or closes an entry, and is fsynced before the caller goes on, so whatever
+  # is still open at startup was cut off by a crash.
+  def __init__(self, path: str = JOURNAL_FILE):
+    self.path = path
+    self.entries = self.replay()
+    self.recovered = {entry_id: dict(entry) for entry_id, entry in self.entries.items()}
+    self.lock = asyncio.Lock()
+    self.compact()
+
+  def replay(self) -> dict:
+    entries = {}
+    if not os.path.exists(self.path):
+      return entries
+    with open(self.path, "r", encoding="utf-8") as f:
+      for line in f:
+        try:
+          record = json.loads(line)
+        except json.JSONDecodeError:
+          # The line being written when the process died
+          continue
+        op = record.pop('op')
+        entry_id = record.pop('id')
+        if op == 'open':
+          entries[entry_id] = record
+        elif op == 'update' and entry_id in entries:
+          entries[entry_id].update(record)
+        elif op == 'close':
+          entries.pop(entry_id, None)
+    return entries
+
+  def compact(self):
+    content = "".join(json.dumps({'op': 'open', 'id': entry_id, **entry}, ensure_ascii=False) + "\n" for entry_id, entry in self.entries.items())
+    atomic_write(os.path.abspath(self.path), content)
+
+  def write(self, records: list, truncate: bool = False):
+    with open(self.path, "w" if truncate else "a", encoding="utf-8") as f:
+      for record in records:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+      f.flush()
+      os.fsync(f.fileno())
+
+  async def append(self, records: list, truncate: bool = False):
+    # One writer at a time keeps the lines in the order the entries changed
+    async with self.lock:
+      await asyncio.to_thread(self.write, records, truncate)
+
+  async def open(self, kind: str, entry_id: str = None, **fields) -> str:
+    entry_id = entry_id or uuid.uuid4().hex
+    entry = {'kind': kind, 'opened_at': time.time(), **fields}
+    self.entries[entry_id] = entry
+    await self.append([{'op': 'open', 'id': entry_id, **entry}])
+    return entry_id
+
+  async def update(self, entry_id: str, **fields):
+    if entry_id not in self.entries:
+      return
+    self.entries[entry_id].update(fields)
+    await self.append([{'op': 'update', 'id': entry_id, **fields}])
+
+  async def close(self, *entry_ids: str):
+    closing = [entry_id for entry_id in entry_ids if entry_id in self.entries]
+    for entry_id in closing:
+      del self.entries[entry_id]
+    if not closing:
+      return
+    # Once nothing is open the log can start over instead of growing
+    if self.entries:
+      await self.append([{'op': 'close', 'id': entry_id} for entry_id in closing])
+    else:
+      await self.append([], truncate=True)
+
+  def run_recorder(self, entry_id: str):
+    async def record(run):
+      await self.update(entry_id, run_id=run.id, thread_id=run.thread_id)
+    return record
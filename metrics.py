@@ -0,0 +1,152 @@
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+def escape(value) -> str:
+  return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(names: tuple, values: tuple, extra: dict = None) -> str:
+  pairs = list(zip(names, values)) + list((extra or {}).items())
+  if not pairs:
+    return ""
+  return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+def format_value(value: float) -> str:
+  return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+  kind = "untyped"
+
+  def __init__(self, name: str, documentation: str, labels: tuple = ()):
+    self.name = name
+    self.documentation = documentation
+    self.labels = tuple(labels)
+    self.values = {}
+    REGISTRY.append(self)
+
+  def header(self) -> list:
+    return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+  def render(self) -> list:
+    lines = self.header()
+    for values, value in sorted(self.samples().items()):
+      lines.append(f"{self.name}{format_labels(self.labels, values)} {format_value(value)}")
+    return lines
+
+  def samples(self) -> dict:
+    return self.values
+
+
+class Counter(Metric):
+  kind = "counter"
+
+  def inc(self, *labels, amount: float = 1):
+    self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+  # A gauge is either set as things happen or, with collect, read when scraped
+  kind = "gauge"
+
+  def __init__(self, name: str, documentation: str, labels: tuple = (), collect=None):
+    super().__init__(name, documentation, labels)
+    self.collect = collect
+
+  def set(self, value: float, *labels):
+    self.values[labels] = value
+
+  def inc(self, *labels, amount: float = 1):
+    self.values[labels] = self.values.get(labels, 0) + amount
+
+  def dec(self, *labels, amount: float = 1):
+    self.inc(*labels, amount=-amount)
+
+  @contextmanager
+  def track(self, *labels):
+    self.inc(*labels)
+    try:
+      yield
+    finally:
+      self.dec(*labels)
+
+  def samples(self) -> dict:
+    if self.collect is None:
+      return self.values
+    try:
+      return self.collect()
+    except Exception as e:
+      print(f"[Error] Failed to collect gauge {self.name}: {e}")
+      return {}
+
+
+class Histogram(Metric):
+  kind = "histogram"
+
+  def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+    super().__init__(name, documentation, labels)
+    self.buckets = tuple(buckets)
+
+  def observe(self, value: float, *labels):
+    series = self.values.setdefault(labels, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+    for index, bound in enumerate(self.buckets):
+      if value <= bound:
+        series['buckets'][index] += 1
+    series['sum'] += value
+    series['count'] += 1
+
+  @contextmanager
+  def time(self, *labels):
+    started = time.monotonic()
+    try:
+      yield
+    finally:
+      self.observe(time.monotonic() - started, *labels)
+
+  def render(self) -> list:
+    lines = self.header()
+    for values, series in sorted(self.values.items()):
+      for bound, count in zip(self.buckets, series['buckets']):
+        lines.append(f"{self.name}_bucket{format_labels(self.labels, values, {'le': format_value(bound)})} {count}")
+      lines.append(f"{self.name}_bucket{format_labels(self.labels, values, {'le': '+Inf'})} {series['count']}")
+      lines.append(f"{self.name}_sum{format_labels(self.labels, values)} {format_value(series['sum'])}")
+      lines.append(f"{self.name}_count{format_labels(self.labels, values)} {series['count']}")
+    return lines
+
+
+REGISTRY = []
+
+# Where the seconds of a turn go. Polled runs split at the first poll that no longer sees them
+# queued; streamed runs split at the first text delta instead.
+STAGE_SECONDS = Histogram("gpttrpg_stage_seconds", "Seconds spent in each stage of a turn.", ("stage",))
+TURN_SECONDS = Histogram("gpttrpg_turn_seconds", "Seconds from a turn being queued to its narration being sent.")
+COMMAND_SECONDS = Histogram("gpttrpg_command_seconds", "Seconds spent serving each command, turn and summary.", ("command",))
+RUNS_IN_FLIGHT = Gauge("gpttrpg_runs_in_flight", "Model runs currently in progress.")
+TURNS_IN_FLIGHT = Gauge("gpttrpg_turns_in_flight", "Sessions with a turn being narrated.")
+QUEUE_DEPTH = Gauge("gpttrpg_queue_depth", "Turns waiting in each session's queue.", ("session",))
+RUNS = Counter("gpttrpg_runs_total", "Finished model runs by task and status.", ("task", "status"))
+TOKENS = Counter("gpttrpg_tokens_total", "Tokens used by task and kind.", ("task", "kind"))
+LOOP_BLOCK_SECONDS = Histogram("gpttrpg_loop_block_seconds", "Event-loop stalls longer than the watchdog threshold.")
+
+
+def render() -> str:
+  return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+async def handle_metrics(request):
+  return web.Response(body=render().encode("utf-8"), headers={'Content-Type': "text/plain; version=0.0.4; charset=utf-8"})
+
+async def serve(host: str = METRICS_HOST, port: int = METRICS_PORT):
+  app = web.Application()
+  app.router.add_get("/metrics", handle_metrics)
+  runner = web.AppRunner(app)
+  await runner.setup()
+  await web.TCPSite(runner, host, port).start()
+  print(f"[Debug] Serving metrics on http://{host}:{port}/metrics")
+  return runner
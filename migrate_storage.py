@@ -0,0 +1,29 @@
+import argparse
+
+from storage import JsonStorage, SqliteStorage, SQLITE_PATH
+
+
+def migrate(source, target) -> dict:
+  counts = {}
+  writes = []
+  for kind, key, content in source.iter_rows():
+    writes.append((kind, key, content))
+    counts[kind] = counts.get(kind, 0) + 1
+  failed = target.write_all(writes)
+  if failed:
+    print(f"[Error] Failed to migrate {len(failed)} rows: {failed}")
+  return counts
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Copy sessions, characters and player states from the JSON layout into SQLite")
+  parser.add_argument("--sqlite-path", default=SQLITE_PATH)
+  args = parser.parse_args()
+
+  source = JsonStorage(None)
+  target = SqliteStorage(None, args.sqlite_path)
+  try:
+    counts = migrate(source, target)
+  finally:
+    target.close()
+  print(f"[Debug] Migrated {counts} into {args.sqlite_path}. Set STORAGE = sqlite in .config to use it.")
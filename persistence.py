@@ -0,0 +1,140 @@
+import asyncio
+import json
+import os
+import tempfile
+import traceback
+
+import tracing
+
+
+SAVES_FILE = 'saves.json'
+CHARACTER_FOLDER = 'characters'
+SESSION_FOLDER = 'sessions'
+SESSION_SAVE_FILE = 'save.json'
+FLUSH_INTERVAL = 30
+
+
+def atomic_write(path: str, content: str):
+  folder = os.path.dirname(path)
+  os.makedirs(folder, exist_ok=True)
+  fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".tmp_", suffix=".json")
+  try:
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+      f.write(content)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+  except Exception:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    raise
+
+class Persistence:
+  def __init__(self, storage, saves: dict, characters: dict, player_state: dict, encoder, flush_interval: float = FLUSH_INTERVAL):
+    self.storage = storage
+    self.saves = saves
+    self.characters = characters
+    self.player_state = player_state
+    self.encoder = encoder
+    self.flush_interval = flush_interval
+    self.dirty_sessions = set()
+    self.dirty_characters = set()
+    self.dirty_players = set()
+    self.flush_requested = asyncio.Event()
+    self.flush_lock = asyncio.Lock()
+
+  def mark_session(self, session_id: str, flush: bool = False):
+    self.dirty_sessions.add(session_id)
+    if flush:
+      self.flush_requested.set()
+
+  def mark_character(self, user_id: str, character_id: str, flush: bool = False):
+    self.dirty_characters.add((user_id, character_id))
+    if flush:
+      self.flush_requested.set()
+
+  def mark_player(self, user_id: str, flush: bool = False):
+    self.dirty_players.add(user_id)
+    if flush:
+      self.flush_requested.set()
+
+  def is_dirty(self, kind: str, key) -> bool:
+    if kind == 'session':
+      return key in self.dirty_sessions
+    if kind == 'character':
+      return key in self.dirty_characters
+    return key in self.dirty_players
+
+  def mark_all(self):
+    self.dirty_sessions.update(self.saves.keys())
+    for user_id, characters in self.characters.items():
+      self.dirty_characters.update((user_id, character_id) for character_id in characters)
+    self.dirty_players.update(self.player_state.keys())
+
+  def dumps(self, data) -> str:
+    return json.dumps(data, ensure_ascii=False, indent=2, cls=self.encoder)
+
+  def collect(self) -> list:
+    # Serialize on the caller's thread so the snapshot is consistent; only the disk I/O is deferred
+    writes = []
+    dirty_sessions, self.dirty_sessions = self.dirty_sessions, set()
+    dirty_characters, self.dirty_characters = self.dirty_characters, set()
+    dirty_players, self.dirty_players = self.dirty_players, set()
+    for session_id in dirty_sessions:
+      self.collect_row(writes, 'session', session_id, self.saves, session_id)
+    for user_id, character_id in dirty_characters:
+      content = self.collect_row(writes, 'character', (user_id, character_id), dict.get(self.characters, user_id), character_id)
+      if content is not None:
+        self.characters.resize(user_id, character_id, len(content))
+    for user_id in dirty_players:
+      self.collect_row(writes, 'player_state', user_id, self.player_state, user_id)
+    return writes
+
+  def collect_row(self, writes: list, kind: str, key, rows, row_key):
+    # dict.get skips LazyRows.__missing__, so nothing is loaded here. A row that is not resident
+    # was evicted or never loaded and storage already holds it; only one deleted through its
+    # LazyRows is deleted from storage.
+    row = dict.get(rows, row_key) if rows is not None else None
+    if row is not None:
+      content = self.dumps(row)
+      writes.append((kind, key, content))
+      return content
+    if rows is not None and row_key in rows.deleted:
+      writes.append((kind, key, None))
+    else:
+      print(f"[Debug] Skipped writing {kind} {key}: not resident.")
+    return None
+
+  def mark_failed(self, failed: list):
+    for kind, key in failed:
+      if kind == 'session':
+        self.dirty_sessions.add(key)
+      elif kind == 'character':
+        self.dirty_characters.add(key)
+      else:
+        self.dirty_players.add(key)
+
+  async def flush(self):
+    async with self.flush_lock:
+      writes = self.collect()
+      if writes:
+        with tracing.span("persistence.flush", writes=len(writes)) as span:
+          failed = await asyncio.to_thread(self.storage.write_all, writes)
+          span.set("failed", len(failed))
+        self.mark_failed(failed)
+
+  def flush_sync(self):
+    self.mark_failed(self.storage.write_all(self.collect()))
+
+  async def run(self):
+    while True:
+      try:
+        await asyncio.wait_for(self.flush_requested.wait(), self.flush_interval)
+      except asyncio.TimeoutError:
+        pass
+      self.flush_requested.clear()
+      try:
+        await self.flush()
+      except Exception as e:
+        print(f"[Error] Failed to flush saves: {e}")
+        traceback.print_exc()
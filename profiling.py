@@ -0,0 +1,187 @@
+import asyncio
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+from metrics import LOOP_BLOCK_SECONDS
+
+
+PROFILE_FOLDER = 'profiles'
+SAMPLE_INTERVAL = 0.005
+LOOP_BLOCK_THRESHOLD = 0.25
+MAX_BLOCKING_EPISODES = 50
+MAX_STACK_DEPTH = 64
+WATCHDOG_THREAD = "loop-watchdog"
+
+
+def frame_name(frame) -> str:
+  code = frame.f_code
+  return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def collapse(frame) -> str:
+  # Root first, the way flamegraph.pl and speedscope read collapsed stacks
+  names = []
+  while frame is not None and len(names) < MAX_STACK_DEPTH:
+    names.append(frame_name(frame))
+    frame = frame.f_back
+  return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+  # Samples every thread's stack from a side thread, so the loop pays nothing between samples and
+  # blocking calls show up where they are, including those running in to_thread workers
+  kind = "sampling"
+  suffix = ".collapsed"
+
+  def __init__(self, interval: float = SAMPLE_INTERVAL):
+    self.interval = interval
+    self.stacks = Counter()
+    self.samples = 0
+    self.stopping = threading.Event()
+    self.thread = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self.sample, name="sampling-profiler", daemon=True)
+    self.thread.start()
+
+  def sample(self):
+    own = threading.get_ident()
+    while not self.stopping.wait(self.interval):
+      names = {thread.ident: thread.name for thread in threading.enumerate()}
+      for ident, frame in sys._current_frames().items():
+        if ident != own and names.get(ident) != WATCHDOG_THREAD:
+          self.stacks[f"{names.get(ident, ident)};{collapse(frame)}"] += 1
+      self.samples += 1
+
+  def stop(self):
+    self.stopping.set()
+    self.thread.join()
+
+  def write(self, path: str):
+    with open(path, "w", encoding="utf-8") as f:
+      for stack, count in self.stacks.most_common():
+        f.write(f"{stack} {count}\n")
+
+  def top(self, limit: int) -> list:
+    # Leaf frames are where the time went; idle threads park in the same few wait frames
+    leaves = Counter()
+    for stack, count in self.stacks.items():
+      leaves[stack.rsplit(";", 1)[-1]] += count
+    return [f"{count * self.interval:.2f}s {name}" for name, count in leaves.most_common(limit)]
+
+
+class CProfiler:
+  # Deterministic profile of the loop thread only; the .prof file opens in snakeviz or pstats
+  kind = "cprofile"
+  suffix = ".prof"
+
+  def __init__(self):
+    self.profile = cProfile.Profile()
+
+  def start(self):
+    self.profile.enable()
+
+  def stop(self):
+    self.profile.disable()
+
+  def write(self, path: str):
+    self.profile.dump_stats(path)
+
+  def top(self, limit: int) -> list:
+    stats = pstats.Stats(self.profile).stats
+    rows = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:limit]
+    return [
+      f"{own:.2f}s / {total:.2f}s x{calls} {name} ({os.path.basename(file_name)}:{line})"
+      for (file_name, line, name), (_, calls, own, total, _) in rows
+    ]
+
+
+class Profiler:
+  # At most one profile runs at a time; it stops on request or when its window is up
+  def __init__(self, folder: str = PROFILE_FOLDER):
+    self.folder = folder
+    self.active = None
+    self.started_at = None
+    self.stop_handle = None
+    self.last = None
+
+  def start(self, mode: str, seconds: float = 0):
+    if self.active:
+      raise RuntimeError(f"已有 {self.active.kind} 分析進行中")
+    profiler = CProfiler() if mode == "cprofile" else SamplingProfiler()
+    profiler.start()
+    self.active = profiler
+    self.started_at = time.time()
+    if seconds:
+      self.stop_handle = asyncio.get_running_loop().call_later(seconds, self.stop)
+
+  def stop(self, limit: int = 10) -> dict:
+    if not self.active:
+      return self.last
+    profiler, self.active = self.active, None
+    if self.stop_handle:
+      self.stop_handle.cancel()
+      self.stop_handle = None
+    profiler.stop()
+    os.makedirs(self.folder, exist_ok=True)
+    path = os.path.join(self.folder, f"{profiler.kind}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at))}{profiler.suffix}")
+    profiler.write(path)
+    self.last = {'kind': profiler.kind, 'path': path, 'seconds': time.time() - self.started_at, 'top': profiler.top(limit)}
+    print(f"[Debug] Wrote {profiler.kind} profile to {path}")
+    return self.last
+
+
+class LoopWatchdog:
+  # The loop ticks a heartbeat; a side thread that sees the heartbeat late by more than threshold
+  # grabs the loop thread's stack while it is still stuck, and the loop files the episode once it
+  # gets going again
+  def __init__(self, threshold: float = LOOP_BLOCK_THRESHOLD, max_episodes: int = MAX_BLOCKING_EPISODES):
+    self.threshold = threshold
+    self.tick = threshold / 4
+    self.episodes = deque(maxlen=max_episodes)
+    self.last_beat = None
+    self.loop_thread = None
+    self.caught = None
+    self.stopping = threading.Event()
+    self.thread = None
+    self.heartbeat_task = None
+
+  def start(self):
+    self.loop_thread = threading.get_ident()
+    self.last_beat = time.monotonic()
+    self.heartbeat_task = asyncio.create_task(self.heartbeat())
+    self.thread = threading.Thread(target=self.watch, name=WATCHDOG_THREAD, daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.stopping.set()
+    if self.heartbeat_task:
+      self.heartbeat_task.cancel()
+
+  async def heartbeat(self):
+    while True:
+      await asyncio.sleep(self.tick)
+      now = time.monotonic()
+      blocked = now - self.last_beat - self.tick
+      caught, self.caught = self.caught, None
+      if blocked > self.threshold:
+        stack = caught[1] if caught and caught[0] == self.last_beat else None
+        self.episodes.append({'at': time.time() - blocked, 'seconds': blocked, 'stack': stack})
+        LOOP_BLOCK_SECONDS.observe(blocked)
+        print(f"[Debug] Event loop blocked for {blocked * 1000:.0f}ms")
+      self.last_beat = now
+
+  def watch(self):
+    while not self.stopping.wait(self.tick):
+      beat = self.last_beat
+      if time.monotonic() - beat > self.threshold + self.tick and (self.caught is None or self.caught[0] != beat):
+        frame = sys._current_frames().get(self.loop_thread)
+        if frame is not None:
+          self.caught = (beat, collapse(frame))
+
+  def recent(self, limit: int) -> list:
+    return list(self.episodes)[-limit:]
@@ -0,0 +1,60 @@
+import contextvars
+import re
+from collections import Counter
+from contextlib import contextmanager
+
+from openai import DefaultAsyncHttpxClient
+
+
+ID_SEGMENT = re.compile(r"^(thread|run|msg|asst|step|call|file|vs)[_-]")
+
+# The counter of the command being served; background work outside a command is not counted
+current_counter = contextvars.ContextVar("round_trip_counter", default=None)
+
+
+def endpoint(method: str, path: str) -> str:
+  segments = ["{id}" if ID_SEGMENT.match(segment) else segment for segment in path.strip("/").split("/")]
+  return f"{method} /{'/'.join(segments)}"
+
+async def count_request(request):
+  counter = current_counter.get()
+  if counter is not None:
+    counter[endpoint(request.method, request.url.path)] += 1
+
+def counting_http_client():
+  return DefaultAsyncHttpxClient(event_hooks={'request': [count_request]})
+
+
+class RoundTripStats:
+  def __init__(self):
+    self.commands = {}
+
+  @contextmanager
+  def track(self, command: str):
+    counter = Counter()
+    token = current_counter.set(counter)
+    try:
+      yield counter
+    finally:
+      current_counter.reset(token)
+      self.record(command, counter)
+
+  def record(self, command: str, counter: Counter):
+    total = sum(counter.values())
+    stats = self.commands.setdefault(command, {'calls': 0, 'round_trips': 0, 'min': None, 'max': 0, 'last': {}})
+    stats['calls'] += 1
+    stats['round_trips'] += total
+    stats['min'] = total if stats['min'] is None else min(stats['min'], total)
+    stats['max'] = max(stats['max'], total)
+    stats['last'] = dict(counter)
+    print(f"[Debug] {command}: {total} OpenAI round trips {dict(counter)}")
+
+  def report(self) -> str:
+    if not self.commands:
+      return "尚無紀錄。"
+    lines = []
+    for command, stats in sorted(self.commands.items()):
+      lines.append(f"• {command}：{stats['calls']} 次，平均 {stats['round_trips'] / stats['calls']:.1f}，最少 {stats['min']}，最多 {stats['max']}")
+      for name, count in sorted(stats['last'].items()):
+        lines.append(f"　{name} × {count}")
+    return "\n".join(lines)
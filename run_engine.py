@@ -0,0 +1,297 @@
+import asyncio
+import json
+import time
+import traceback
+from abc import ABC, abstractmethod
+
+import tracing
+from metrics import STAGE_SECONDS, RUNS_IN_FLIGHT
+
+
+TERMINAL_RUN_STATUSES = ["completed", "failed", "cancelled", "expired"]
+RUN_POLL_INTERVAL = 1
+
+
+def user_message(content: str, attachments: list = None) -> dict:
+  message = {'role': "user", 'content': content}
+  if attachments:
+    message['attachments'] = attachments
+  return message
+
+
+class Backend(ABC):
+  # What the bot needs from a model backend: threads of messages and runs over them that resolve
+  # function tool calls locally through tool_handler
+  def __init__(self, rate_limiter=None, tool_handler=None):
+    self.rate_limiter = rate_limiter
+    self.tool_handler = tool_handler
+
+  async def throttle(self):
+    if self.rate_limiter:
+      await self.rate_limiter.acquire_request()
+
+  async def call_tool(self, thread_id: str, tool_call_id: str, name: str, arguments: str) -> dict:
+    with tracing.span(f"tool.{name}", thread=thread_id) as span:
+      try:
+        arguments = json.loads(arguments or "{}")
+        if not self.tool_handler:
+          raise ValueError("no tool handler registered")
+        output = await self.tool_handler(thread_id, name, arguments)
+        if output is None:
+          raise ValueError(f"unknown tool {name}")
+      except Exception as e:
+        print(f"[Error] Tool call {name} on thread {thread_id} failed: {e}")
+        traceback.print_exc()
+        span.fail(str(e))
+        output = {'error': str(e)}
+    return {'tool_call_id': tool_call_id, 'output': json.dumps(output, ensure_ascii=False)}
+
+  def owns(self, assistant_id: str) -> bool:
+    return False
+
+  @abstractmethod
+  async def create_thread(self, messages: list = None) -> str:
+    pass
+
+  @abstractmethod
+  async def add_message(self, thread_id: str, content: str, attachments: list = [], role: str = "user"):
+    pass
+
+  @abstractmethod
+  async def list_messages(self, thread_id: str, after: str = None) -> list:
+    pass
+
+  @abstractmethod
+  async def run_and_fetch(self, thread_id: str, assistant_id: str, messages: list = None, on_run=None) -> (str, object, str):
+    pass
+
+  @abstractmethod
+  async def stream_and_fetch(self, thread_id: str, assistant_id: str, on_text, messages: list = None, on_run=None) -> (str, object, str):
+    pass
+
+  @abstractmethod
+  async def resume(self, thread_id: str, assistant_id: str, run_id: str = None, since: float = None) -> (str, object, str):
+    # Picks a run back up after a restart; None when there is no such run to pick up
+    pass
+
+
+class RunEngine(Backend):
+  # Assistants API threads and runs; owns every assistant id no other backend claims
+  def __init__(self, client, poll_interval: float = RUN_POLL_INTERVAL, rate_limiter=None, tool_handler=None):
+    super().__init__(rate_limiter, tool_handler)
+    self.client = client
+    self.poll_interval = poll_interval
+
+  async def create_thread(self, messages: list = None) -> str:
+    await self.throttle()
+    with tracing.span("openai.thread_create"):
+      if messages:
+        thread = await self.client.beta.threads.create(messages=messages)
+      else:
+        thread = await self.client.beta.threads.create()
+    return thread.id
+
+  async def add_message(self, thread_id: str, content: str, attachments: list = [], role: str = "user"):
+    await self.throttle()
+    with STAGE_SECONDS.time("message_create"), tracing.span("openai.message_create", thread=thread_id):
+      await self.client.beta.threads.messages.create(
+        thread_id=thread_id,
+        role=role,
+        content=content,
+        attachments=attachments,
+      )
+
+  async def list_messages(self, thread_id: str, after: str = None) -> list:
+    await self.throttle()
+    with tracing.span("openai.message_list", thread=thread_id):
+      if after:
+        pages = self.client.beta.threads.messages.list(thread_id=thread_id, order="asc", after=after, limit=100)
+      else:
+        pages = self.client.beta.threads.messages.list(thread_id=thread_id, order="asc", limit=100)
+      return [message async for message in pages]
+
+  async def resolve_tool_calls(self, thread_id: str, run_status) -> list:
+    tool_calls = run_status.required_action.submit_tool_outputs.tool_calls
+    return await asyncio.gather(*[
+      self.call_tool(thread_id, tool_call.id, tool_call.function.name, tool_call.function.arguments)
+      for tool_call in tool_calls
+    ])
+
+  async def wait_for_run(self, thread_id: str, run_id: str):
+    # A freshly created run is never done yet, so wait before the first poll
+    stage, started = "run_queued", time.monotonic()
+    polls = 0
+    while True:
+      await asyncio.sleep(self.poll_interval)
+      await self.throttle()
+      polls += 1
+      with tracing.span("openai.run_poll", run=run_id, poll=polls) as span:
+        run_status = await self.client.beta.threads.runs.retrieve(
+          thread_id=thread_id,
+          run_id=run_id,
+        )
+        span.set("run.status", run_status.status)
+      if stage == "run_queued" and run_status.status != "queued":
+        STAGE_SECONDS.observe(time.monotonic() - started, stage)
+        stage, started = "run_in_progress", time.monotonic()
+      if run_status.status in TERMINAL_RUN_STATUSES:
+        STAGE_SECONDS.observe(time.monotonic() - started, stage)
+        return run_status
+      if run_status.status == "requires_action":
+        tool_outputs = await self.resolve_tool_calls(thread_id, run_status)
+        await self.throttle()
+        with tracing.span("openai.submit_tool_outputs", run=run_id, outputs=len(tool_outputs)):
+          await self.client.beta.threads.runs.submit_tool_outputs(
+            thread_id=thread_id,
+            run_id=run_id,
+            tool_outputs=tool_outputs,
+          )
+
+  async def run(self, thread_id: str, assistant_id: str, messages: list = None, on_run=None):
+    # Messages ride along on the run creation; without a thread the thread is created in the same call
+    await self.throttle()
+    with STAGE_SECONDS.time("run_create"), tracing.span("openai.run_create", thread=thread_id, assistant=assistant_id) as span:
+      if thread_id is None:
+        run = await self.client.beta.threads.create_and_run(
+          assistant_id=assistant_id,
+          thread={'messages': messages or []},
+        )
+      elif messages:
+        run = await self.client.beta.threads.runs.create(
+          thread_id=thread_id,
+          assistant_id=assistant_id,
+          additional_messages=messages,
+        )
+      else:
+        run = await self.client.beta.threads.runs.create(
+          thread_id=thread_id,
+          assistant_id=assistant_id,
+        )
+      span.set("run", run.id)
+    if on_run:
+      await on_run(run)
+    return await self.wait_for_run(run.thread_id, run.id)
+
+  async def fetch_latest_reply(self, thread_id: str, run_id: str = None) -> str:
+    await self.throttle()
+    with STAGE_SECONDS.time("message_fetch"), tracing.span("openai.message_fetch", thread=thread_id, run=run_id):
+      if run_id:
+        # Only messages written by this run, newest first, so the first one is the reply
+        messages = await self.client.beta.threads.messages.list(thread_id=thread_id, run_id=run_id, order="desc", limit=1)
+      else:
+        messages = await self.client.beta.threads.messages.list(thread_id=thread_id, limit=5)
+    # Find the latest assistant message
+    for msg in messages.data:
+      if msg.role == "assistant":
+        return "".join(content.text.value for content in msg.content if content.type == "text")
+    return None
+
+  async def fetch_run_reply(self, run_status) -> (str, object, str):
+    if run_status.status != "completed":
+      return None, run_status, f"❌ Bot錯誤. 狀態: {run_status.status}"
+
+    assistant_reply = await self.fetch_latest_reply(run_status.thread_id, run_status.id)
+    if not assistant_reply:
+      return None, run_status, "❌ 沒有收到 AI 回覆。"
+
+    return assistant_reply, run_status, None
+
+  async def run_and_fetch(self, thread_id: str, assistant_id: str, messages: list = None, on_run=None) -> (str, object, str):
+    with RUNS_IN_FLIGHT.track(), tracing.span("run", thread=thread_id, assistant=assistant_id) as span:
+      run_status = await self.run(thread_id, assistant_id, messages, on_run)
+      span.set("run.status", run_status.status)
+    return await self.fetch_run_reply(run_status)
+
+  async def find_run(self, thread_id: str, since: float):
+    # A run the journal never got the id of is the newest on its thread, if it started after the
+    # entry was opened; a little slack covers clock skew against the server
+    await self.throttle()
+    runs = await self.client.beta.threads.runs.list(thread_id=thread_id, order="desc", limit=1)
+    for run in runs.data:
+      if run.created_at >= since - 5:
+        return run
+    return None
+
+  async def resume(self, thread_id: str, assistant_id: str, run_id: str = None, since: float = None) -> (str, object, str):
+    if run_id:
+      await self.throttle()
+      run = await self.client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+    elif thread_id and since:
+      run = await self.find_run(thread_id, since)
+    else:
+      run = None
+    if run is None:
+      return None
+    with RUNS_IN_FLIGHT.track(), tracing.span("run", thread=thread_id, assistant=assistant_id, run=run.id, resumed=True) as span:
+      run_status = run if run.status in TERMINAL_RUN_STATUSES else await self.wait_for_run(run.thread_id, run.id)
+      span.set("run.status", run_status.status)
+    return await self.fetch_run_reply(run_status)
+
+  async def stream_and_fetch(self, thread_id: str, assistant_id: str, on_text, messages: list = None, on_run=None) -> (str, object, str):
+    with RUNS_IN_FLIGHT.track(), tracing.span("run", thread=thread_id, assistant=assistant_id, streamed=True) as span:
+      assistant_reply, run_status = await self.stream(thread_id, assistant_id, on_text, messages, on_run)
+      span.set("run.status", run_status.status)
+
+    if run_status.status != "completed":
+      return None, run_status, f"❌ Bot錯誤. 狀態: {run_status.status}"
+
+    if not assistant_reply:
+      return None, run_status, "❌ 沒有收到 AI 回覆。"
+
+    return assistant_reply, run_status, None
+
+  async def stream(self, thread_id: str, assistant_id: str, on_text, messages: list = None, on_run=None) -> (str, object):
+    assistant_reply = ""
+    await self.throttle()
+    if thread_id is None:
+      stream_manager = self.client.beta.threads.create_and_run_stream(
+        assistant_id=assistant_id,
+        thread={'messages': messages or []},
+      )
+    elif messages:
+      stream_manager = self.client.beta.threads.runs.stream(
+        thread_id=thread_id,
+        assistant_id=assistant_id,
+        additional_messages=messages,
+      )
+    else:
+      stream_manager = self.client.beta.threads.runs.stream(
+        thread_id=thread_id,
+        assistant_id=assistant_id,
+      )
+    # A run that calls tools ends its stream in requires_action; submitting the outputs opens a new stream
+    stage, started = "run_create", time.monotonic()
+    # The run id arrives with the stream's first events
+    reported = on_run is None
+    while stream_manager:
+      with tracing.span("openai.stream", thread=thread_id) as span:
+        async with stream_manager as stream:
+          if stage == "run_create":
+            STAGE_SECONDS.observe(time.monotonic() - started, stage)
+            stage, started = "run_queued", time.monotonic()
+          async for text in stream.text_deltas:
+            if not reported and stream.current_run:
+              await on_run(stream.current_run)
+              reported = True
+            if stage == "run_queued":
+              STAGE_SECONDS.observe(time.monotonic() - started, stage)
+              stage, started = "run_in_progress", time.monotonic()
+            assistant_reply += text
+            await on_text(assistant_reply)
+          run_status = await stream.get_final_run()
+        if not reported:
+          await on_run(run_status)
+          reported = True
+        span.set("run", run_status.id)
+        span.set("run.status", run_status.status)
+      stream_manager = None
+      if run_status.status == "requires_action":
+        tool_outputs = await self.resolve_tool_calls(run_status.thread_id, run_status)
+        await self.throttle()
+        stream_manager = self.client.beta.threads.runs.submit_tool_outputs_stream(
+          thread_id=run_status.thread_id,
+          run_id=run_status.id,
+          tool_outputs=tool_outputs,
+        )
+    STAGE_SECONDS.observe(time.monotonic() - started, stage)
+    return assistant_reply, run_status
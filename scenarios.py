@@ -0,0 +1,105 @@
+import os
+import time
+
+
+SCENARIO_FOLDER = os.path.join(os.path.dirname(__file__), "scenarios")
+SCENARIO_EXTENSION = ".md"
+SCENARIO_RECHECK_INTERVAL = 30
+SCENARIO_SYNOPSIS_CHARS = 300
+
+
+def parse_scenario(scenario_id: str, content: str) -> dict:
+  lines = content.splitlines()
+  first_line = lines[0].strip() if lines else ""
+  title = first_line.lstrip("# ") if first_line.startswith("#") else first_line
+
+  sections = []
+  for line in lines[1:]:
+    if line.startswith("##"):
+      sections.append({'heading': line.lstrip("# ").strip(), 'lines': []})
+    elif sections:
+      sections[-1]['lines'].append(line)
+  sections = [{'heading': section['heading'], 'body': "\n".join(section['lines']).strip()} for section in sections]
+
+  detail = f"{sections[0]['heading']}\n{sections[0]['body']}".strip() if sections else None
+  synopsis = f"{title}\n{detail}" if detail else title
+  if len(synopsis) > SCENARIO_SYNOPSIS_CHARS:
+    synopsis = synopsis[:SCENARIO_SYNOPSIS_CHARS] + "……"
+  return {
+    'id': scenario_id,
+    'title': title,
+    'sections': sections,
+    'detail': detail,
+    'synopsis': synopsis,
+    'body': content,
+  }
+
+
+class ScenarioRegistry:
+  # Scenarios are parsed once and kept in memory. A file is re-read only when its mtime changes;
+  # new and removed files show up through the folder's mtime.
+  def __init__(self, folder: str = SCENARIO_FOLDER, recheck_interval: float = SCENARIO_RECHECK_INTERVAL):
+    self.folder = folder
+    self.recheck_interval = recheck_interval
+    self.scenarios = {}
+    self.mtimes = {}
+    self.folder_mtime = None
+    self.checked_at = 0
+
+  def path(self, scenario_id: str) -> str:
+    return os.path.join(self.folder, f"{scenario_id}{SCENARIO_EXTENSION}")
+
+  def load(self, scenario_id: str, mtime: float):
+    with open(self.path(scenario_id), "r", encoding="utf-8") as f:
+      self.scenarios[scenario_id] = parse_scenario(scenario_id, f.read())
+    self.mtimes[scenario_id] = mtime
+
+  def forget(self, scenario_id: str):
+    self.scenarios.pop(scenario_id, None)
+    self.mtimes.pop(scenario_id, None)
+
+  def revalidate(self, scenario_id: str) -> bool:
+    try:
+      mtime = os.stat(self.path(scenario_id)).st_mtime
+    except FileNotFoundError:
+      self.forget(scenario_id)
+      return False
+    if self.mtimes.get(scenario_id) != mtime:
+      self.load(scenario_id, mtime)
+    return True
+
+  def refresh(self):
+    try:
+      folder_mtime = os.stat(self.folder).st_mtime
+    except FileNotFoundError:
+      self.scenarios.clear()
+      self.mtimes.clear()
+      self.folder_mtime = None
+      return
+    now = time.monotonic()
+    if folder_mtime == self.folder_mtime and now - self.checked_at < self.recheck_interval:
+      return
+    # In-place edits do not touch the folder mtime, so the per-file check also runs on an interval
+    scenario_ids = {
+      file_name[:-len(SCENARIO_EXTENSION)]
+      for file_name in os.listdir(self.folder)
+      if file_name.endswith(SCENARIO_EXTENSION)
+    }
+    for scenario_id in set(self.scenarios) - scenario_ids:
+      self.forget(scenario_id)
+    for scenario_id in scenario_ids:
+      self.revalidate(scenario_id)
+    self.folder_mtime = folder_mtime
+    self.checked_at = now
+
+  def get(self, scenario_id: str) -> dict:
+    if not scenario_id or os.path.basename(scenario_id) != scenario_id:
+      return None
+    return self.scenarios.get(scenario_id) if self.revalidate(scenario_id) else None
+
+  def list(self) -> list:
+    self.refresh()
+    return sorted(self.scenarios.values(), key=lambda scenario: scenario['id'])
+
+  def exists(self) -> bool:
+    return os.path.isdir(self.folder)
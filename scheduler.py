@@ -0,0 +1,175 @@
+import asyncio
+import time
+import traceback
+from collections import deque
+
+
+class TokenBucket:
+  def __init__(self, per_minute: int):
+    self.capacity = per_minute
+    self.rate = per_minute / 60
+    self.tokens = per_minute
+    self.updated = time.monotonic()
+    self.lock = asyncio.Lock()
+
+  def refill(self):
+    now = time.monotonic()
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  async def acquire(self, amount: float = 1):
+    # Sleep outside the lock, so a large reservation waiting to refill does not hold up smaller
+    # ones; the order sessions go in is FairLimiter's to decide
+    amount = min(amount, self.capacity)
+    while True:
+      async with self.lock:
+        self.refill()
+        if self.tokens >= amount:
+          self.tokens -= amount
+          return
+        wait = (amount - self.tokens) / self.rate
+      await asyncio.sleep(wait)
+
+  def adjust(self, amount: float):
+    # Settle the difference between an estimate taken up front and the real usage; may go negative
+    self.refill()
+    self.tokens -= amount
+
+
+class RateLimiter:
+  def __init__(self, rpm: int, tpm: int):
+    self.requests = TokenBucket(rpm)
+    self.tokens = TokenBucket(tpm)
+
+  async def acquire_request(self):
+    await self.requests.acquire(1)
+
+  async def acquire_tokens(self, amount: int):
+    await self.tokens.acquire(amount)
+
+  def settle_tokens(self, amount: int):
+    self.tokens.adjust(amount)
+
+
+class FairLimiter:
+  # Every session worker waits for at most one slot at a time, so granting slots
+  # in arrival order is a round-robin across sessions.
+  def __init__(self, max_concurrent: int):
+    self.available = max_concurrent
+    self.waiters = deque()
+
+  async def acquire(self, session_id: str):
+    if self.available > 0 and not self.waiters:
+      self.available -= 1
+      return
+    future = asyncio.get_running_loop().create_future()
+    self.waiters.append((session_id, future))
+    try:
+      await future
+    except asyncio.CancelledError:
+      if future.done() and not future.cancelled():
+        self.release()
+      else:
+        self.waiters.remove((session_id, future))
+      raise
+
+  def release(self):
+    while self.waiters:
+      _, future = self.waiters.popleft()
+      if not future.done():
+        future.set_result(None)
+        return
+    self.available += 1
+
+  def waiting_sessions(self) -> list:
+    return [session_id for session_id, _ in self.waiters]
+
+
+class SessionScheduler:
+  def __init__(self, process_batch, batch_ready, batch_window: float, limiter: FairLimiter, rate_limiter: RateLimiter, default_turn_tokens: int, idle_ttl: float = None):
+    self.process_batch = process_batch
+    self.batch_ready = batch_ready
+    self.batch_window = batch_window
+    self.limiter = limiter
+    self.rate_limiter = rate_limiter
+    self.default_turn_tokens = default_turn_tokens
+    self.idle_ttl = idle_ttl
+    self.queues = {}
+    self.workers = {}
+    self.last_turn_tokens = {}
+    self.in_flight = set()
+    # Payloads submitted and not yet handed to process_batch, collected batches included
+    self.waiting = {}
+
+  def submit(self, session_id: str, payload: dict):
+    if session_id not in self.queues:
+      self.queues[session_id] = asyncio.Queue()
+    self.queues[session_id].put_nowait(payload)
+    self.waiting.setdefault(session_id, []).append(payload)
+    if session_id not in self.workers or self.workers[session_id].done():
+      self.workers[session_id] = asyncio.create_task(self.worker(session_id), name=f"session-worker-{session_id}")
+
+  def is_active(self, session_id: str) -> bool:
+    return session_id in self.workers and not self.workers[session_id].done()
+
+  def queue_depth(self, session_id: str) -> int:
+    return self.queues[session_id].qsize() if session_id in self.queues else 0
+
+  def queued(self, session_id: str) -> list:
+    return list(self.waiting.get(session_id, []))
+
+  async def collect_batch(self, session_id: str) -> list:
+    queue = self.queues[session_id]
+    try:
+      batch = [await asyncio.wait_for(queue.get(), self.idle_ttl)]
+    except asyncio.TimeoutError:
+      return None
+    deadline = batch[0]['queued_at'] + self.batch_window
+    while not self.batch_ready(session_id, batch):
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        break
+      try:
+        batch.append(await asyncio.wait_for(queue.get(), remaining))
+      except asyncio.TimeoutError:
+        break
+    while not queue.empty():
+      batch.append(queue.get_nowait())
+    return batch
+
+  async def worker(self, session_id: str):
+    while True:
+      batch = await self.collect_batch(session_id)
+      if batch is None:
+        # Idle past the TTL: release the queue and let the session be rehydrated on the next submit
+        del self.queues[session_id]
+        del self.workers[session_id]
+        self.last_turn_tokens.pop(session_id, None)
+        self.waiting.pop(session_id, None)
+        print(f"[Debug] Session {session_id} worker idle, releasing.")
+        return
+      # Tokens first: a session waiting for the token budget to refill must not sit on a slot
+      # that a session with budget to spare could run in
+      estimate = self.last_turn_tokens.get(session_id, self.default_turn_tokens)
+      await self.rate_limiter.acquire_tokens(estimate)
+      await self.limiter.acquire(session_id)
+      self.in_flight.add(session_id)
+      try:
+        # A batch is the oldest payloads of the queue, so it is the front of waiting
+        del self.waiting[session_id][:len(batch)]
+        used_tokens = await self.process_batch(session_id, batch)
+        if used_tokens:
+          self.rate_limiter.settle_tokens(used_tokens - estimate)
+          self.last_turn_tokens[session_id] = used_tokens
+      except Exception as e:
+        print(f"[Error] Worker for session {session_id} failed: {e}")
+        traceback.print_exc()
+      finally:
+        self.in_flight.discard(session_id)
+        self.limiter.release()
+
+  async def shutdown(self):
+    for task in self.workers.values():
+      task.cancel()
+    await asyncio.gather(*self.workers.values(), return_exceptions=True)
+    self.workers.clear()
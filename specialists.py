@@ -0,0 +1,122 @@
+import asyncio
+import json
+import time
+import traceback
+
+from combat import wounds_of
+from run_engine import user_message
+
+
+ROUTER_TOOLS = [
+  {
+    "type": "function",
+    "function": {
+      "name": "request_checks",
+      "description": "將檢定交由檢定地城主執行。每一筆為一個獨立的檢定，會同時處理並回傳結果。",
+      "parameters": {
+        "type": "object",
+        "properties": {
+          "checks": {
+            "type": "array",
+            "items": {
+              "type": "object",
+              "properties": {
+                "character": {"type": "string", "description": "進行檢定的角色"},
+                "action": {"type": "string", "description": "角色嘗試的行動"},
+                "check_type": {"type": "string", "enum": ["single", "opposed", "threshold", "cumulative"]},
+                "attributes": {"type": "string", "description": "相關屬性值、專精與加值，對抗檢定時包含對手的屬性"},
+                "situation": {"type": "string", "description": "環境、狀態與其他影響檢定的因素，累計檢定時包含目前進度"},
+              },
+              "required": ["character", "action", "check_type", "attributes"],
+            },
+          },
+        },
+        "required": ["checks"],
+      },
+    },
+  },
+  {
+    "type": "function",
+    "function": {
+      "name": "resolve_combat_round",
+      "description": "將一個交戰回合交由戰鬥地城主執行。每一筆為一個戰鬥事件，會同時處理並回傳結果。",
+      "parameters": {
+        "type": "object",
+        "properties": {
+          "situation": {"type": "string", "description": "目前戰況、距離與地形"},
+          "events": {
+            "type": "array",
+            "items": {
+              "type": "object",
+              "properties": {
+                "actor": {"type": "string", "description": "發動事件的角色"},
+                "targets": {"type": "array", "items": {"type": "string"}},
+                "strategy": {"type": "string", "description": "發動者本回合的策略"},
+                "target_strategies": {"type": "string", "description": "目標本回合的策略"},
+                "attributes": {"type": "string", "description": "雙方相關屬性、武器、護甲與特性"},
+              },
+              "required": ["actor", "targets", "strategy", "attributes"],
+            },
+          },
+        },
+        "required": ["events"],
+      },
+    },
+  },
+]
+
+CHECK_PROMPT = "System\n主地城主請你執行以下檢定，請使用檢定工具擲骰，並簡短回報難度、屬性、骰值、最終結果與成敗：\n"
+COMBAT_PROMPT = "System\n主地城主請你執行以下戰鬥事件，請使用檢定工具擲骰，每次造成傷害都以 record_wound 記錄，並簡短回報每個檢定的結果與各部位造成的傷勢：\n"
+
+
+class SpecialistRouter:
+  def __init__(self, backend_of, rule_set: dict, on_usage=None):
+    self.backend_of = backend_of
+    self.rule_set = rule_set
+    self.on_usage = on_usage
+
+  def handles(self, name: str) -> bool:
+    return any(tool['function']['name'] == name for tool in ROUTER_TOOLS)
+
+  async def consult(self, rule_key: str, prompt: str) -> str:
+    # Every sub-task runs on its own short-lived thread so sub-tasks can run at the same time
+    # and none of the specialist chatter lands in the main thread
+    started = time.monotonic()
+    usage = None
+    try:
+      assistant_id = self.rule_set[rule_key]['assistant_id']
+      assistant_reply, run_status, error = await self.backend_of(assistant_id).run_and_fetch(None, assistant_id, [user_message(prompt)])
+      usage = getattr(run_status, 'usage', None)
+      result = error if error else assistant_reply
+    except Exception as e:
+      print(f"[Error] Specialist {rule_key} failed: {e}")
+      traceback.print_exc()
+      result = f"❌ 發生錯誤: {e}"
+    if self.on_usage:
+      self.on_usage(rule_key, usage, time.monotonic() - started)
+    return result
+
+  async def dispatch(self, name: str, arguments: dict, session: dict = None) -> dict:
+    if name == "request_checks":
+      items = arguments.get('checks', [])
+      prompts = [CHECK_PROMPT + json.dumps(item, ensure_ascii=False) for item in items]
+      rule_key = 'ability_check'
+    elif name == "resolve_combat_round":
+      items = arguments.get('events', [])
+      situation = {'situation': arguments['situation']} if arguments.get('situation') else {}
+      # The wounds come from the local ledger rather than from the main thread's memory
+      prompts = [
+        COMBAT_PROMPT + json.dumps({
+          **situation,
+          **item,
+          'wounds': wounds_of(session, [item['actor'], *item.get('targets', [])]) if session else {},
+        }, ensure_ascii=False)
+        for item in items
+      ]
+      rule_key = 'combat'
+    else:
+      return None
+
+    results = await asyncio.gather(*[self.consult(rule_key, prompt) for prompt in prompts])
+    print(f"[Debug] Routed {len(prompts)} {name} sub-tasks to {rule_key}.")
+    return {'results': [{'request': item, 'result': result} for item, result in zip(items, results)]}
@@ -0,0 +1,442 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from persistence import SAVES_FILE, CHARACTER_FOLDER, SESSION_FOLDER, SESSION_SAVE_FILE, atomic_write
+
+
+PLAYER_FOLDER = 'players'
+SQLITE_PATH = 'gpttrpg.db'
+CHARACTER_CACHE_SIZE = 1000
+CHARACTER_CACHE_BYTES = 16 * 1024 * 1024
+
+
+class Storage(ABC):
+  # Rows are handed in already serialized by Persistence and handed back decoded with `decoder`.
+  def __init__(self, decoder):
+    self.decoder = decoder
+
+  def loads(self, content: str):
+    return json.loads(content, object_hook=self.decoder)
+
+  @abstractmethod
+  def load_session(self, session_id: str) -> dict:
+    pass
+
+  @abstractmethod
+  def list_session_ids(self) -> list:
+    pass
+
+  @abstractmethod
+  def load_character(self, user_id: str, character_id: str) -> dict:
+    pass
+
+  @abstractmethod
+  def list_characters(self, user_id: str) -> list:
+    pass
+
+  @abstractmethod
+  def list_characters_in_state(self, state: str) -> list:
+    # state is the stored form of the enum, e.g. CharacterCreationState__NOT_STARTED
+    pass
+
+  @abstractmethod
+  def load_player_state(self, user_id: str) -> dict:
+    pass
+
+  @abstractmethod
+  def iter_rows(self):
+    pass
+
+  @abstractmethod
+  def write(self, kind: str, key, content: str):
+    pass
+
+  def write_all(self, writes: list) -> list:
+    failed = []
+    for kind, key, content in writes:
+      try:
+        self.write(kind, key, content)
+      except Exception as e:
+        print(f"[Error] Failed to write {kind} {key}: {e}")
+        traceback.print_exc()
+        failed.append((kind, key))
+    return failed
+
+  def close(self):
+    pass
+
+
+class JsonStorage(Storage):
+  def __init__(self, decoder):
+    super().__init__(decoder)
+    self.migrate_saves_file()
+
+  def migrate_saves_file(self):
+    # saves.json used to hold every session in one document; split it into per-session files once
+    if not os.path.exists(SAVES_FILE):
+      return
+    with open(SAVES_FILE, "r", encoding="utf-8") as f:
+      saves = json.load(f)
+    for session_id, session in saves.items():
+      if not os.path.exists(self.path('session', session_id)):
+        atomic_write(self.path('session', session_id), json.dumps(session, ensure_ascii=False, indent=2))
+    os.replace(SAVES_FILE, f"{SAVES_FILE}.migrated")
+    print(f"[Debug] Migrated {len(saves)} sessions out of {SAVES_FILE}.")
+
+  def path(self, kind: str, key) -> str:
+    if kind == 'session':
+      return os.path.join(SESSION_FOLDER, key, SESSION_SAVE_FILE)
+    if kind == 'character':
+      user_id, character_id = key
+      return os.path.join(CHARACTER_FOLDER, user_id, f"{character_id}.json")
+    return os.path.join(PLAYER_FOLDER, f"{key}.json")
+
+  def read(self, path: str):
+    if not os.path.exists(path):
+      return None
+    with open(path, "r", encoding="utf-8") as f:
+      return self.loads(f.read())
+
+  def load_session(self, session_id: str) -> dict:
+    return self.read(self.path('session', session_id))
+
+  def list_session_ids(self) -> list:
+    if not os.path.exists(SESSION_FOLDER):
+      return []
+    return sorted(
+      session_id for session_id in os.listdir(SESSION_FOLDER)
+      if os.path.exists(self.path('session', session_id))
+    )
+
+  def load_character(self, user_id: str, character_id: str) -> dict:
+    return self.read(self.path('character', (user_id, character_id)))
+
+  def list_characters(self, user_id: str) -> list:
+    user_folder = os.path.join(CHARACTER_FOLDER, user_id)
+    if not os.path.isdir(user_folder):
+      return []
+    characters = []
+    for character_file in sorted(os.listdir(user_folder)):
+      if character_file.endswith(".json") and not character_file.startswith(".tmp_"):
+        character_id = os.path.splitext(character_file)[0]
+        try:
+          character = self.load_character(user_id, character_id)
+        except Exception as e:
+          print(f"[Error] Failed to load character {character_file} for user {user_id}: {e}")
+          continue
+        characters.append((character_id, character.get('state'), character.get('data', {}).get('name')))
+    return characters
+
+  def list_characters_in_state(self, state: str) -> list:
+    characters = []
+    if not os.path.exists(CHARACTER_FOLDER):
+      return characters
+    for user_id in sorted(os.listdir(CHARACTER_FOLDER)):
+      user_folder = os.path.join(CHARACTER_FOLDER, user_id)
+      if not os.path.isdir(user_folder):
+        continue
+      for character_file in sorted(os.listdir(user_folder)):
+        if character_file.endswith(".json") and not character_file.startswith(".tmp_"):
+          try:
+            with open(os.path.join(user_folder, character_file), "r", encoding="utf-8") as f:
+              stored_state = json.load(f).get('state')
+          except Exception as e:
+            print(f"[Error] Failed to read character {character_file} for user {user_id}: {e}")
+            continue
+          if stored_state == state:
+            characters.append((user_id, os.path.splitext(character_file)[0]))
+    return characters
+
+  def load_player_state(self, user_id: str) -> dict:
+    return self.read(self.path('player_state', user_id))
+
+  def iter_rows(self):
+    for session_id in self.list_session_ids():
+      with open(self.path('session', session_id), "r", encoding="utf-8") as f:
+        yield 'session', session_id, f.read()
+    if os.path.exists(CHARACTER_FOLDER):
+      for user_id in sorted(os.listdir(CHARACTER_FOLDER)):
+        user_folder = os.path.join(CHARACTER_FOLDER, user_id)
+        if not os.path.isdir(user_folder):
+          continue
+        for character_file in sorted(os.listdir(user_folder)):
+          if character_file.endswith(".json") and not character_file.startswith(".tmp_"):
+            with open(os.path.join(user_folder, character_file), "r", encoding="utf-8") as f:
+              yield 'character', (user_id, os.path.splitext(character_file)[0]), f.read()
+    if os.path.exists(PLAYER_FOLDER):
+      for player_file in sorted(os.listdir(PLAYER_FOLDER)):
+        if player_file.endswith(".json") and not player_file.startswith(".tmp_"):
+          with open(os.path.join(PLAYER_FOLDER, player_file), "r", encoding="utf-8") as f:
+            yield 'player_state', os.path.splitext(player_file)[0], f.read()
+
+  def write(self, kind: str, key, content: str):
+    path = self.path(kind, key)
+    if content is None:
+      if os.path.exists(path):
+        os.remove(path)
+    else:
+      atomic_write(path, content)
+
+
+class SqliteStorage(Storage):
+  def __init__(self, decoder, path: str = SQLITE_PATH):
+    super().__init__(decoder)
+    # Writes come from Persistence's worker thread, reads from the event loop
+    self.connection = sqlite3.connect(path, check_same_thread=False)
+    self.lock = threading.Lock()
+    with self.lock:
+      self.connection.execute("PRAGMA journal_mode=WAL")
+      self.connection.execute("PRAGMA synchronous=NORMAL")
+      self.connection.executescript("""
+        CREATE TABLE IF NOT EXISTS sessions (
+          session_id TEXT PRIMARY KEY,
+          state TEXT,
+          data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS characters (
+          user_id TEXT NOT NULL,
+          character_id TEXT NOT NULL,
+          state TEXT,
+          name TEXT,
+          data TEXT NOT NULL,
+          PRIMARY KEY (user_id, character_id)
+        );
+        CREATE INDEX IF NOT EXISTS characters_state ON characters (state);
+        CREATE TABLE IF NOT EXISTS player_states (
+          user_id TEXT PRIMARY KEY,
+          session_id TEXT,
+          data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS player_states_session ON player_states (session_id);
+      """)
+      self.connection.commit()
+
+  def fetch_one(self, query: str, params: tuple):
+    with self.lock:
+      row = self.connection.execute(query, params).fetchone()
+    return self.loads(row[0]) if row else None
+
+  def load_session(self, session_id: str) -> dict:
+    return self.fetch_one("SELECT data FROM sessions WHERE session_id = ?", (session_id,))
+
+  def list_session_ids(self) -> list:
+    with self.lock:
+      rows = self.connection.execute("SELECT session_id FROM sessions ORDER BY session_id").fetchall()
+    return [row[0] for row in rows]
+
+  def load_character(self, user_id: str, character_id: str) -> dict:
+    return self.fetch_one("SELECT data FROM characters WHERE user_id = ? AND character_id = ?", (user_id, character_id))
+
+  def list_characters(self, user_id: str) -> list:
+    with self.lock:
+      rows = self.connection.execute(
+        "SELECT character_id, state, name FROM characters WHERE user_id = ? ORDER BY character_id",
+        (user_id,),
+      ).fetchall()
+    # The state column holds the stored form of the enum; the decoder maps it back as it would inside a row
+    return [(character_id, self.decoder({'state': state})['state'], name) for character_id, state, name in rows]
+
+  def list_characters_in_state(self, state: str) -> list:
+    with self.lock:
+      rows = self.connection.execute("SELECT user_id, character_id FROM characters WHERE state = ?", (state,)).fetchall()
+    return [(user_id, character_id) for user_id, character_id in rows]
+
+  def load_player_state(self, user_id: str) -> dict:
+    return self.fetch_one("SELECT data FROM player_states WHERE user_id = ?", (user_id,))
+
+  def iter_rows(self):
+    with self.lock:
+      sessions = self.connection.execute("SELECT session_id, data FROM sessions").fetchall()
+      characters = self.connection.execute("SELECT user_id, character_id, data FROM characters").fetchall()
+      player_states = self.connection.execute("SELECT user_id, data FROM player_states").fetchall()
+    for session_id, data in sessions:
+      yield 'session', session_id, data
+    for user_id, character_id, data in characters:
+      yield 'character', (user_id, character_id), data
+    for user_id, data in player_states:
+      yield 'player_state', user_id, data
+
+  def write(self, kind: str, key, content: str):
+    with self.lock, self.connection:
+      if kind == 'session':
+        if content is None:
+          self.connection.execute("DELETE FROM sessions WHERE session_id = ?", (key,))
+        else:
+          self.connection.execute(
+            "INSERT OR REPLACE INTO sessions (session_id, state, data) VALUES (?, ?, ?)",
+            (key, json.loads(content).get('state'), content),
+          )
+      elif kind == 'character':
+        user_id, character_id = key
+        if content is None:
+          self.connection.execute("DELETE FROM characters WHERE user_id = ? AND character_id = ?", (user_id, character_id))
+        else:
+          character = json.loads(content)
+          self.connection.execute(
+            "INSERT OR REPLACE INTO characters (user_id, character_id, state, name, data) VALUES (?, ?, ?, ?, ?)",
+            (user_id, character_id, character.get('state'), (character.get('data') or {}).get('name'), content),
+          )
+      else:
+        if content is None:
+          self.connection.execute("DELETE FROM player_states WHERE user_id = ?", (key,))
+        else:
+          self.connection.execute(
+            "INSERT OR REPLACE INTO player_states (user_id, session_id, data) VALUES (?, ?, ?)",
+            (key, json.loads(content).get('session_id'), content),
+          )
+
+  def close(self):
+    with self.lock:
+      self.connection.close()
+
+
+class LazyRows(dict):
+  # A dict that pulls missing rows from storage on first access and remembers deletions
+  # until they are flushed, so callers can keep using plain dict operations.
+  def __init__(self, load):
+    super().__init__()
+    self.load = load
+    self.deleted = set()
+    self.accessed = {}
+
+  def __missing__(self, key):
+    if key in self.deleted:
+      raise KeyError(key)
+    row = self.load(key)
+    if row is None:
+      raise KeyError(key)
+    dict.__setitem__(self, key, row)
+    return row
+
+  def __getitem__(self, key):
+    row = dict.__getitem__(self, key)
+    self.accessed[key] = time.monotonic()
+    return row
+
+  def __contains__(self, key):
+    if dict.__contains__(self, key):
+      return True
+    try:
+      self[key]
+      return True
+    except KeyError:
+      return False
+
+  def __setitem__(self, key, value):
+    self.deleted.discard(key)
+    self.accessed[key] = time.monotonic()
+    dict.__setitem__(self, key, value)
+
+  def __delitem__(self, key):
+    if key in self:
+      dict.__delitem__(self, key)
+    self.accessed.pop(key, None)
+    self.deleted.add(key)
+
+  def evict(self, key):
+    # Drop the resident copy only; storage still has the row and reloads it on next access
+    dict.pop(self, key, None)
+    self.accessed.pop(key, None)
+
+  def idle_keys(self, ttl: float) -> list:
+    now = time.monotonic()
+    return [key for key in self.keys() if now - self.accessed.get(key, 0) > ttl]
+
+
+class CachedRows(LazyRows):
+  def __init__(self, cache, user_id: str):
+    super().__init__(lambda character_id: cache.storage.load_character(user_id, character_id))
+    self.cache = cache
+    self.user_id = user_id
+
+  def __getitem__(self, character_id):
+    character = super().__getitem__(character_id)
+    self.cache.touch(self.user_id, character_id, character)
+    return character
+
+  def __setitem__(self, character_id, character):
+    super().__setitem__(character_id, character)
+    self.cache.touch(self.user_id, character_id, character)
+
+  def __delitem__(self, character_id):
+    super().__delitem__(character_id)
+    self.cache.forget(self.user_id, character_id)
+
+
+class CharacterCache(dict):
+  # user_id -> CachedRows, with one LRU across every user's resident characters
+  def __init__(self, storage: Storage, max_entries: int = CHARACTER_CACHE_SIZE, max_bytes: int = CHARACTER_CACHE_BYTES, can_evict=None):
+    super().__init__()
+    self.storage = storage
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.can_evict = can_evict
+    self.lru = OrderedDict()
+    self.resident_bytes = 0
+
+  def __missing__(self, user_id):
+    characters = CachedRows(self, user_id)
+    dict.__setitem__(self, user_id, characters)
+    return characters
+
+  def __contains__(self, user_id):
+    # A user has characters if any are resident, or stored and not deleted since the last flush
+    characters = dict.get(self, user_id)
+    if characters:
+      return True
+    deleted = characters.deleted if characters is not None else set()
+    return any(character_id not in deleted for character_id, _, _ in self.storage.list_characters(user_id))
+
+  def __setitem__(self, user_id, characters):
+    user_characters = self[user_id]
+    for character_id, character in characters.items():
+      user_characters[character_id] = character
+
+  def touch(self, user_id: str, character_id: str, character: dict):
+    key = (user_id, character_id)
+    if key in self.lru:
+      self.lru.move_to_end(key)
+      return
+    size = len(json.dumps(character, ensure_ascii=False, default=str))
+    self.lru[key] = size
+    self.resident_bytes += size
+    self.evict_over_budget()
+
+  def resize(self, user_id: str, character_id: str, size: int):
+    # A character starts out as a bare NOT_STARTED row and grows as it is created, so its size
+    # is taken again whenever Persistence serializes it. Nothing is evicted here: the row may
+    # not have reached storage yet, and the next touch enforces the budget.
+    key = (user_id, character_id)
+    if key in self.lru:
+      self.resident_bytes += size - self.lru[key]
+      self.lru[key] = size
+
+  def forget(self, user_id: str, character_id: str):
+    self.resident_bytes -= self.lru.pop((user_id, character_id), 0)
+
+  def evict_over_budget(self):
+    # Never evict the entry that was just touched; its caller is still holding it
+    for key in list(self.lru.keys())[:-1]:
+      if len(self.lru) <= self.max_entries and self.resident_bytes <= self.max_bytes:
+        return
+      if self.can_evict and not self.can_evict(*key):
+        continue
+      user_id, character_id = key
+      characters = dict.__getitem__(self, user_id)
+      characters.evict(character_id)
+      self.forget(user_id, character_id)
+      # Keep the user's rows if they remember deletions; Persistence only deletes what they list
+      if not characters and not characters.deleted:
+        dict.pop(self, user_id)
+
+
+def create_storage(kind: str, decoder, sqlite_path: str = SQLITE_PATH) -> Storage:
+  if kind == 'sqlite':
+    return SqliteStorage(decoder, sqlite_path)
+  return JsonStorage(decoder)
@@ -0,0 +1,74 @@
+import time
+
+from metrics import STAGE_SECONDS
+
+
+DISCORD_MESSAGE_LIMIT = 2000
+STREAM_EDIT_INTERVAL_MS = 1200
+STREAM_EDIT_MIN_CHARS = 40
+
+
+def split_message(content: str, limit: int = DISCORD_MESSAGE_LIMIT) -> list:
+  chunks = []
+  while len(content) > limit:
+    cut = content.rfind("\n", 0, limit)
+    if cut <= 0:
+      cut = limit
+    chunks.append(content[:cut])
+    content = content[cut:].lstrip("\n")
+  chunks.append(content)
+  return chunks
+
+
+class ChannelFollowup:
+  # Stands in for an interaction's followup webhook once the interaction is gone, e.g. for turns
+  # answered after a restart; there is no ephemeral reply to a channel
+  def __init__(self, channel):
+    self.channel = channel
+
+  async def send(self, content: str, ephemeral: bool = False, wait: bool = False):
+    return await self.channel.send(content)
+
+
+class NarrationReply:
+  def __init__(self, followup, header: str = "", streaming: bool = False, interval_ms: int = STREAM_EDIT_INTERVAL_MS, min_chars: int = STREAM_EDIT_MIN_CHARS):
+    self.followup = followup
+    self.header = header
+    self.streaming = streaming
+    self.interval = interval_ms / 1000
+    self.min_chars = min_chars
+    self.message = None
+    self.last_edit = 0
+    self.last_length = 0
+
+  async def update(self, text: str):
+    if not self.streaming:
+      return
+
+    now = time.monotonic()
+    if self.message is not None:
+      if now - self.last_edit < self.interval or len(text) - self.last_length < self.min_chars:
+        return
+
+    content = f"{self.header}{text}"
+    if len(content) > DISCORD_MESSAGE_LIMIT:
+      content = content[:DISCORD_MESSAGE_LIMIT - 1] + "…"
+
+    with STAGE_SECONDS.time("followup_send"):
+      if self.message is None:
+        self.message = await self.followup.send(content, wait=True)
+      else:
+        await self.message.edit(content=content)
+    self.last_edit = now
+    self.last_length = len(text)
+
+  async def finish(self, content: str, ephemeral: bool = False):
+    chunks = split_message(content)
+    with STAGE_SECONDS.time("followup_send"):
+      if self.message is None:
+        self.message = await self.followup.send(chunks[0], ephemeral=ephemeral, wait=True)
+      else:
+        await self.message.edit(content=chunks[0])
+      for chunk in chunks[1:]:
+        await self.followup.send(chunk, ephemeral=ephemeral)
+    return self.message
@@ -0,0 +1,471 @@
+import asyncio
+import copy
+import json
+import math
+import os
+import random
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from openai import NotFoundError
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+import tracing
+from scheduler import TokenBucket
+from usage import estimate_tokens
+
+
+def fake_reply(assistant_name: str, user_texts: list) -> str:
+  # Character creation finishes on the second message so players can go on to join
+  if assistant_name == "GPTTRPG_character_creation" and len(user_texts) >= 2:
+    character = {'name': f"角色{len(user_texts)}", 'house': "無", 'stats': {'力量': 5}}
+    return f"角色已完成。START_OF_CHARACTER\n{json.dumps(character, ensure_ascii=False)}\nEND_OF_CHARACTER"
+  return f"（測試敘事）{user_texts[-1][:60] if user_texts else ''}"
+
+
+class FakeList:
+  # Like the SDK's paginators: awaitable for one page, async-iterable for every item
+  def __init__(self, server, endpoint: str, items, limit: int = None):
+    self.server = server
+    self.endpoint = endpoint
+    self.items = items
+    self.limit = limit
+
+  async def page(self):
+    await self.server.request(self.endpoint)
+    return SimpleNamespace(data=self.items()[:self.limit])
+
+  def __await__(self):
+    return self.page().__await__()
+
+  async def __aiter__(self):
+    await self.server.request(self.endpoint)
+    for item in self.items():
+      yield item
+
+
+class FakeRunStream:
+  def __init__(self, server, start):
+    self.server = server
+    self.start = start
+    self.run = None
+
+  async def __aenter__(self):
+    self.run = await self.start
+    return self
+
+  async def __aexit__(self, *exc_info):
+    return False
+
+  @property
+  async def text_deltas(self):
+    await self.server.wait_for(self.run)
+    reply = self.server.finish(self.run)
+    for start in range(0, len(reply or ""), 20):
+      yield reply[start:start + 20]
+
+  @property
+  def current_run(self):
+    return self.server.run_status(self.run) if self.run else None
+
+  async def get_final_run(self):
+    await self.server.wait_for(self.run)
+    self.server.finish(self.run)
+    return self.server.run_status(self.run)
+
+
+class FakeAssistantsServer:
+  # In-process stand-in for the Assistants and Files endpoints the bot calls. Every request costs
+  # request_latency; a run completes run_latency (with jitter) after it is created. With manual,
+  # a run, the bot's own FakeBackend completions included, only completes once release() is
+  # called on it, and every run is handed to next_run() as it starts.
+  def __init__(self, run_latency: float = 2.0, request_latency: float = 0.05, prompt_tokens: int = 800, completion_tokens: int = 300, failure_rate: float = 0, jitter: float = 0.5, seed: int = 0, manual: bool = False):
+    self.run_latency = run_latency
+    self.request_latency = request_latency
+    self.prompt_tokens = prompt_tokens
+    self.completion_tokens = completion_tokens
+    self.failure_rate = failure_rate
+    self.jitter = jitter
+    self.random = random.Random(seed)
+    self.assistants = {}
+    self.threads = {}
+    self.runs = {}
+    self.last_runs = {}
+    self.files = {}
+    self.requests = Counter()
+    self.runs_by_assistant = Counter()
+    self.violations = []
+    self.next_id = 0
+    self.manual = manual
+    self.started = asyncio.Queue()
+
+  def new_id(self, prefix: str) -> str:
+    self.next_id += 1
+    return f"{prefix}_{self.next_id}"
+
+  async def request(self, endpoint: str):
+    self.requests[endpoint] += 1
+    if self.request_latency:
+      await asyncio.sleep(self.request_latency)
+
+  def active_run(self, thread_id: str):
+    run = self.last_runs.get(thread_id)
+    if run is None:
+      return None
+    self.finish(run)
+    return None if run['finished'] else run
+
+  def message(self, thread_id: str, role: str, content: str, attachments: list = None, run_id: str = None):
+    message = SimpleNamespace(
+      id=self.new_id("msg"),
+      role=role,
+      run_id=run_id,
+      status="completed",
+      content=[SimpleNamespace(type="text", text=SimpleNamespace(value=content))],
+      attachments=[SimpleNamespace(file_id=attachment['file_id']) for attachment in attachments or []],
+    )
+    self.threads[thread_id].append(message)
+    return message
+
+  def new_thread(self, messages: list = None) -> str:
+    thread_id = self.new_id("thread")
+    self.threads[thread_id] = []
+    for message in messages or []:
+      self.message(thread_id, message.get('role', "user"), message['content'], message.get('attachments'))
+    return thread_id
+
+  def start_run(self, thread_id: str, assistant_id: str, messages: list = None) -> dict:
+    # The real API rejects a run or a message on a thread whose run is still going
+    if self.active_run(thread_id):
+      self.violations.append(f"run started on {thread_id} while {self.active_run(thread_id)['id']} is active")
+    for message in messages or []:
+      self.message(thread_id, message.get('role', "user"), message['content'], message.get('attachments'))
+    latency = self.run_latency * (1 + self.jitter * (2 * self.random.random() - 1))
+    run = {
+      'id': self.new_id("run"),
+      'thread_id': thread_id,
+      'assistant': self.assistants.get(assistant_id, assistant_id),
+      'created_at': int(time.time()),
+      'started_at': time.monotonic() + latency * 0.2,
+      'done_at': time.monotonic() + latency,
+      'failed': self.random.random() < self.failure_rate,
+      'finished': False,
+      'reply': None,
+    }
+    if self.manual:
+      self.hold(run)
+    self.runs[run['id']] = run
+    self.last_runs[thread_id] = run
+    self.runs_by_assistant[run['assistant']] += 1
+    return run
+
+  def hold(self, run: dict):
+    run['done_at'] = math.inf
+    run['released'] = asyncio.Event()
+    self.started.put_nowait(run)
+
+  def release(self, run: dict):
+    run['done_at'] = time.monotonic()
+    run['released'].set()
+
+  async def next_run(self) -> dict:
+    return await self.started.get()
+
+  def reply_for(self, run: dict) -> str:
+    return fake_reply(run['assistant'], [message.content[0].text.value for message in self.threads[run['thread_id']] if message.role == "user"])
+
+  async def local_reply(self, spec: dict, messages: list) -> str:
+    # Replies for the bot's own FakeBackend, counted alongside the server's runs
+    self.runs_by_assistant[spec['name']] += 1
+    if self.manual:
+      run = {'id': self.new_id("completion"), 'thread_id': None, 'assistant': spec['name']}
+      self.hold(run)
+      await run['released'].wait()
+    if self.random.random() < self.failure_rate:
+      raise RuntimeError("injected failure")
+    return fake_reply(spec['name'], [message['content'] for message in messages if message['role'] == "user"])
+
+  def finish(self, run: dict) -> str:
+    if not run['finished'] and time.monotonic() >= run['done_at']:
+      run['finished'] = True
+      if not run['failed']:
+        run['reply'] = self.reply_for(run)
+        self.message(run['thread_id'], "assistant", run['reply'], run_id=run['id'])
+    return run['reply']
+
+  async def wait_for(self, run: dict):
+    if 'released' in run:
+      await run['released'].wait()
+    else:
+      await asyncio.sleep(max(0, run['done_at'] - time.monotonic()))
+
+  def run_status(self, run: dict):
+    self.finish(run)
+    if not run['finished']:
+      status = "queued" if time.monotonic() < run['started_at'] else "in_progress"
+    else:
+      status = "failed" if run['failed'] else "completed"
+    context = sum(estimate_tokens(message.content[0].text.value) for message in self.threads[run['thread_id']])
+    prompt_tokens = self.prompt_tokens + context
+    return SimpleNamespace(
+      id=run['id'],
+      thread_id=run['thread_id'],
+      status=status,
+      created_at=run['created_at'],
+      required_action=None,
+      usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=self.completion_tokens, total_tokens=prompt_tokens + self.completion_tokens),
+    )
+
+  async def create_assistant(self, name: str, **spec):
+    await self.request("assistants.create")
+    assistant_id = self.new_id("asst")
+    self.assistants[assistant_id] = name
+    return SimpleNamespace(id=assistant_id, name=name, metadata=spec.get('metadata'))
+
+  async def retrieve_assistant(self, assistant_id: str):
+    await self.request("assistants.retrieve")
+    if assistant_id not in self.assistants:
+      raise NotFoundError(f"No assistant found with id '{assistant_id}'.", response=SimpleNamespace(request=None, status_code=404, headers={}), body=None)
+    return SimpleNamespace(id=assistant_id, name=self.assistants[assistant_id])
+
+  def list_assistants(self, **options):
+    return FakeList(self, "assistants.list", lambda: [])
+
+  async def create_thread(self, messages: list = None):
+    await self.request("threads.create")
+    return SimpleNamespace(id=self.new_thread(messages))
+
+  async def create_message(self, thread_id: str, role: str, content: str, attachments: list = []):
+    await self.request("messages.create")
+    if self.active_run(thread_id):
+      self.violations.append(f"message added to {thread_id} while a run is active")
+    return self.message(thread_id, role, content, attachments)
+
+  def list_messages(self, thread_id: str, order: str = "desc", after: str = None, limit: int = 20, run_id: str = None):
+    def items():
+      messages = [message for message in self.threads[thread_id] if run_id is None or message.run_id == run_id]
+      if after:
+        ids = [message.id for message in messages]
+        messages = messages[ids.index(after) + 1:] if after in ids else messages
+      return messages if order == "asc" else messages[::-1]
+    return FakeList(self, "messages.list", items, limit)
+
+  async def create_and_run(self, assistant_id: str, thread: dict):
+    await self.request("threads.create_and_run")
+    run = self.start_run(self.new_thread(thread.get('messages')), assistant_id)
+    return SimpleNamespace(id=run['id'], thread_id=run['thread_id'])
+
+  async def create_run(self, thread_id: str, assistant_id: str, additional_messages: list = None):
+    await self.request("runs.create")
+    run = self.start_run(thread_id, assistant_id, additional_messages)
+    return SimpleNamespace(id=run['id'], thread_id=run['thread_id'])
+
+  async def retrieve_run(self, thread_id: str, run_id: str):
+    await self.request("runs.retrieve")
+    if self.manual:
+      # A held run answers the poll once it is released, so polling never outruns the test
+      await self.wait_for(self.runs[run_id])
+    return self.run_status(self.runs[run_id])
+
+  def list_runs(self, thread_id: str, order: str = "desc", limit: int = 20):
+    def items():
+      runs = [self.run_status(run) for run in self.runs.values() if run['thread_id'] == thread_id]
+      return runs if order == "asc" else runs[::-1]
+    return FakeList(self, "runs.list", items, limit)
+
+  async def start_stream(self, endpoint: str, thread_id: str, assistant_id: str, messages: list = None):
+    await self.request(endpoint)
+    if thread_id is None:
+      thread_id = self.new_thread(messages)
+      messages = None
+    return self.start_run(thread_id, assistant_id, messages)
+
+  def stream_run(self, thread_id: str, assistant_id: str, additional_messages: list = None):
+    return FakeRunStream(self, self.start_stream("runs.stream", thread_id, assistant_id, additional_messages))
+
+  def create_and_run_stream(self, assistant_id: str, thread: dict):
+    return FakeRunStream(self, self.start_stream("threads.create_and_run_stream", None, assistant_id, thread.get('messages')))
+
+  async def create_file(self, file, purpose: str):
+    await self.request("files.create")
+    file_id = self.new_id("file")
+    self.files[file_id] = SimpleNamespace(id=file_id, filename=file.name, created_at=time.time())
+    return self.files[file_id]
+
+  def list_files(self, purpose: str = None):
+    return FakeList(self, "files.list", lambda: list(self.files.values()))
+
+  async def delete_file(self, file_id: str):
+    await self.request("files.delete")
+    self.files.pop(file_id, None)
+
+  def client(self):
+    return SimpleNamespace(
+      beta=SimpleNamespace(
+        assistants=SimpleNamespace(list=self.list_assistants, create=self.create_assistant, retrieve=self.retrieve_assistant),
+        threads=SimpleNamespace(
+          create=self.create_thread,
+          create_and_run=self.create_and_run,
+          create_and_run_stream=self.create_and_run_stream,
+          messages=SimpleNamespace(create=self.create_message, list=self.list_messages),
+          runs=SimpleNamespace(create=self.create_run, retrieve=self.retrieve_run, list=self.list_runs, stream=self.stream_run),
+        ),
+      ),
+      files=SimpleNamespace(create=self.create_file, list=self.list_files, delete=self.delete_file),
+    )
+
+
+class FakeFollowup:
+  def __init__(self):
+    self.events = []
+
+  def record(self, content: str):
+    self.events.append((time.monotonic(), content))
+
+  async def send(self, content: str, ephemeral: bool = False, wait: bool = False):
+    self.record(content)
+    return FakeMessage(self)
+
+
+class FakeMessage:
+  def __init__(self, followup: FakeFollowup):
+    self.followup = followup
+    self.jump_url = "https://discord.invalid/message"
+
+  async def edit(self, content: str):
+    self.followup.record(content)
+
+
+class FakeResponse:
+  def __init__(self, followup: FakeFollowup):
+    self.followup = followup
+
+  async def send_message(self, content: str, ephemeral: bool = False):
+    self.followup.record(content)
+
+  async def defer(self):
+    pass
+
+
+class FakeInteraction:
+  def __init__(self, channel_id: int, user_id: int, user_name: str):
+    self.channel = SimpleNamespace(id=channel_id)
+    self.user = SimpleNamespace(id=user_id, name=user_name)
+    self.followup = FakeFollowup()
+    self.response = FakeResponse(self.followup)
+    self.created_at = time.monotonic()
+
+  def latency(self) -> float:
+    return self.followup.events[-1][0] - self.created_at if self.followup.events else None
+
+  def failed(self) -> bool:
+    return any(content.startswith("❌") for _, content in self.followup.events)
+
+
+def enter_workdir(workdir: str):
+  os.chdir(workdir)
+  if not os.path.exists("instructions"):
+    os.symlink(os.path.join(ROOT, "instructions"), "instructions")
+
+def import_bot(workdir: str):
+  # bot.py reads its configs next to itself but keeps state relative to the working directory
+  enter_workdir(workdir)
+  os.environ.setdefault("OPENAI_API_KEY", "offline-load-test")
+  import bot
+  return bot
+
+async def build_client(bot, server: FakeAssistantsServer, workdir: str, backend: str = "assistants", streaming: bool = True, poll_interval: float = 1.0, rpm: int = 500, tpm: int = 300000, batch_window: float = 2.0, run_latency: float = 0, summary_threshold: int = 0, trace: str = None):
+  # Building a second client over the workdir of an earlier one starts the bot again over what
+  # that one left on disk
+  enter_workdir(workdir)
+  client = bot.GPTTRPG()
+  # Replies of recovered work go to the channel rather than to an interaction
+  channel = FakeFollowup()
+  client.channel_events = channel.events
+  client.get_channel = lambda channel_id: channel
+  client.rule_set = copy.deepcopy(bot.RULE_SET)
+  client.specialist_router.rule_set = client.rule_set
+  for rule in client.rule_set.values():
+    rule['backend'] = backend
+    rule['streaming'] = rule.get('streaming', False) and streaming
+  if summary_threshold:
+    client.rule_set['main']['summary_threshold_token'] = summary_threshold
+  fake = server.client()
+  client.openAIClient = fake
+  client.run_engine.client = fake
+  client.upload_cache.client = fake
+  client.run_engine.poll_interval = poll_interval
+  client.rate_limiter.requests = TokenBucket(rpm)
+  client.rate_limiter.tokens = TokenBucket(tpm)
+  client.scheduler.batch_window = batch_window
+  client.backends['fake'].delay = run_latency
+  client.backends['fake'].reply = server.local_reply
+  await client.setup_assistants()
+  if trace:
+    tracing.configure(trace)
+  client.persistence_task = asyncio.create_task(client.persistence.run())
+  return client
+
+async def shutdown(client):
+  await client.scheduler.shutdown()
+  for task in list(client.summary_tasks.values()):
+    task.cancel()
+  client.persistence_task.cancel()
+  await client.persistence.flush()
+  client.storage.close()
+  if tracing.exporter:
+    await tracing.exporter.flush()
+
+
+async def until(predicate):
+  # Yields to the loop until predicate holds; callers bound the wait with a timeout
+  while not predicate():
+    await asyncio.sleep(0)
+
+def settled(client) -> bool:
+  # Every queued turn has been answered once its journal entry is closed
+  return not client.journal.entries and not client.scheduler.in_flight
+
+
+class Releaser:
+  # Releases a manual server's runs as they start, except those of the assistants in hold,
+  # which wait in held until release_held()
+  def __init__(self, server: FakeAssistantsServer, hold: set = ()):
+    self.server = server
+    self.hold = set(hold)
+    self.held = []
+    self.task = None
+
+  async def run(self):
+    while True:
+      run = await self.server.next_run()
+      if run['assistant'] in self.hold:
+        self.held.append(run)
+      else:
+        self.server.release(run)
+
+  def start(self):
+    self.task = asyncio.create_task(self.run())
+
+  def stop(self):
+    self.task.cancel()
+
+  def release_held(self):
+    held, self.held = self.held, []
+    for run in held:
+      self.server.release(run)
+
+
+async def thread_plays(client, session_id: str, user_id: int, thread_id: str = None) -> list:
+  # What user_id played into a session thread, through whichever backend holds the thread
+  session = client.saves[session_id]
+  backend = client.backend_of(session['assistant_id'])
+  prefix = f"User ID:{user_id}\n"
+  plays = []
+  for message in await backend.list_messages(thread_id or session['thread_id']):
+    text = client.message_text(message)
+    if message.role == "user" and text.startswith(prefix):
+      plays.append(text[len(prefix):])
+  return plays
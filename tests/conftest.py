@@ -0,0 +1,13 @@
+import pytest
+
+from testing.fakes import import_bot
+
+
+@pytest.fixture(scope="session")
+def bot(tmp_path_factory):
+  return import_bot(str(tmp_path_factory.mktemp("bot")))
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  return str(tmp_path)
@@ -0,0 +1,32 @@
+import asyncio
+
+from testing.fakes import FakeAssistantsServer, FakeInteraction, build_client, settled, until
+
+
+# Only bounds a hang; nothing waits on the clock for an outcome
+TIMEOUT = 60
+JOIN_MESSAGE = "我推開酒館的門。"
+
+
+def drive(coro):
+  return asyncio.run(asyncio.wait_for(coro, TIMEOUT))
+
+def action(turn: int) -> str:
+  return f"第 {turn} 個行動"
+
+async def new_client(bot, server: FakeAssistantsServer, workdir: str, backend: str = "assistants", summary_threshold: int = 0):
+  return await build_client(bot, server, workdir, backend=backend, poll_interval=0, rpm=10 ** 9, tpm=10 ** 9, batch_window=0, summary_threshold=summary_threshold)
+
+async def join_player(bot, client, session_id: str, user_id: int):
+  def interaction():
+    return FakeInteraction(bot.CHANNEL_ID, user_id, f"player{user_id}")
+
+  await client.create_character(interaction(), f"c{user_id}")
+  await client.play(interaction(), "我是一名來自北境的騎士。")
+  await client.join(interaction(), session_id, f"c{user_id}", JOIN_MESSAGE)
+
+async def start_session(bot, client, session_id: str, user_ids: list):
+  await client.start_game(FakeInteraction(bot.CHANNEL_ID, 1, "host"), session_id)
+  for user_id in user_ids:
+    await join_player(bot, client, session_id, user_id)
+  await until(lambda: settled(client))
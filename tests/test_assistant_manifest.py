@@ -0,0 +1,37 @@
+from assistant_manifest import load_manifest, reconcile_assistants
+from testing.fakes import FakeAssistantsServer
+from tests.helpers import drive
+
+
+SPECS = {
+  key: {'name': f"GPTTRPG_{key}", 'model': "gpt-4o-mini", 'metadata': {'version': "1"}, 'instructions': key, 'tools': []}
+  for key in ("main", "summary")
+}
+
+
+def test_manifest_assistants_are_reused_while_they_exist(workdir):
+  async def scenario():
+    server = FakeAssistantsServer(request_latency=0)
+    first = await reconcile_assistants(server.client(), SPECS)
+    created = server.requests["assistants.create"]
+    second = await reconcile_assistants(server.client(), SPECS)
+    return first, second, created, server.requests["assistants.create"]
+
+  first, second, created, created_after = drive(scenario())
+  assert second == first
+  assert created == created_after == 2
+
+
+def test_assistant_deleted_remotely_is_created_again(workdir):
+  async def scenario():
+    server = FakeAssistantsServer(request_latency=0)
+    first = await reconcile_assistants(server.client(), SPECS)
+    # Deleted from the dashboard; the manifest still names it
+    del server.assistants[first['main']]
+    second = await reconcile_assistants(server.client(), SPECS)
+    return first, second, load_manifest()
+
+  first, second, manifest = drive(scenario())
+  assert second['main'] != first['main']
+  assert second['summary'] == first['summary']
+  assert {key: entry['assistant_id'] for key, entry in manifest.items()} == second
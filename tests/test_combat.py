@@ -0,0 +1,134 @@
+import pytest
+
+from combat import begin_round, end_combat, handle_combat_tool, ledger_summary, pending_players, record_strategy, record_wound, start_combat, wounds_of
+from testing.fakes import FakeAssistantsServer, FakeInteraction, Releaser, settled, shutdown, thread_plays, until
+from tests.helpers import JOIN_MESSAGE, drive, new_client, start_session
+
+
+PARTICIPANTS = [
+  {'name': "騎士", 'side': "玩家", 'user_id': "1000"},
+  {'name': "弓手", 'side': "玩家", 'user_id': "1001"},
+  {'name': "野狼", 'side': "野獸"},
+]
+
+def fight() -> dict:
+  session = {}
+  start_combat(session, "酒館門口", PARTICIPANTS)
+  return session
+
+
+def test_wounds_on_different_parts_stack():
+  session = fight()
+  record_wound(session, "騎士", "左手臂", "輕傷", "咬傷")
+  record_wound(session, "騎士", "頭部", "重傷", "撞擊")
+  assert wounds_of(session, ["騎士"]) == {"騎士": {"左手臂": "輕傷", "頭部": "重傷"}}
+
+
+def test_a_new_level_on_the_same_part_replaces_the_old_one():
+  session = fight()
+  record_wound(session, "騎士", "左手臂", "輕傷", "咬傷")
+  change = record_wound(session, "騎士", "左手臂", "重傷", "再次咬傷")
+  assert change == {'character': "騎士", 'part': "左手臂", 'from': "輕傷", 'to': "重傷", 'reason': "再次咬傷"}
+  assert wounds_of(session, ["騎士"])["騎士"] == {"左手臂": "重傷"}
+
+
+def test_healing_to_unhurt_clears_the_part():
+  session = fight()
+  record_wound(session, "騎士", "左手臂", "重傷", "咬傷")
+  change = record_wound(session, "騎士", "左手臂", "無傷", "包紮")
+  assert change['from'] == "重傷" and change['to'] == "無傷"
+  assert wounds_of(session, ["騎士"])["騎士"] == {}
+
+
+def test_unknown_wound_level_is_rejected_without_touching_the_ledger():
+  session = fight()
+  assert 'error' in record_wound(session, "騎士", "左手臂", "擦傷")
+  assert wounds_of(session, ["騎士"])["騎士"] == {}
+  assert session['combat']['changes'] == []
+
+
+def test_wounds_outlive_the_combat():
+  session = fight()
+  record_wound(session, "騎士", "左手臂", "重傷", "咬傷")
+  end_combat(session, "野狼逃走")
+  assert "騎士：左手臂重傷" in ledger_summary(session)
+  start_combat(session, "森林", [{'name': "騎士", 'side': "玩家", 'user_id': "1000"}])
+  assert wounds_of(session, ["騎士"])["騎士"] == {"左手臂": "重傷"}
+
+
+@pytest.mark.parametrize("strategies, active, pending", [
+  ({}, {"1000", "1001"}, ["騎士", "弓手"]),
+  ({"1000": "衝鋒"}, {"1000", "1001"}, ["弓手"]),
+  ({"1000": "衝鋒", "1001": "射箭"}, {"1000", "1001"}, []),
+  # A player who left the session does not hold up the round
+  ({"1000": "衝鋒"}, {"1000"}, []),
+  # Players outside the combat never count, nor do characters without a player
+  ({}, {"1000", "2000"}, ["騎士"]),
+])
+def test_pending_players(strategies, active, pending):
+  session = fight()
+  for user_id, strategy in strategies.items():
+    record_strategy(session, user_id, strategy)
+  assert pending_players(session, active) == pending
+
+
+def test_strategy_from_outside_the_combat_is_not_recorded():
+  session = fight()
+  assert record_strategy(session, "2000", "旁觀") is None
+  assert session['combat']['strategies'] == {}
+
+
+def test_a_round_carries_its_strategies_and_wound_changes_then_starts_the_next_clean():
+  session = fight()
+  record_strategy(session, "1000", "衝鋒")
+  record_wound(session, "野狼", "後腿", "輕傷", "劍傷")
+  prompt = begin_round(session)
+  assert "交戰回合 1" in prompt
+  assert "- 騎士：衝鋒" in prompt
+  assert "- 野狼 後腿：無傷 → 輕傷（劍傷）" in prompt
+  assert session['combat']['strategies'] == {} and session['combat']['changes'] == []
+  assert pending_players(session, {"1000", "1001"}) == ["騎士", "弓手"]
+  assert "交戰回合 2" in begin_round(session)
+
+
+def test_combat_tools_need_a_session():
+  assert 'error' in handle_combat_tool(None, "record_wound", {})
+  assert 'error' in handle_combat_tool({}, "end_combat", {'outcome': ""})
+
+
+def test_combat_turn_from_a_non_participant_is_rejected(bot, workdir):
+  async def scenario():
+    server = FakeAssistantsServer(request_latency=0, jitter=0, manual=True)
+    client = await new_client(bot, server, workdir)
+    releaser = Releaser(server)
+    releaser.start()
+    await start_session(bot, client, "fight", [1000, 1001])
+    start_combat(client.saves["fight"], "酒館門口", [
+      {'name': "騎士", 'side': "玩家", 'user_id': "1000"},
+      {'name': "野狼", 'side': "野獸"},
+    ])
+
+    bystander = FakeInteraction(bot.CHANNEL_ID, 1001, "player1001")
+    await client.play(bystander, "我在旁邊喝酒。")
+    await until(lambda: settled(client))
+    fighter = FakeInteraction(bot.CHANNEL_ID, 1000, "player1000")
+    await client.play(fighter, "我舉盾衝向野狼。")
+    await until(lambda: settled(client))
+    result = {
+      'bystander': [content for _, content in bystander.followup.events],
+      'fighter': [content for _, content in fighter.followup.events],
+      'bystander_plays': await thread_plays(client, "fight", 1001),
+      'round': client.saves["fight"]['combat']['round'],
+    }
+    releaser.stop()
+    await shutdown(client)
+    return result
+
+  result = drive(scenario())
+  assert len(result['bystander']) == 1
+  assert "❌ 你的角色沒有參與這場戰鬥" in result['bystander'][0]
+  assert not any("已記錄策略" in content for content in result['bystander'])
+  assert result['bystander_plays'] == [JOIN_MESSAGE]
+  # The bystander does not hold up the round: the one participant's strategy starts it
+  assert result['round'] == 1
+  assert any("遊戲敘事" in content for content in result['fighter'])
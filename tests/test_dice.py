@@ -0,0 +1,137 @@
+import random
+
+import pytest
+
+from dice import (
+  CRITICAL_FAILURE, CRITICAL_SUCCESS, DIE_FACES, handle_check_tool, resolve_check, resolve_cumulative,
+  resolve_opposed, resolve_thresholds, roll_2d20, success_probability,
+)
+
+
+class Rolls:
+  # Stands in for random: hands out the given dice in order
+  def __init__(self, *dice):
+    self.dice = list(dice)
+
+  def randint(self, low: int, high: int) -> int:
+    return self.dice.pop(0)
+
+
+@pytest.mark.parametrize("dice, mode, roll, critical", [
+  ((10, 5), "high", 10, None),
+  ((10, 5), "low", 5, None),
+  ((1, 1), "high", 1, CRITICAL_FAILURE),
+  ((20, 20), "low", 20, CRITICAL_SUCCESS),
+  # One die at either end is not a critical
+  ((1, 2), "high", 2, None),
+  ((20, 19), "low", 19, None),
+])
+def test_roll_2d20(dice, mode, roll, critical):
+  result = roll_2d20(mode, Rolls(*dice))
+  assert (result['roll'], result['critical']) == (roll, critical)
+
+
+@pytest.mark.parametrize("dice, stat, bonus, difficulty, mode, total, success", [
+  # Meeting the difficulty succeeds, one short fails
+  ((10, 5), 2, 0, 30, "high", 30, True),
+  ((10, 5), 2, 0, 31, "high", 30, False),
+  ((10, 5), 2, 0, 25, "low", 25, True),
+  ((10, 5), 2, 0, 26, "low", 25, False),
+  ((10, 5), 2, 3, 33, "high", 33, True),
+  ((10, 5), 2, -3, 28, "high", 27, False),
+  ((10, 5), 2.5, 0, 35, "high", 35, True),
+  # Double 1 fails whatever the total, double 20 succeeds whatever the difficulty
+  ((1, 1), 10, 50, 10, "high", 151, False),
+  ((20, 20), 0, 0, 1000, "low", 20, True),
+])
+def test_resolve_check(dice, stat, bonus, difficulty, mode, total, success):
+  result = resolve_check(stat, difficulty, bonus, mode, Rolls(*dice))
+  assert (result['total'], result['success']) == (total, success)
+
+
+@pytest.mark.parametrize("actor_dice, target_dice, actor_stat, target_stat, winner", [
+  # Ties go to the target
+  ((10, 3), (10, 3), 2, 2, "target"),
+  ((11, 3), (10, 3), 2, 2, "actor"),
+  ((10, 3), (11, 3), 2, 2, "target"),
+  # A critical outranks any plain total
+  ((20, 20), (19, 3), 0, 10, "actor"),
+  ((18, 3), (20, 20), 10, 0, "target"),
+  ((1, 1), (2, 3), 10, 0, "target"),
+  ((5, 3), (1, 1), 0, 10, "actor"),
+  # The same critical on both sides is decided by the totals, ties still to the target
+  ((20, 20), (20, 20), 3, 2, "actor"),
+  ((1, 1), (1, 1), 2, 2, "target"),
+])
+def test_resolve_opposed(actor_dice, target_dice, actor_stat, target_stat, winner):
+  assert resolve_opposed(actor_stat, target_stat, rng=Rolls(*actor_dice, *target_dice))['winner'] == winner
+
+
+@pytest.mark.parametrize("dice, thresholds, reached, tier", [
+  ((10, 5), [20, 30, 40], 30, 2),
+  ((9, 5), [20, 30, 40], 20, 1),
+  ((10, 5), [40, 20, 30], 30, 2),
+  ((5, 5), [30, 40], None, 0),
+  ((20, 20), [30, 100, 200], 200, 3),
+  ((1, 1), [1, 2], None, 0),
+])
+def test_resolve_thresholds(dice, thresholds, reached, tier):
+  # stat 2 puts the total at the kept die + 20
+  result = resolve_thresholds(2, thresholds, rng=Rolls(*dice))
+  assert (result['reached'], result['tier']) == (reached, tier)
+  assert result['thresholds'] == sorted(thresholds)
+
+
+@pytest.mark.parametrize("dice, goal, progress, after, completed", [
+  ((10, 5), 60, 30, 60, True),
+  ((9, 5), 60, 30, 59, False),
+  # Double 1 adds nothing, double 20 completes the goal outright
+  ((1, 1), 60, 30, 30, False),
+  ((20, 20), 1000, 30, 1000, True),
+  ((20, 20), 10, 30, 70, True),
+])
+def test_resolve_cumulative(dice, goal, progress, after, completed):
+  result = resolve_cumulative(2, goal, progress, rng=Rolls(*dice))
+  assert (result['progress'], result['completed']) == (after, completed)
+
+
+def every_roll():
+  return [(a, b) for a in range(1, DIE_FACES + 1) for b in range(1, DIE_FACES + 1)]
+
+@pytest.mark.parametrize("stat, bonus, difficulty, mode", [
+  (2, 0, 30, "high"),
+  (2, 0, 30, "low"),
+  (0, 0, 1, "high"),
+  (0, 0, 20, "high"),
+  (0, 0, 21, "high"),
+  (3, 0, 10, "low"),
+  (2.5, 1, 40, "high"),
+  (1, 0.5, 25.2, "low"),
+  (5, 0, 1000, "high"),
+])
+def test_success_probability_counts_every_roll(stat, bonus, difficulty, mode):
+  successes = sum(resolve_check(stat, difficulty, bonus, mode, Rolls(*dice))['success'] for dice in every_roll())
+  assert success_probability(stat, difficulty, bonus, mode) == pytest.approx(successes / DIE_FACES ** 2)
+
+
+def test_success_probability_bounds():
+  # Only double 1 fails an easy check, only double 20 passes an impossible one
+  assert success_probability(10, 0) == pytest.approx(399 / 400)
+  assert success_probability(0, 1000) == pytest.approx(1 / 400)
+
+
+def test_seeded_checks_are_consistent():
+  rng = random.Random(7)
+  for _ in range(500):
+    result = resolve_check(2, 35, 0, rng.choice(["high", "low"]), rng)
+    low, high = sorted(result['dice'])
+    assert result['roll'] in (low, high)
+    if result['critical'] is None:
+      assert result['success'] == (result['total'] >= 35)
+
+
+def test_check_tools_pass_their_arguments_through():
+  result = handle_check_tool("roll_check", {'stat': 2, 'difficulty': 30, 'bonus': 5, 'mode': "low"})
+  assert result['request']['bonus'] == 5
+  assert result['result']['total'] == result['result']['roll'] + 25
+  assert handle_check_tool("unknown", {}) is None
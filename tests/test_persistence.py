@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from persistence import Persistence
+from storage import CharacterCache, LazyRows, create_storage
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def rows(request, tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  storage = create_storage(request.param, lambda row: row, str(tmp_path / "test.db"))
+  saves = LazyRows(storage.load_session)
+  characters = CharacterCache(storage)
+  player_state = LazyRows(storage.load_player_state)
+  persistence = Persistence(storage, saves, characters, player_state, json.JSONEncoder)
+  yield storage, saves, characters, player_state, persistence
+  storage.close()
+
+
+def test_dirty_rows_that_are_not_resident_are_kept(rows):
+  storage, saves, characters, player_state, persistence = rows
+  saves["s1"] = {'state': "playing"}
+  player_state["u1"] = {'session_id': "s1"}
+  characters["u1"]["c1"] = {'state': "created", 'data': {'name': "甲"}}
+  persistence.mark_all()
+  persistence.flush_sync()
+
+  # Marked dirty, then evicted before the flush came round
+  persistence.mark_session("s1")
+  persistence.mark_player("u1")
+  persistence.mark_character("u1", "c1")
+  saves.evict("s1")
+  player_state.evict("u1")
+  dict.get(characters, "u1").evict("c1")
+  characters.forget("u1", "c1")
+  persistence.flush_sync()
+
+  assert storage.load_session("s1") == {'state': "playing"}
+  assert storage.load_player_state("u1") == {'session_id': "s1"}
+  assert storage.load_character("u1", "c1") == {'state': "created", 'data': {'name': "甲"}}
+
+
+def test_deleted_rows_are_deleted(rows):
+  storage, saves, characters, player_state, persistence = rows
+  saves["s1"] = {'state': "playing"}
+  player_state["u1"] = {'session_id': "s1"}
+  characters["u1"]["c1"] = {'state': "created", 'data': {'name': "甲"}}
+  persistence.mark_all()
+  persistence.flush_sync()
+
+  del saves["s1"]
+  del player_state["u1"]
+  del characters["u1"]["c1"]
+  persistence.mark_session("s1")
+  persistence.mark_player("u1")
+  persistence.mark_character("u1", "c1")
+  persistence.flush_sync()
+
+  assert storage.load_session("s1") is None
+  assert storage.load_player_state("u1") is None
+  assert storage.load_character("u1", "c1") is None
+
+
+def test_character_deletion_survives_eviction_of_the_users_last_character(rows):
+  storage, saves, characters, player_state, persistence = rows
+  characters["u1"]["c1"] = {'state': "created", 'data': {'name': "甲"}}
+  characters["u1"]["c2"] = {'state': "created", 'data': {'name': "乙"}}
+  persistence.mark_all()
+  persistence.flush_sync()
+
+  del characters["u1"]["c2"]
+  persistence.mark_character("u1", "c2")
+  characters.max_entries = 1
+  # Loading another user's character evicts u1's last resident one
+  characters["u2"]["c3"] = {'state': "created", 'data': {'name': "丙"}}
+  persistence.flush_sync()
+
+  assert storage.load_character("u1", "c2") is None
+  assert storage.load_character("u1", "c1") is not None
@@ -0,0 +1,57 @@
+import asyncio
+import time
+
+from scheduler import FairLimiter, RateLimiter, SessionScheduler
+from testing.fakes import until
+from tests.helpers import drive
+
+
+def payload() -> dict:
+  return {'queued_at': time.monotonic(), 'messages': []}
+
+
+def test_a_session_waiting_on_the_token_budget_does_not_hold_a_slot():
+  async def scenario():
+    processed = []
+    async def process_batch(session_id: str, batch: list):
+      processed.append(session_id)
+
+    # One slot; a token a second, and the budget spent
+    rate_limiter = RateLimiter(rpm=10 ** 9, tpm=60)
+    rate_limiter.tokens.tokens = 0
+    scheduler = SessionScheduler(process_batch, lambda session_id, batch: True, 0, FairLimiter(1), rate_limiter, default_turn_tokens=0)
+    scheduler.last_turn_tokens["large"] = 60
+    scheduler.submit("large", payload())
+    await until(lambda: scheduler.queue_depth("large") == 0)
+    scheduler.submit("small", payload())
+    await until(lambda: "small" in processed)
+    result = (list(processed), scheduler.queued("large"))
+    await scheduler.shutdown()
+    return result
+
+  processed, queued = drive(scenario())
+  assert processed == ["small"]
+  # The large turn is still waiting for its tokens, not lost
+  assert len(queued) == 1
+
+
+def test_slots_go_round_robin_across_sessions():
+  async def scenario():
+    order = []
+    gate = asyncio.Event()
+    async def process_batch(session_id: str, batch: list):
+      order.append(session_id)
+      await gate.wait()
+
+    scheduler = SessionScheduler(process_batch, lambda session_id, batch: True, 0, FairLimiter(1), RateLimiter(10 ** 9, 10 ** 9), default_turn_tokens=0)
+    scheduler.submit("a", payload())
+    await until(lambda: order == ["a"])
+    for session_id in ["b", "c", "a"]:
+      scheduler.submit(session_id, payload())
+    await until(lambda: len(scheduler.limiter.waiting_sessions()) == 2)
+    gate.set()
+    await until(lambda: len(order) == 4)
+    await scheduler.shutdown()
+    return order
+
+  assert drive(scenario()) == ["a", "b", "c", "a"]
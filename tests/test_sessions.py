@@ -0,0 +1,38 @@
+from testing.fakes import FakeAssistantsServer, Releaser, shutdown
+from tests.helpers import drive, new_client, start_session
+
+
+def test_hibernation_keeps_a_session_changed_during_its_flush(bot, workdir):
+  async def scenario():
+    server = FakeAssistantsServer(request_latency=0, jitter=0, manual=True)
+    client = await new_client(bot, server, workdir)
+    releaser = Releaser(server)
+    releaser.start()
+    await start_session(bot, client, "idle", [1000])
+
+    flush = client.persistence.flush
+    async def flush_then_change():
+      await flush()
+      # As a usage record landing while the flush was writing would
+      client.saves["idle"]['usage_changed'] = True
+      client.persistence.mark_session("idle")
+      client.persistence.mark_player("1000")
+
+    client.persistence.mark_session("idle")
+    client.persistence.flush = flush_then_change
+    await client.hibernate_session("idle")
+    client.persistence.flush = flush
+    result = {
+      'session': dict.__contains__(client.saves, "idle"),
+      'player': dict.__contains__(client.player_state, "1000"),
+    }
+    await client.persistence.flush()
+    result['stored'] = client.storage.load_session("idle")
+    releaser.stop()
+    await shutdown(client)
+    return result
+
+  result = drive(scenario())
+  assert result['session']
+  assert result['player']
+  assert result['stored']['usage_changed']
@@ -0,0 +1,177 @@
+import asyncio
+import random
+
+import pytest
+
+from testing.fakes import FakeAssistantsServer, FakeInteraction, Releaser, settled, shutdown, thread_plays, until
+from tests.helpers import JOIN_MESSAGE, action, drive, join_player, new_client, start_session
+
+
+class ShufflingReleaser(Releaser):
+  # Lets every run that can start do so, then releases them in a seeded random order, so runs
+  # finish out of the order they started in
+  def __init__(self, server: FakeAssistantsServer, seed: int):
+    super().__init__(server)
+    self.random = random.Random(seed)
+
+  async def run(self):
+    while True:
+      pending = [await self.server.next_run()]
+      for _ in range(50):
+        await asyncio.sleep(0)
+      while not self.server.started.empty():
+        pending.append(self.server.started.get_nowait())
+      self.random.shuffle(pending)
+      for held in pending:
+        self.server.release(held)
+
+
+def test_no_message_is_posted_to_a_thread_mid_run(bot, workdir):
+  # Many players on few sessions: the session worker must never post to a thread mid-run
+  async def scenario():
+    server = FakeAssistantsServer(request_latency=0, jitter=0, manual=True)
+    client = await new_client(bot, server, workdir)
+    releaser = ShufflingReleaser(server, seed=1)
+    releaser.start()
+    sessions = {f"s{index}": [1000 + index * 3 + seat for seat in range(3)] for index in range(2)}
+    for session_id in sessions:
+      await client.start_game(FakeInteraction(bot.CHANNEL_ID, 1, "host"), session_id)
+
+    async def player(session_id: str, user_id: int):
+      await join_player(bot, client, session_id, user_id)
+      for turn in range(3):
+        await client.play(FakeInteraction(bot.CHANNEL_ID, user_id, f"player{user_id}"), action(turn + 1))
+
+    await asyncio.gather(*[player(session_id, user_id) for session_id, user_ids in sessions.items() for user_id in user_ids])
+    await until(lambda: settled(client))
+    plays = {
+      user_id: await thread_plays(client, session_id, user_id)
+      for session_id, user_ids in sessions.items()
+      for user_id in user_ids
+    }
+    releaser.stop()
+    await shutdown(client)
+    return server, plays
+
+  server, plays = drive(scenario())
+  assert server.violations == []
+  for user_id, played in plays.items():
+    assert played == [JOIN_MESSAGE] + [action(turn + 1) for turn in range(3)], user_id
+
+
+@pytest.mark.parametrize("backend", ["assistants", "fake"])
+def test_turns_reach_the_thread_once_and_in_order(bot, workdir, backend):
+  # Turns submitted back to back by one player, while the run before them is still going
+  async def scenario():
+    server = FakeAssistantsServer(request_latency=0, jitter=0, manual=True)
+    client = await new_client(bot, server, workdir, backend)
+    releaser = Releaser(server)
+    releaser.start()
+    await start_session(bot, client, "order", [1000])
+
+    # Hold the first turn's run so the rest queue up behind it
+    releaser.stop()
+    interaction = lambda: FakeInteraction(bot.CHANNEL_ID, 1000, "player1000")
+    await client.play(interaction(), action(1))
+    first = await server.next_run()
+    for turn in range(1, 8):
+      await client.play(interaction(), action(turn + 1))
+    releaser.start()
+    server.release(first)
+    await until(lambda: settled(client))
+    plays = await thread_plays(client, "order", 1000)
+    releaser.stop()
+    await shutdown(client)
+    return plays
+
+  assert drive(scenario()) == [JOIN_MESSAGE] + [action(turn + 1) for turn in range(8)]
+
+
+@pytest.mark.parametrize("backend", ["assistants", "fake"])
+def test_rollover_replays_turns_posted_after_the_snapshot(bot, workdir, backend):
+  # The summary is held while play goes on, so the snapshot it took misses the turns played in
+  # the meantime; once the successor is swapped in it must hold exactly those, in order
+  async def scenario():
+    server = FakeAssistantsServer(request_latency=0, jitter=0, manual=True)
+    client = await new_client(bot, server, workdir, backend, summary_threshold=1)
+    releaser = Releaser(server, hold={"GPTTRPG_summary"})
+    releaser.start()
+    await start_session(bot, client, "rollover", [1000])
+    original = client.saves["rollover"]['thread_id']
+    # The join turn crossed the threshold; its summary is waiting on its run
+    await until(lambda: releaser.held)
+
+    interaction = lambda: FakeInteraction(bot.CHANNEL_ID, 1000, "player1000")
+    for turn in range(3):
+      await client.play(interaction(), action(turn + 1))
+      await until(lambda: settled(client))
+    releaser.release_held()
+    await until(lambda: 'pending_thread' in client.saves["rollover"] and not releaser.held)
+    await until(lambda: "rollover" not in client.summary_tasks)
+
+    await client.play(interaction(), action(4))
+    await until(lambda: settled(client))
+    session = client.saves["rollover"]
+    result = {
+      'swapped': session['thread_id'] != original,
+      'summaries': len(session['summaries']),
+      'original': await thread_plays(client, "rollover", 1000, original),
+      'current': await thread_plays(client, "rollover", 1000),
+    }
+    releaser.stop()
+    await shutdown(client)
+    return result
+
+  result = drive(scenario())
+  assert result['swapped']
+  assert result['summaries'] == 1
+  assert result['original'] == [JOIN_MESSAGE] + [action(turn + 1) for turn in range(3)]
+  assert result['current'] == [action(turn + 1) for turn in range(4)]
+
+
+def test_crash_mid_run_is_recovered_without_running_again(bot, workdir):
+  # The bot dies with a turn and a character creation mid-run; started again over the same
+  # files, it must deliver both replies to the channel without starting either run again
+  async def scenario():
+    server = FakeAssistantsServer(request_latency=0, jitter=0, manual=True)
+    client = await new_client(bot, server, workdir)
+    releaser = Releaser(server)
+    releaser.start()
+    await start_session(bot, client, "crash", [1000])
+    releaser.stop()
+
+    await client.play(FakeInteraction(bot.CHANNEL_ID, 1000, "player1000"), action(1))
+    creating = asyncio.create_task(client.create_character(FakeInteraction(bot.CHANNEL_ID, 2000, "player2000"), "c2000"))
+    held = [await server.next_run(), await server.next_run()]
+    # Die once the creation's run id is on disk; the streamed turn is found on its thread instead
+    await until(lambda: any(
+      entry['kind'] == 'character_creation' and 'run_id' in entry
+      for entry in client.journal.entries.values()
+    ) and not client.journal.lock.locked())
+    creating.cancel()
+    await shutdown(client)
+    runs = len(server.runs)
+
+    restarted = await new_client(bot, server, workdir)
+    recovering = asyncio.create_task(restarted.recover_in_flight())
+    for run in held:
+      server.release(run)
+    # A run started again by mistake is let through too, so it shows up in the count
+    releaser.start()
+    await recovering
+    await until(lambda: settled(restarted))
+    result = {
+      'repeated': len(server.runs) - runs,
+      'recovered': [content for _, content in restarted.channel_events if content.startswith(bot.RECOVERED_NOTE)],
+      'plays': await thread_plays(restarted, "crash", 1000),
+      'character': restarted.characters["2000"]["c2000"]['state'],
+    }
+    releaser.stop()
+    await shutdown(restarted)
+    return result
+
+  result = drive(scenario())
+  assert result['repeated'] == 0
+  assert len(result['recovered']) == 2
+  assert result['plays'] == [JOIN_MESSAGE, action(1)]
+  assert result['character'] == bot.CharacterCreationState.CHARACTER_CREATION
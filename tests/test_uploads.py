@@ -0,0 +1,108 @@
+import asyncio
+import time
+
+from testing.fakes import FakeAssistantsServer, until
+from tests.helpers import drive
+from uploads import UploadCache
+
+
+class CountingLock(asyncio.Lock):
+  # A task that has looked an upload up and let go of the lock is already waiting on it
+  def __init__(self):
+    super().__init__()
+    self.acquired = 0
+
+  async def acquire(self):
+    await super().acquire()
+    self.acquired += 1
+    return True
+
+
+def gated_cache(server):
+  cache = UploadCache(server.client())
+  cache.lock = CountingLock()
+  return cache
+
+async def start_waiter(cache, content: bytes):
+  waiter = asyncio.create_task(cache.upload("CHARACTER_1_a.json", content))
+  await until(lambda: cache.lock.acquired == 2 and not cache.lock.locked())
+  return waiter
+
+
+class GatedServer(FakeAssistantsServer):
+  # Each upload waits until the test opens the gate
+  def __init__(self):
+    super().__init__(request_latency=0)
+    self.gate = asyncio.Event()
+    self.uploads = 0
+
+  async def create_file(self, file, purpose: str):
+    self.uploads += 1
+    await self.gate.wait()
+    return await super().create_file(file, purpose)
+
+
+def test_waiters_take_over_an_upload_whose_uploader_was_cancelled(workdir):
+  async def scenario():
+    server = GatedServer()
+    cache = gated_cache(server)
+    owner = asyncio.create_task(cache.upload("CHARACTER_1_a.json", b"{}"))
+    await until(lambda: server.uploads == 1)
+    waiter = await start_waiter(cache, b"{}")
+    owner.cancel()
+    await until(lambda: server.uploads == 2)
+    server.gate.set()
+    file_id = await waiter
+    try:
+      await owner
+      owner_cancelled = False
+    except asyncio.CancelledError:
+      owner_cancelled = True
+    return owner_cancelled, file_id, cache.entries, server.files
+
+  owner_cancelled, file_id, entries, files = drive(scenario())
+  assert owner_cancelled
+  assert [entry['file_id'] for entry in entries.values()] == [file_id]
+  assert list(files) == [file_id]
+
+
+def test_waiters_share_an_upload_failure(workdir):
+  async def scenario():
+    server = GatedServer()
+    async def fail(file, purpose: str):
+      server.uploads += 1
+      await server.gate.wait()
+      raise RuntimeError("upload failed")
+    server.create_file = fail
+    cache = gated_cache(server)
+    owner = asyncio.create_task(cache.upload("CHARACTER_1_a.json", b"{}"))
+    await until(lambda: server.uploads == 1)
+    waiter = await start_waiter(cache, b"{}")
+    server.gate.set()
+    results = await asyncio.gather(owner, waiter, return_exceptions=True)
+    return results, server.uploads
+
+  results, uploads = drive(scenario())
+  assert [str(result) for result in results] == ["upload failed", "upload failed"]
+  assert uploads == 1
+
+
+def test_garbage_collection_only_deletes_files_this_cache_uploaded(workdir):
+  async def scenario():
+    server = FakeAssistantsServer(request_latency=0)
+    cache = UploadCache(server.client())
+    own = await cache.upload("CHARACTER_1_a.json", b"{}")
+    kept = await cache.upload("SUMMARY_s_1.md", b"summary")
+    # Another instance sharing the key uploaded a file named just like ours
+    foreign = (await server.create_file(type("File", (), {'name': "CHARACTER_2_b.json"}), "assistants")).id
+    for entry in cache.entries.values():
+      entry['used_at'] = time.time() - 10
+    server.files[foreign].created_at = time.time() - 10
+    deleted = await cache.collect_garbage({kept}, grace=1)
+    return deleted, own, kept, foreign, server.files, cache.entries
+
+  deleted, own, kept, foreign, files, entries = drive(scenario())
+  assert deleted == 1
+  assert own not in files
+  assert kept in files and foreign in files
+  assert [entry['file_id'] for entry in entries.values()] == [kept]
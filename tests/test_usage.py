@@ -0,0 +1,54 @@
+from testing.fakes import FakeAssistantsServer, FakeInteraction, Releaser, settled, shutdown, until
+from tests.helpers import drive, new_client, start_session
+from usage import ledger_of, predict_next_context
+
+
+def test_usage_report_prices_each_rule_set_and_counts_queued_turns(bot, workdir):
+  async def scenario():
+    server = FakeAssistantsServer(request_latency=0, jitter=0, manual=True)
+    client = await new_client(bot, server, workdir)
+    releaser = Releaser(server)
+    releaser.start()
+    await start_session(bot, client, "usage", [1000])
+
+    # Hold the next turn's run so the one after it is still queued when the report is asked for
+    releaser.stop()
+    interaction = lambda: FakeInteraction(bot.CHANNEL_ID, 1000, "player1000")
+    await client.play(interaction(), "第 1 個行動")
+    held = await server.next_run()
+    queued = "長" * 5000
+    await client.play(interaction(), queued)
+
+    session = client.saves["usage"]
+    ledger = ledger_of(session)
+    ledger['total'] = {'prompt': 1_000_000, 'completion': 1_000_000, 'runs': 2}
+    ledger['players'] = {'1000': {'prompt': 1_000_000, 'completion': 1_000_000, 'turns': 2}}
+    ledger['specialist'] = {'combat': {'prompt': 2_000_000, 'completion': 1_000_000, 'runs': 3}}
+    client.rule_set['main'].update(prompt_token_price=1.0, completion_token_price=2.0)
+    client.rule_set['combat'].update(prompt_token_price=10.0, completion_token_price=20.0)
+
+    report = FakeInteraction(bot.CHANNEL_ID, 1000, "player1000")
+    await client.usage_report(report, "usage")
+    result = {
+      'report': report.followup.events[-1][1],
+      'queued_text': client.queued_text("usage"),
+      'with_queued': predict_next_context(session, client.queued_text("usage")),
+      'without_queued': predict_next_context(session),
+    }
+    server.release(held)
+    releaser.start()
+    await until(lambda: settled(client))
+    releaser.stop()
+    await shutdown(client)
+    return result
+
+  result = drive(scenario())
+  report = result['report']
+  assert "輸出 1000000 tokens，約 $3.00\n" in report
+  assert "專職地城主 combat：3 次，輸入 2000000，輸出 1000000 tokens，約 $40.00\n" in report
+  assert "合計約 $43.00\n" in report
+  assert "<@1000>：2 回合，輸入 1000000，輸出 1000000 tokens，約 $3.00\n" in report
+  # Only the turn still queued: the held one has already been handed to its run
+  assert result['queued_text'].count("長" * 5000) == 1 and "第 1 個行動" not in result['queued_text']
+  assert result['with_queued'] > result['without_queued']
+  assert f"預估下回合 {result['with_queued']} /" in report
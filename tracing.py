@@ -0,0 +1,273 @@
+import argparse
+import asyncio
+import contextvars
+import glob
+import json
+import os
+import secrets
+import time
+import traceback
+from contextlib import contextmanager
+
+
+TRACE_FILE = os.path.join('traces', 'spans.jsonl')
+TRACE_MAX_BYTES = 10 * 1024 * 1024
+TRACE_BACKUPS = 5
+TRACE_FLUSH_INTERVAL = 2
+
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def new_trace_id() -> str:
+  return secrets.token_hex(16)
+
+def new_span_id() -> str:
+  return secrets.token_hex(8)
+
+def attribute_value(value) -> dict:
+  if isinstance(value, bool):
+    return {'boolValue': value}
+  if isinstance(value, int):
+    return {'intValue': str(value)}
+  if isinstance(value, float):
+    return {'doubleValue': value}
+  return {'stringValue': str(value)}
+
+
+class Span:
+  def __init__(self, name: str, parent: dict = None, links: list = None, attributes: dict = None):
+    # parent is a span context, {'trace_id', 'span_id'}; without one the span starts a new trace
+    self.name = name
+    self.trace_id = parent['trace_id'] if parent else new_trace_id()
+    self.span_id = new_span_id()
+    self.parent_span_id = parent['span_id'] if parent else None
+    self.links = [link for link in links or [] if link]
+    self.attributes = {key: value for key, value in (attributes or {}).items() if value is not None}
+    self.start_ns = time.time_ns()
+    self.end_ns = None
+    self.status = STATUS_UNSET
+    self.status_message = None
+
+  def context(self) -> dict:
+    return {'trace_id': self.trace_id, 'span_id': self.span_id}
+
+  def set(self, key: str, value):
+    if value is not None:
+      self.attributes[key] = value
+
+  def fail(self, message: str):
+    self.status = STATUS_ERROR
+    self.status_message = message
+
+  def end(self):
+    if self.end_ns is not None:
+      return
+    self.end_ns = time.time_ns()
+    if exporter:
+      exporter.export(self)
+
+  def to_json(self) -> dict:
+    # Field names follow the OTLP/JSON span encoding so the file can be replayed into a collector
+    span = {
+      'traceId': self.trace_id,
+      'spanId': self.span_id,
+      'name': self.name,
+      'kind': 1,
+      'startTimeUnixNano': str(self.start_ns),
+      'endTimeUnixNano': str(self.end_ns),
+      'attributes': [{'key': key, 'value': attribute_value(value)} for key, value in self.attributes.items()],
+      'status': {'code': self.status},
+    }
+    if self.parent_span_id:
+      span['parentSpanId'] = self.parent_span_id
+    if self.links:
+      span['links'] = [{'traceId': link['trace_id'], 'spanId': link['span_id']} for link in self.links]
+    if self.status_message:
+      span['status']['message'] = self.status_message
+    return span
+
+
+def current_context() -> dict:
+  active = current_span.get()
+  return active.context() if active else None
+
+def set_attribute(key: str, value):
+  active = current_span.get()
+  if active:
+    active.set(key, value)
+
+@contextmanager
+def span(name: str, parent: dict = None, links: list = None, **attributes):
+  active = Span(name, parent or current_context(), links, attributes)
+  token = current_span.set(active)
+  try:
+    yield active
+  except BaseException as e:
+    if not isinstance(e, (asyncio.CancelledError, GeneratorExit)):
+      active.fail(f"{type(e).__name__}: {e}")
+    raise
+  finally:
+    current_span.reset(token)
+    active.end()
+
+
+class TraceExporter:
+  # Spans are buffered and appended as JSON lines off the event loop; the file rotates like
+  # logging's RotatingFileHandler, spans.jsonl -> spans.jsonl.1 -> ... spans.jsonl.<backups>
+  def __init__(self, path: str = TRACE_FILE, max_bytes: int = TRACE_MAX_BYTES, backups: int = TRACE_BACKUPS):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.backups = backups
+    self.buffer = []
+
+  def export(self, span: Span):
+    self.buffer.append(span.to_json())
+
+  def rotate(self):
+    for index in range(self.backups - 1, 0, -1):
+      if os.path.exists(f"{self.path}.{index}"):
+        os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+    if self.backups:
+      os.replace(self.path, f"{self.path}.1")
+    else:
+      os.remove(self.path)
+
+  def write(self, spans: list):
+    os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+    if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+      self.rotate()
+    with open(self.path, "a", encoding="utf-8") as f:
+      for span in spans:
+        f.write(json.dumps(span, ensure_ascii=False) + "\n")
+
+  def take(self) -> list:
+    spans, self.buffer = self.buffer, []
+    return spans
+
+  async def flush(self):
+    spans = self.take()
+    if spans:
+      await asyncio.to_thread(self.write, spans)
+
+  def flush_sync(self):
+    spans = self.take()
+    if spans:
+      self.write(spans)
+
+  async def run(self, interval: float = TRACE_FLUSH_INTERVAL):
+    while True:
+      await asyncio.sleep(interval)
+      try:
+        await self.flush()
+      except Exception as e:
+        print(f"[Error] Failed to write spans: {e}")
+        traceback.print_exc()
+
+
+exporter = None
+
+def configure(path: str = TRACE_FILE, max_bytes: int = TRACE_MAX_BYTES, backups: int = TRACE_BACKUPS) -> TraceExporter:
+  global exporter
+  exporter = TraceExporter(path, max_bytes, backups) if path else None
+  return exporter
+
+
+def load_spans(path: str) -> list:
+  spans = []
+  for file_path in sorted(glob.glob(f"{glob.escape(path)}*")):
+    with open(file_path, "r", encoding="utf-8") as f:
+      for line in f:
+        if not line.strip():
+          continue
+        raw = json.loads(line)
+        spans.append({
+          'trace_id': raw['traceId'],
+          'span_id': raw['spanId'],
+          'parent_id': raw.get('parentSpanId'),
+          'name': raw['name'],
+          'start': int(raw['startTimeUnixNano']) / 1e9,
+          'end': int(raw['endTimeUnixNano']) / 1e9,
+          'attributes': {item['key']: next(iter(item['value'].values())) for item in raw.get('attributes', [])},
+          'error': raw.get('status', {}).get('code') == STATUS_ERROR,
+        })
+  return spans
+
+def finish(span: dict, children: dict) -> float:
+  # A queued turn outlives the command span that queued it, so a span is done when its subtree is
+  return max([span['end']] + [finish(child, children) for child in children.get(span['span_id'], [])])
+
+def critical_path(span: dict, children: dict) -> list:
+  # Walk back from the span's finish: the child finishing last is what the span waited on, then
+  # the child finishing last before that one started, and so on
+  path = [span]
+  cursor = finish(span, children)
+  for child in sorted(children.get(span['span_id'], []), key=lambda child: finish(child, children), reverse=True):
+    if finish(child, children) <= cursor + 1e-6:
+      path += [{**step, 'depth': step.get('depth', 0) + 1} for step in critical_path(child, children)]
+      cursor = child['start']
+  return path
+
+def describe(span: dict) -> str:
+  attributes = " ".join(f"{key}={value}" for key, value in span['attributes'].items())
+  return f"{span['name']}{' [error]' if span['error'] else ''} {attributes}".strip()
+
+def analyze(spans: list, session: str = None, since: float = None, until: float = None, traces: int = 3, top: int = 10):
+  in_window = [
+    span for span in spans
+    if (since is None or span['end'] >= since) and (until is None or span['start'] <= until)
+  ]
+  by_trace = {}
+  for span in in_window:
+    by_trace.setdefault(span['trace_id'], []).append(span)
+  if session:
+    by_trace = {
+      trace_id: trace for trace_id, trace in by_trace.items()
+      if any(str(span['attributes'].get('session')) == session for span in trace)
+    }
+  if not by_trace:
+    print("No spans match.")
+    return
+
+  def duration(trace: list) -> float:
+    return max(span['end'] for span in trace) - min(span['start'] for span in trace)
+
+  slowest = sorted(by_trace.values(), key=duration, reverse=True)[:traces]
+  for trace in slowest:
+    ids = {span['span_id'] for span in trace}
+    children = {}
+    for span in trace:
+      children.setdefault(span['parent_id'], []).append(span)
+    roots = [span for span in trace if span['parent_id'] not in ids]
+    origin = min(span['start'] for span in trace)
+    print(f"trace {trace[0]['trace_id']}: {duration(trace):.2f}s, {len(trace)} spans")
+    root = max(roots, key=lambda span: finish(span, children))
+    for step in critical_path(root, children):
+      print(f"  {'  ' * step.get('depth', 0)}+{step['start'] - origin:7.2f}s {step['end'] - step['start']:7.2f}s  {describe(step)}")
+
+  print(f"slowest spans:")
+  matched = [span for trace in by_trace.values() for span in trace]
+  for span in sorted(matched, key=lambda span: span['end'] - span['start'], reverse=True)[:top]:
+    print(f"  {span['end'] - span['start']:7.2f}s  {time.strftime('%H:%M:%S', time.localtime(span['start']))}  {describe(span)}")
+
+def parse_time(value: str) -> float:
+  # Either minutes ago or an ISO timestamp
+  try:
+    return time.time() - float(value) * 60
+  except ValueError:
+    return time.mktime(time.strptime(value, "%Y-%m-%dT%H:%M:%S"))
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Critical path and slowest spans from the bot's trace files")
+  parser.add_argument("--file", default=TRACE_FILE, help="trace file; rotated siblings are read too")
+  parser.add_argument("--session", help="only traces that touched this session")
+  parser.add_argument("--since", type=parse_time, help="minutes ago, or YYYY-MM-DDTHH:MM:SS")
+  parser.add_argument("--until", type=parse_time, help="minutes ago, or YYYY-MM-DDTHH:MM:SS")
+  parser.add_argument("--traces", type=int, default=3, help="how many of the slowest traces to break down")
+  parser.add_argument("--top", type=int, default=10, help="how many of the slowest spans to list")
+  args = parser.parse_args()
+  analyze(load_spans(args.file), args.session, args.since, args.until, args.traces, args.top)
@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import time
+import traceback
+
+import tracing
+from persistence import atomic_write
+
+
+UPLOAD_CACHE_FILE = 'uploads.json'
+UPLOAD_MIRROR_FOLDER = 'uploads'
+UPLOAD_GC_INTERVAL = 6 * 60 * 60
+UPLOAD_GC_GRACE = 60 * 60
+
+
+def collect_file_ids(obj, file_ids: set = None) -> set:
+  if file_ids is None:
+    file_ids = set()
+  if isinstance(obj, dict):
+    for key, value in obj.items():
+      if key == 'file_id' and isinstance(value, str):
+        file_ids.add(value)
+      else:
+        collect_file_ids(value, file_ids)
+  elif isinstance(obj, list):
+    for value in obj:
+      collect_file_ids(value, file_ids)
+  return file_ids
+
+
+class UploadCache:
+  # Uploaded bytes are also mirrored locally by digest so backends without file_search can inline them
+  def __init__(self, client, path: str = UPLOAD_CACHE_FILE, mirror_folder: str = UPLOAD_MIRROR_FOLDER):
+    self.client = client
+    self.path = path
+    self.mirror_folder = mirror_folder
+    self.entries = {}
+    self.uploading = {}
+    self.lock = asyncio.Lock()
+    if os.path.exists(path):
+      try:
+        with open(path, "r", encoding="utf-8") as f:
+          self.entries = json.load(f)
+      except Exception as e:
+        print(f"[Error] Failed to load upload cache: {e}")
+
+  async def save(self):
+    content = json.dumps(self.entries, ensure_ascii=False, indent=2)
+    await asyncio.to_thread(atomic_write, os.path.abspath(self.path), content)
+
+  def mirror_path(self, digest: str) -> str:
+    return os.path.join(self.mirror_folder, digest)
+
+  def write_mirror(self, digest: str, content: bytes):
+    if not os.path.exists(self.mirror_path(digest)):
+      atomic_write(os.path.abspath(self.mirror_path(digest)), content.decode('utf-8', errors='replace'))
+
+  def read_text(self, file_id: str) -> str:
+    for digest, entry in self.entries.items():
+      if entry['file_id'] == file_id:
+        try:
+          with open(self.mirror_path(digest), "r", encoding="utf-8") as f:
+            return f.read()
+        except FileNotFoundError:
+          return None
+    return None
+
+  async def upload(self, file_name: str, content: bytes) -> str:
+    digest = hashlib.sha256(content).hexdigest()
+    await asyncio.to_thread(self.write_mirror, digest, content)
+    # The lock only guards the lookup and the insert, so uploads of different content go out
+    # together; the same content already on its way up is waited on instead of sent twice
+    while True:
+      async with self.lock:
+        if digest in self.entries:
+          self.entries[digest]['used_at'] = time.time()
+          return self.entries[digest]['file_id']
+        pending = self.uploading.get(digest)
+        if pending is None:
+          pending = self.uploading[digest] = asyncio.get_running_loop().create_future()
+          break
+      file_id = await asyncio.shield(pending)
+      # None: the task uploading it was cancelled, which is no reason to fail this one; take it over
+      if file_id is not None:
+        return file_id
+
+    try:
+      file_io = io.BytesIO(content)
+      file_io.name = file_name
+      with tracing.span("openai.file_upload", file=file_name, bytes=len(content)):
+        response = await self.client.files.create(
+          file=file_io,
+          purpose="assistants",
+        )
+    except BaseException as e:
+      del self.uploading[digest]
+      if isinstance(e, Exception):
+        pending.set_exception(e)
+        # Nobody may be waiting; don't let the loop report the exception as never retrieved
+        pending.exception()
+      else:
+        pending.set_result(None)
+      raise
+    # Recorded and handed to the waiters without yielding, so a cancellation cannot land in between
+    self.entries[digest] = {
+      'file_id': response.id,
+      'file_name': file_name,
+      'used_at': time.time(),
+    }
+    del self.uploading[digest]
+    pending.set_result(response.id)
+    async with self.lock:
+      await self.save()
+    return response.id
+
+  async def collect_garbage(self, referenced: set, grace: float = UPLOAD_GC_GRACE) -> int:
+    # Only files recorded in this cache are considered: another bot instance sharing the API key
+    # owns the rest. Anything touched within the grace period is kept so an upload that is not
+    # referenced by a flushed row yet survives.
+    now = time.time()
+    deleted = 0
+    async with self.lock:
+      known = {entry['file_id']: digest for digest, entry in self.entries.items()}
+      async for remote_file in self.client.files.list(purpose="assistants"):
+        digest = known.get(remote_file.id)
+        if digest is None or remote_file.id in referenced:
+          continue
+        if now - self.entries[digest]['used_at'] < grace:
+          continue
+        try:
+          await self.client.files.delete(remote_file.id)
+          deleted += 1
+        except Exception as e:
+          print(f"[Error] Failed to delete file {remote_file.id}: {e}")
+          continue
+        del self.entries[digest]
+        try:
+          os.remove(self.mirror_path(digest))
+        except FileNotFoundError:
+          pass
+      if deleted:
+        await self.save()
+    return deleted
+
+  async def run_gc(self, referenced_file_ids, interval: float = UPLOAD_GC_INTERVAL):
+    while True:
+      await asyncio.sleep(interval)
+      try:
+        referenced = await referenced_file_ids()
+        deleted = await self.collect_garbage(referenced)
+        print(f"[Debug] Upload GC deleted {deleted} unreferenced files.")
+      except Exception as e:
+        print(f"[Error] Upload GC failed: {e}")
+        traceback.print_exc()
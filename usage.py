@@ -0,0 +1,131 @@
+import time
+from collections import deque
+
+
+USAGE_TURN_HISTORY = 200
+GROWTH_SAMPLE_TURNS = 5
+# gpt-4-turbo list prices, USD per million tokens
+PROMPT_TOKEN_PRICE = 10.0
+COMPLETION_TOKEN_PRICE = 30.0
+TIER_LATENCY_SAMPLES = 500
+
+
+def is_cjk(char: str) -> bool:
+  code = ord(char)
+  return (
+    0x3000 <= code <= 0x303F or 0x3400 <= code <= 0x4DBF or 0x4E00 <= code <= 0x9FFF
+    or 0xF900 <= code <= 0xFAFF or 0xFF00 <= code <= 0xFFEF
+  )
+
+def estimate_tokens(text: str) -> int:
+  # cl100k encodes most CJK characters as one token or more and English at roughly four characters
+  # per token; this errs on the high side, which is the safe side for a budget
+  if not text:
+    return 0
+  cjk = sum(1 for char in text if is_cjk(char))
+  return cjk + (len(text) - cjk + 3) // 4
+
+
+def new_ledger() -> dict:
+  return {
+    'total': {'prompt': 0, 'completion': 0, 'runs': 0},
+    'specialist': {},
+    'players': {},
+    'turns': [],
+    'context_tokens': 0,
+  }
+
+def ledger_of(session: dict) -> dict:
+  return session.setdefault('usage', new_ledger())
+
+def record_turn(session: dict, user_ids: list, prompt_tokens: int, completion_tokens: int, input_tokens: int) -> dict:
+  ledger = ledger_of(session)
+  ledger['total']['prompt'] += prompt_tokens
+  ledger['total']['completion'] += completion_tokens
+  ledger['total']['runs'] += 1
+
+  # A batched turn is one run, so its cost is shared evenly by the players in it
+  for user_id in user_ids:
+    player = ledger['players'].setdefault(user_id, {'prompt': 0, 'completion': 0, 'turns': 0})
+    player['prompt'] += prompt_tokens // len(user_ids)
+    player['completion'] += completion_tokens // len(user_ids)
+    player['turns'] += 1
+
+  context_tokens = prompt_tokens + completion_tokens
+  turn = {
+    'at': time.time(),
+    'players': user_ids,
+    'prompt': prompt_tokens,
+    'completion': completion_tokens,
+    'input_estimate': input_tokens,
+    'growth': context_tokens - ledger['context_tokens'] if ledger['context_tokens'] else 0,
+  }
+  ledger['context_tokens'] = context_tokens
+  ledger['turns'].append(turn)
+  del ledger['turns'][:-USAGE_TURN_HISTORY]
+  return turn
+
+def record_specialist(session: dict, rule_key: str, prompt_tokens: int, completion_tokens: int):
+  specialist = ledger_of(session)['specialist'].setdefault(rule_key, {'prompt': 0, 'completion': 0, 'runs': 0})
+  specialist['prompt'] += prompt_tokens
+  specialist['completion'] += completion_tokens
+  specialist['runs'] += 1
+
+def reset_context(session: dict):
+  # The successor thread starts from the seed; the next run re-establishes the baseline
+  ledger_of(session)['context_tokens'] = 0
+
+def expected_growth(session: dict) -> int:
+  growths = [turn['growth'] for turn in ledger_of(session)['turns'][-GROWTH_SAMPLE_TURNS:] if turn['growth'] > 0]
+  return sum(growths) // len(growths) if growths else 0
+
+def predict_next_context(session: dict, pending_text: str = "") -> int:
+  ledger = ledger_of(session)
+  return ledger['context_tokens'] + max(expected_growth(session), estimate_tokens(pending_text))
+
+def cost(prompt_tokens: int, completion_tokens: int, prompt_price: float = PROMPT_TOKEN_PRICE, completion_price: float = COMPLETION_TOKEN_PRICE) -> float:
+  return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+def percentile(values: list, fraction: float) -> float:
+  ordered = sorted(values)
+  return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0
+
+
+class TierStats:
+  # Latency and cost of every run, grouped by task and model, so a model change on one task shows
+  # up as a shift in that tier's percentiles
+  def __init__(self, samples: int = TIER_LATENCY_SAMPLES):
+    self.samples = samples
+    self.tiers = {}
+
+  def record(self, task: str, model: str, seconds: float, usage=None, prompt_price: float = PROMPT_TOKEN_PRICE, completion_price: float = COMPLETION_TOKEN_PRICE):
+    tier = self.tiers.setdefault((task, model), {
+      'runs': 0,
+      'failed': 0,
+      'prompt': 0,
+      'completion': 0,
+      'cost': 0.0,
+      'latencies': deque(maxlen=self.samples),
+    })
+    tier['runs'] += 1
+    tier['latencies'].append(seconds)
+    if usage is None:
+      tier['failed'] += 1
+      return
+    tier['prompt'] += usage.prompt_tokens
+    tier['completion'] += usage.completion_tokens
+    tier['cost'] += cost(usage.prompt_tokens, usage.completion_tokens, prompt_price, completion_price)
+
+  def report(self) -> str:
+    if not self.tiers:
+      return "尚無紀錄。"
+    lines = []
+    for (task, model), tier in sorted(self.tiers.items()):
+      latencies = list(tier['latencies'])
+      lines.append(
+        f"• {task} / {model}：{tier['runs']} 次（失敗 {tier['failed']}），"
+        f"p50 {percentile(latencies, 0.5):.1f}s，p95 {percentile(latencies, 0.95):.1f}s，"
+        f"平均每次 ${tier['cost'] / tier['runs']:.4f}，共 ${tier['cost']:.2f}"
+      )
+    return "\n".join(lines)